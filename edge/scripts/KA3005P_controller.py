@@ -3,10 +3,21 @@ import sys
 import time
 import json
 import logging
-import requests
 import paho.mqtt.client as mqtt
-import threading
 from ka3005p import PowerSupply
+from psu_worker import PsuWorker
+from driver_registry import DriverRegistry
+from psu_controller import PsuController, DeviceLink, GatewayLink
+from profile_loader import ProfileLoader
+from telemetry_outbox import TelemetryOutbox
+from tb_batcher import TelemetryBatcher, TeeSink
+from telemetry_compression import TelemetryCompressor
+from prom_remote_write import RemoteWriteSink
+from derived_metrics import DerivedFeed
+from history_store import start_history
+from mqtt_uplink import UplinkClient
+from tb_protobuf import ka3005p_schema
+from edge_metrics import REGISTRY, start_export
 
 # Config
 DEVICE_ACCESS_TOKEN = "t00000b00000i00000k8" # CHANGE THIS
@@ -15,208 +26,241 @@ MQTT_HOST = "yourhost.net" # CHANGE THIS
 MQTT_PORT = 1883
 MAX_CURRENT = 5.0 # Max current of the KA3005P in A
 VOLTAGE_SETPOINT = 30.0 # Volts - A fixed voltage to enable current control mode
-
-# Globals
-mode = "manual"
-manual_current_pct = 0
-profile_data = []
-profile_status = "idle"
-profile_thread = None
-profile_url = ""
-psu = None # Initialize psu to None before the try block
+PSU_POLL_INTERVAL_SECONDS = 0.25 # How often the serial worker reads back voltage/current
+PSU_OPEN_TIMEOUT_SECONDS = 5.0 # A PSU taking longer to open is logged and MQTT carries on without it; it's retried in the background
+PSU_STALE_SECONDS = 10.0 # A PSU with no successful poll for this long is closed and reopened
+TELEMETRY_INTERVAL_SECONDS = 2 # How often PSU telemetry is recorded (from the latest poll, no serial traffic)
+PROFILE_RAMP_INTERVAL_SECONDS = 0.1 # Setpoint update period during ramp steps of a profile
+PROFILE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profile_cache") # Downloaded profiles, re-used while unchanged on the server
+# Telemetry is stored here first and sent when MQTT is up, so nothing is lost during outages
+OUTBOX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "psu_outbox.db")
+OUTBOX_MAX_BYTES = 50 * 1024 * 1024 # Oldest readings are dropped beyond this
+# Optional: also write the readings straight into the cloud Prometheus with remote_write, see prom_remote_write.py.
+# They're buffered on disk in REMOTE_WRITE_FILE while it can't be reached.
+REMOTE_WRITE_URL = None # e.g. "http://yourhost.net:9090/api/v1/write"
+REMOTE_WRITE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "psu_remote_write.db")
+# "protobuf" sends each reading as a compact protobuf message (see tb_protobuf.py, single PSU only). The TB device
+# profile then needs Protobuf payloads with `python tb_protobuf.py --proto ka3005p`, and JSON compatibility for the attributes/RPCs
+TELEMETRY_FORMAT = "json"
+# Set to derived_metrics.py's socket (e.g. "/tmp/pem_iot_derived.sock") to send it a copy of the readings for the
+# Faraday efficiency / kWh per Nm3 calculation. Nothing waits if the daemon isn't running.
+DERIVED_SOCKET = None
+# Local history of the readings for commissioning, queried over HTTP without ThingsBoard or the WAN, see history_store.py.
+# With PSU_DEVICES (gateway) the series are named "<device>:<key>".
+HISTORY_PORT = None # e.g. 8767, then curl 'http://raspberrypi:8767/query?series=psu_current&start=-1h'
+HISTORY_DIR = None # None keeps it in memory only. "/dev/shm/pem_history/ka3005p" survives restarts, not reboots
+HISTORY_KEYS = ("*",) # Patterns of the keys kept, ~5.7 MB each once full (see the README)
+UPLINK_SOCKET = None # Set to the mqtt_uplink.py socket (e.g. "/tmp/pem_iot_uplink.sock") to use its shared connection instead
+TB_BATCH_SECONDS = 10 # Readings (with their own timestamps) are grouped into one MQTT message at most this often
+# Report by exception: a key is only sent to ThingsBoard when it can't be reconstructed within the given error
+# from what was already sent (see telemetry_compression.py), and at least every TELEMETRY_HEARTBEAT_SECONDS.
+# Profile step/timing and setpoint latency telemetry isn't listed, so it's always sent. {} sends everything.
+TELEMETRY_COMPRESSION = {
+    "psu_voltage": {"swinging_door": 0.02}, # V - the KA3005P reads back in 10 mV steps
+    "psu_current": {"swinging_door": 0.002}, # A - 1 mA steps
+    "psu_power": {"swinging_door_pct": 0.5},
+    "psu_commandedCurrent": {"deadband": 0}, # whenever it changes
+}
+TELEMETRY_HEARTBEAT_SECONDS = 300
+# This script's own performance metrics (serial command/MQTT publish latency, queue depth, ...), see edge_metrics.py.
+# The textfile goes to node_exporter's textfile collector (see the README). Set METRICS_PORT to also serve /metrics.
+METRICS_TEXTFILE = "/var/lib/node_exporter/textfile_collector/ka3005p_controller.prom" # None to disable
+METRICS_PORT = None # e.g. 9103
+# Several stacks from one process: list the PSUs here and they are all driven through one MQTT
+# connection using the ThingsBoard gateway API. Create a device of type Gateway in TB and put its
+# token in GATEWAY_ACCESS_TOKEN; each entry shows up as its own TB device (by name). max_current and
+# voltage default to MAX_CURRENT and VOLTAGE_SETPOINT. Leave the list empty to drive the single
+# PSU at SERIAL_PORT as the device DEVICE_ACCESS_TOKEN, like before.
+PSU_DEVICES = [
+    # {"name": "PEM Stack 1", "port": "/dev/serial/by-id/usb-Nuvoton_USB_Virtual_COM_000962640452-if00", "max_current": 5.0, "voltage": 30.0},
+    # {"name": "PEM Stack 2", "port": "/dev/serial/by-id/usb-Nuvoton_USB_Virtual_COM_000962640453-if00"},
+]
+GATEWAY_ACCESS_TOKEN = "g00000a00000t00000w8" # CHANGE THIS if you use PSU_DEVICES
+GATEWAY_OUTBOX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "psu_gateway_outbox.db")
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# KA3005P Controller Setup
-try:
-    psu = PowerSupply(SERIAL_PORT)
-    psu.voltage = VOLTAGE_SETPOINT
-    psu.current = 0.0
-    psu.enable()
-    logging.info(f"Connected to PSU at {SERIAL_PORT}. Output is ON.")
-except Exception as e:
-    logging.error(f"Failed to connect to power supply: {e}")
+gateway = bool(PSU_DEVICES)
+if not gateway:
+    PSU_DEVICES = [{"name": "psu", "port": SERIAL_PORT}]
+
+# KA3005P Controller Setup - one serial worker per PSU (each has its own USB port), opened in the
+# background and in parallel by driver_registry.py: MQTT comes up straight away, a PSU that isn't
+# there yet is retried with backoff and attached to its controller once it opens.
+def open_psu(device):
+    psu = PowerSupply(device["port"])
+    worker = PsuWorker(psu, poll_interval_s=PSU_POLL_INTERVAL_SECONDS, name=device["name"],
+                       on_status=lambda status: psus.sampled(device["name"]))
+    worker.start()
+    worker.set_voltage(device.get("voltage", VOLTAGE_SETPOINT))
+    worker.set_current(0.0)
+    try:
+        worker.enable().result(timeout=5) # setpoints are written before the enable
+    except Exception:
+        worker.close(timeout=0)
+        psu.close()
+        raise
+    logging.info(f"{device['name']}: connected to PSU at {device['port']}. Output is ON.")
+    return worker
+
+def attach_psu(name, worker):
+    controllers[name].attach(worker)
+
+def close_psu(name, worker):
+    if controllers[name].worker is worker: # not already closed by the controller on exit
+        controllers[name].worker = None
+        worker.close(timeout=1.0)
+        worker.psu.close() # frees the port for the reopen
+
+psus = DriverRegistry("ka3005p", timeout_s=PSU_OPEN_TIMEOUT_SECONDS, max_errors=1)
+for device in PSU_DEVICES:
+    psus.add(device["name"], lambda device=device: open_psu(device), close_fn=lambda worker, name=device["name"]: close_psu(name, worker),
+             on_ready=lambda worker, name=device["name"]: attach_psu(name, worker))
+profile_loader = ProfileLoader(PROFILE_CACHE_DIR)
 
 # ThingsBoard MQTT bits
 def on_connect(client, userdata, flags, reasonCode, properties):
     logging.info(f"Connected to ThingsBoard Edge with result code {reasonCode}")
-    client.subscribe("v1/devices/me/attributes")
-    
-    # Request all shared attributes to sync local state with server dashboard state
-    client.publish("v1/devices/me/attributes/request/1", json.dumps({"sharedKeys": "controllerMode,manualCurrentPct"}))
+    if gateway:
+        client.subscribe("v1/gateway/attributes")
+        client.subscribe("v1/gateway/attributes/response")
+        client.subscribe("v1/gateway/rpc")
+        for request_id, name in enumerate(controllers, start=1):
+            client.publish("v1/gateway/connect", json.dumps({"device": name, "type": "KA3005P"}))
+            # Request the shared attributes to sync local state with server dashboard state
+            client.publish("v1/gateway/attributes/request", json.dumps({"id": request_id, "device": name, "client": False, "keys": ["controllerMode", "manualCurrentPct"]}))
+    else:
+        client.subscribe("v1/devices/me/attributes")
+        client.subscribe("v1/devices/me/attributes/response/+")
+        client.subscribe("v1/devices/me/rpc/request/+")
+
+        # Request all shared attributes to sync local state with server dashboard state
+        client.publish("v1/devices/me/attributes/request/1", json.dumps({"sharedKeys": "controllerMode,manualCurrentPct"}))
 
 def on_message(client, userdata, msg):
-    global mode, manual_current_pct, profile_url, profile_data, profile_status, profile_thread
-    
+    received = time.monotonic()
     topic = msg.topic
     payload = json.loads(msg.payload.decode("utf-8"))
     
     logging.info(f"Message received on topic {topic}: {payload}")
 
-    attributes = payload.get('shared', payload)
-    
-    # Check for mode change (manual  or auto)
-    if "controllerMode" in attributes:
-        mode = attributes["controllerMode"]
-        logging.info(f"Controller mode switched to: {mode}")
-        
-        if mode == "manual" and profile_thread and profile_thread.is_alive():
-            logging.warning("Automated profile cancelled due to mode switch.")
-            profile_status = "idle"
-            client.publish("v1/devices/me/attributes", json.dumps({"profileStatus": profile_status}))
-
-    # Check for manual current change
-    if "manualCurrentPct" in attributes:
-        manual_current_pct = attributes["manualCurrentPct"]
-        
-    # Check for power profile URL change
-    if "profileUrl" in attributes:
-        profile_url = attributes["profileUrl"]
-
-    # Check for new power profile trigger
-    if "newProfileReady" in attributes and attributes["newProfileReady"] == True:
-        if profile_url:
-            client.publish("v1/devices/me/attributes", json.dumps({"newProfileReady": False}))
-            
-            if profile_thread and profile_thread.is_alive():
-                logging.warning("New profile request received, but a profile is already running.")
-                return
-            
-            profile_thread = threading.Thread(target=run_automated_profile)
-            profile_thread.start()
-
+    if gateway:
+        controller = controllers.get(payload.get("device"))
+        if controller is None:
+            logging.warning(f"Message for unknown device: {payload.get('device')}")
+        elif topic == "v1/gateway/rpc":
+            data = payload.get("data", {})
+            controller.handle_rpc(data.get("id"), data.get("method"), data.get("params"), received)
+        elif topic == "v1/gateway/attributes/response":
+            values = payload.get("values", {payload.get("key"): payload.get("value")} if "key" in payload else {})
+            controller.handle_attributes(values, received)
         else:
-            logging.warning("New profile flag set but URL is missing.")
-
-def run_automated_profile():
-    global profile_data, profile_status, mode, psu, client
-    
-    if mode != "auto":
-        logging.warning("Cannot start automated profile: Controller not in 'auto' mode.")
-        profile_status = "idle"
-        client.publish("v1/devices/me/attributes", json.dumps({"profileStatus": profile_status}))
-        return
-    
-    if not psu:
-        logging.error("Cannot start automated profile: Power supply not connected.")
-        profile_status = "idle"
-        client.publish("v1/devices/me/attributes", json.dumps({"profileStatus": profile_status}))
-        return
-
-    try:
-      # Download and parse the power profile csv from the specified URL
-        profile_status = "downloading"
-        client.publish("v1/devices/me/attributes", json.dumps({"profileStatus": profile_status}))
-        
-        response = requests.get(profile_url, timeout=10)
-        response.raise_for_status()
-        
-        csv_data = response.text.strip().split('\n')
-        profile_data = []
-        for line in csv_data[1:]:
-            duration, power_pct = line.split(',')
-            profile_data.append({"duration": int(duration), "power_pct": int(power_pct)})
-            
-        logging.info("Power profile downloaded and parsed successfully.")
-        
-    except requests.exceptions.RequestException as e:
-        profile_status = "download_error"
-        client.publish("v1/devices/me/attributes", json.dumps({"profileStatus": profile_status}))
-        logging.error(f"Error downloading profile from {profile_url}: {e}")
-        return
-    except Exception as e:
-        profile_status = "parsing_error"
-        client.publish("v1/devices/me/attributes", json.dumps({"profileStatus": profile_status}))
-        logging.error(f"Error parsing profile data: {e}")
-        return
-    
-    logging.info("Automated profile execution started.")
-    profile_status = "executing"
-    client.publish("v1/devices/me/attributes", json.dumps({"profileStatus": profile_status}))
-
-  # run the power profile
-    for step in profile_data:
-        if mode != "auto":
-            logging.info("Automated profile execution interrupted by user.")
-            break
-        
-        power_pct = step["power_pct"]
-        duration_s = step["duration"]
-        
-        target_current = (power_pct / 100.0) * MAX_CURRENT
-        
-        logging.info(f"Setting current to {target_current:.2f}A ({power_pct}%) for {duration_s} seconds.")
-        try:
-            psu.current = target_current
-            client.publish("v1/devices/me/telemetry", json.dumps({"psu_commandedCurrent": target_current}))
-        except Exception as e:
-            logging.error(f"Failed to set current: {e}")
-            
-        time.sleep(duration_s)
-        
-    logging.info("Automated profile execution finished.")
-    profile_status = "idle"
-    client.publish("v1/devices/me/attributes", json.dumps({"profileStatus": profile_status}))
+            controller.handle_attributes(payload.get("data", {}), received)
+    else:
+        controller = controllers["psu"]
+        if topic.startswith("v1/devices/me/rpc/request/"):
+            controller.handle_rpc(topic.rsplit("/", 1)[1], payload.get("method"), payload.get("params"), received)
+        else:
+            controller.handle_attributes(payload.get('shared', payload), received)
 
 def main_loop():
-    global mode, manual_current_pct, psu, client
-    
+    overruns = REGISTRY.counter("edge_loop_overruns_total", "Sample slots skipped because a loop iteration ran late", ["loop"]).labels(loop="psu_main")
+    next_due = time.monotonic()
     while True:
-        try:
-            commanded_current = 0
-
-          # manually control PSU
-            if mode == "manual":
-                if psu:
-                    target_current = (manual_current_pct / 100.0) * MAX_CURRENT
-                    psu.current = target_current
-                    commanded_current = target_current
-                else:
-                    commanded_current = (manual_current_pct / 100.0) * MAX_CURRENT
+        for controller in controllers.values():
+            try:
+                controller.sample()
+            except Exception as e:
+                logging.error(f"{controller.name}: error in main loop: {e}")
+            # Stale: no successful poll for PSU_STALE_SECONDS, or none at all that long after (re)opening
+            status = controller.worker.status if controller.worker else None
+            if controller.worker and time.monotonic() - (status["mono"] if status else controller.attached) > PSU_STALE_SECONDS:
+                psus.report_error(controller.name, "no successful poll") # reopened in the background
             
-            elif mode == "auto":
-                if psu:
-                    commanded_current = psu.current
-
-          # get and publish the telemety from the PSU reported values
-            if psu:
-                voltage_v = psu.voltage
-                current_a = psu.current
-                power_w = voltage_v * current_a
-
-                telemetry = {
-                    "psu_voltage": voltage_v,
-                    "psu_current": current_a,
-                    "psu_power": power_w,
-                    "psu_commandedCurrent": commanded_current
-                }
-                client.publish("v1/devices/me/telemetry", json.dumps(telemetry))
-            else:
-                telemetry = {
-                    "psu_commandedCurrent": commanded_current
-                }
-                client.publish("v1/devices/me/telemetry", json.dumps(telemetry))
-
-        except Exception as e:
-            logging.error(f"Error in main loop: {e}")
-            
-        time.sleep(2)
+        next_due += TELEMETRY_INTERVAL_SECONDS
+        now = time.monotonic()
+        if next_due < now:
+            overruns.inc()
+            next_due = now
+        time.sleep(next_due - now)
 
 # Setup MQTT client
-client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=DEVICE_ACCESS_TOKEN)
-client.username_pw_set(DEVICE_ACCESS_TOKEN)
+outbox = None
+if UPLINK_SOCKET and gateway:
+    logging.warning("UPLINK_SOCKET is ignored with PSU_DEVICES, the gateway connection is already shared by all PSUs")
+    UPLINK_SOCKET = None
+if TELEMETRY_FORMAT == "protobuf" and (gateway or UPLINK_SOCKET):
+    logging.warning("TELEMETRY_FORMAT protobuf is ignored with PSU_DEVICES or UPLINK_SOCKET, sending JSON")
+if UPLINK_SOCKET:
+    # The uplink daemon holds the MQTT connection, subscriptions and the outbox
+    client = UplinkClient(UPLINK_SOCKET, DEVICE_ACCESS_TOKEN)
+    telemetry_sink = client
+else:
+    token = GATEWAY_ACCESS_TOKEN if gateway else DEVICE_ACCESS_TOKEN
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=token)
+    client.username_pw_set(token)
+    client.connect_async(MQTT_HOST, MQTT_PORT, 60) # the loop keeps retrying until the broker is up
+    encoder = ka3005p_schema() if TELEMETRY_FORMAT == "protobuf" and not gateway else None
+    outbox = TelemetryOutbox(GATEWAY_OUTBOX_FILE if gateway else OUTBOX_FILE, client, max_bytes=OUTBOX_MAX_BYTES, gateway=gateway, encoder=encoder)
+    telemetry_sink = outbox
+compressor = None
+if TELEMETRY_COMPRESSION: # only what goes to ThingsBoard, remote_write gets every reading
+    compressor = TelemetryCompressor(telemetry_sink, TELEMETRY_COMPRESSION, heartbeat_s=TELEMETRY_HEARTBEAT_SECONDS, name="psu")
+    telemetry_sink = compressor
+remote_write = None
+if REMOTE_WRITE_URL:
+    # Gateway telemetry carries the PSU name, which becomes a device="..." label
+    remote_write = RemoteWriteSink(REMOTE_WRITE_URL, REMOTE_WRITE_FILE, labels={"job": "pem_edge", "script": "ka3005p_controller"})
+    remote_write.start()
+    telemetry_sink = TeeSink(telemetry_sink, remote_write)
+derived_feed = None
+if DERIVED_SOCKET:
+    derived_feed = DerivedFeed(DERIVED_SOCKET, "ka3005p_controller")
+    telemetry_sink = TeeSink(telemetry_sink, derived_feed)
+history, history_server = None, None
+if HISTORY_PORT or HISTORY_DIR:
+    history, history_server = start_history(HISTORY_DIR, HISTORY_PORT, keys=HISTORY_KEYS)
+batcher = TelemetryBatcher(telemetry_sink, max_age_s=TB_BATCH_SECONDS, name="psu", tap=history)
+
+# One controller (mode, setpoints, profile) per PSU, all sharing the client, batcher and outbox
+controllers = {}
+for device in PSU_DEVICES:
+    link = GatewayLink(client, batcher, device["name"]) if gateway else DeviceLink(client, batcher)
+    controllers[device["name"]] = PsuController(device["name"], None, link, profile_loader,
+                                                device.get("max_current", MAX_CURRENT), ramp_interval_s=PROFILE_RAMP_INTERVAL_SECONDS)
+psus.start() # the workers are attached to their controllers as the PSUs open
+
 client.on_connect = on_connect
 client.on_message = on_message
-client.connect(MQTT_HOST, MQTT_PORT, 60)
 client.loop_start()
+if outbox:
+    outbox.start()
+batcher.start()
+metrics = start_export("ka3005p_controller", textfile=METRICS_TEXTFILE, port=METRICS_PORT)
 
 
 try:
     main_loop()
 except KeyboardInterrupt:
     logging.info("Exiting script...")
-    if psu:
-        psu.disable()
+    metrics.close()
+    for controller in controllers.values():
+        controller.close()
+    psus.close()
+    batcher.close()
+    if compressor:
+        compressor.close() # sends the points it's still holding
+        logging.info(f"Telemetry compression: {compressor.stats()}")
+    if outbox:
+        outbox.close()
+    if remote_write:
+        remote_write.close()
+    if derived_feed:
+        derived_feed.close()
+    if history_server:
+        history_server.close()
+    if history:
+        history.close()
     client.loop_stop()
     sys.exit(0)
@@ -0,0 +1,386 @@
+# Streaming derived metrics: Faraday efficiency, kWh/Nm3 H2, charge, energy, stack resistance
+# Stack current/voltage come from sensors.py (INA260) or KA3005P_controller.py, H2 volume from
+# gas_monitor.py - three processes, each batching on its own schedule. Each script hands a copy of
+# its telemetry to this daemon (DERIVED_SOCKET in the script, a Unix datagram socket, nothing
+# waits if the daemon isn't running). The daemon integrates charge and energy with O(1) work per
+# electrical sample, and at every gas counter sample - once the electrical stream has caught up to
+# that time, so bursts and late batches line up - interpolates the electrical totals to the gas
+# sample's timestamp. A rolling window over those aligned points gives
+#   faradayEfficiency_pct        H2 actually collected / H2 the charge should have made (cells * Q / 2F)
+#   specificEnergy_kWh_per_Nm3   electrical energy per normal m3 (0 degC, 1013.25 hPa) of H2
+# plus running totals stack_charge_Ah, stack_energy_kWh, h2_volume_Nl and the stack resistance
+# (exponentially weighted V/I, its trend per hour and dV/dI). They go to ThingsBoard as the
+# telemetry of their own device (DERIVED_ACCESS_TOKEN).
+# Run it (e.g. as a systemd service like mqtt_uplink.py):  python derived_metrics.py
+# Demo on synthetic streams (checks the numbers, times the processing):  python derived_metrics.py --demo
+import json
+import math
+import os
+import socket
+from collections import deque
+
+from edge_metrics import REGISTRY
+
+# Config
+MQTT_HOST = "localhost" # ThingsBoard Edge on the same Pi
+MQTT_PORT = 1883
+DERIVED_ACCESS_TOKEN = "d00000e00000r00000v0" # CHANGE THIS - a TB device for the derived telemetry
+DERIVED_SOCKET = "/tmp/pem_iot_derived.sock" # must match DERIVED_SOCKET in the scripts
+UPLINK_SOCKET = None # Set to the mqtt_uplink.py socket to publish through it instead of connecting here
+OUTBOX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "derived_outbox.db")
+TB_BATCH_SECONDS = 30
+ELECTRICAL_SOURCE = "sensors" # "sensors" (INA260 on the stack leads) or "ka3005p_controller" (PSU read back)
+PSU_DEVICE = None # with several PSUs (gateway mode), the PSU name feeding the stack on the gas counter
+STACK_CELLS = 1 # CHANGE THIS - cells in series, each makes H2 from the full stack current
+WINDOW_SECONDS = 600 # Rolling window for the efficiency figures
+GAS_PRESSURE_HPA = 1013.25 # Used until sensors.py reports pressure_hPa
+GAS_TEMPERATURE_C = 20.0 # Used until sensors.py reports sht40_temperature_C (the gas is near room temperature in the counter)
+METRICS_TEXTFILE = "/var/lib/node_exporter/textfile_collector/derived_metrics.prom" # None to disable
+METRICS_PORT = None
+
+FARADAY_C_PER_MOL = 96485.332
+NORMAL_LITRES_PER_MOL = 22.414 # ideal gas at 0 degC, 1013.25 hPa
+
+DROPPED_SAMPLES = REGISTRY.counter("edge_derived_dropped_samples_total", "Input samples the derived metrics couldn't use", ["reason"])
+
+# Stream keys by source: (current key, scale to A, voltage key, scale to V, power key, scale to W)
+ELECTRICAL_KEYS = {
+    "sensors": ("current_mA", 0.001, "voltage_V", 1.0, "power_mW", 0.001),
+    "ka3005p_controller": ("psu_current", 1.0, "psu_voltage", 1.0, "psu_power", 1.0),
+}
+
+
+class _EwRegression:
+    """Exponentially weighted least squares y = a + b x, forgetting with time constant tau_s. O(1) per point."""
+
+    def __init__(self, tau_s):
+        self.tau_s = tau_s
+        self.last_t = None
+        self.sw = self.sx = self.sy = self.sxx = self.sxy = 0.0
+
+    def add(self, t, x, y):
+        if self.last_t is not None:
+            decay = math.exp(-max(0.0, t - self.last_t) / self.tau_s)
+            self.sw *= decay
+            self.sx *= decay
+            self.sy *= decay
+            self.sxx *= decay
+            self.sxy *= decay
+        self.last_t = t
+        self.sw += 1.0
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.sxy += x * y
+
+    @property
+    def mean_y(self):
+        return self.sy / self.sw if self.sw else None
+
+    def slope(self, min_var_x):
+        """dy/dx, or None while x hasn't varied by more than min_var_x (variance) in the window."""
+        if self.sw < 2:
+            return None
+        var_x = self.sxx / self.sw - (self.sx / self.sw) ** 2
+        if var_x <= min_var_x:
+            return None
+        return (self.sxy / self.sw - (self.sx / self.sw) * (self.sy / self.sw)) / var_x
+
+
+class DerivedMetrics:
+    """Aligns the electrical and gas streams and returns derived telemetry records [(ts_ms, values), ...]."""
+
+    def __init__(self, cells=1, window_s=600.0, min_span_s=60.0, max_gap_s=60.0, min_current_a=0.05,
+                 pressure_hpa=1013.25, temperature_c=20.0, max_pending=10000, max_electrical=86400):
+        self.cells = cells
+        self.window_s = window_s
+        self.min_span_s = min_span_s # shortest window the efficiency figures are published for (after a start/gap)
+        self.max_gap_s = max_gap_s # longer without an electrical sample and the charge in between is unknown
+        self.min_current_a = min_current_a # below this the stack is off - no resistance
+        self.pressure_hpa = pressure_hpa
+        self.temperature_c = temperature_c
+        self.max_pending = max_pending
+        self.max_electrical = max_electrical # electrical samples kept for gas samples yet to come (a day at 1 Hz)
+
+        # Running totals since the daemon started
+        self.charge_c = 0.0
+        self.energy_j = 0.0
+        self.h2_nl = 0.0
+
+        self._electrical = deque() # (t, charge_c, energy_j) per electrical sample, back to the oldest gas time still to come
+        self._last_electrical = None # (t, current, power)
+        self._last_gas = None # (t, volume_ml)
+        self._pending = deque() # (t, h2_nl) gas samples waiting for the electrical stream to catch up
+        self._window = deque() # aligned (t, charge_c, energy_j, h2_nl), oldest first
+        self._gap_until = None # no efficiency over windows starting before this (charge unknown in a gap)
+        self._resistance = _EwRegression(window_s) # V/I against time (hours)
+        self._dvdi = _EwRegression(window_s) # V against I
+        self._t_first = None
+
+        # Stats
+        self.dropped = {"late": 0, "gap": 0, "overflow": 0, "electrical_overflow": 0, "unaligned": 0}
+        self.released = 0
+
+    def _drop(self, reason):
+        self.dropped[reason] += 1
+        DROPPED_SAMPLES.inc(reason=reason)
+
+    def add_conditions(self, ts_ms, pressure_hpa=None, temperature_c=None):
+        """Gas pressure/temperature used to normalise the gas counter volume from here on."""
+        if pressure_hpa is not None:
+            self.pressure_hpa = pressure_hpa
+        if temperature_c is not None:
+            self.temperature_c = temperature_c
+
+    def add_electrical(self, ts_ms, current_a, voltage_v, power_w=None):
+        t = ts_ms / 1000.0
+        last = self._last_electrical
+        if last is not None and t <= last[0]:
+            self._drop("late") # out of order - the totals up to here are already used
+            return []
+        power_w = current_a * voltage_v if power_w is None else power_w
+        if last is not None:
+            dt = t - last[0]
+            if dt <= self.max_gap_s:
+                self.charge_c += (last[1] + current_a) / 2.0 * dt # trapezoid
+                self.energy_j += (last[2] + power_w) / 2.0 * dt
+            else:
+                self._drop("gap")
+                self._gap_until = t
+        self._last_electrical = (t, current_a, power_w)
+        points = self._electrical
+        points.append((t, self.charge_c, self.energy_j))
+        if not self._pending and self._last_gas is not None:
+            # The next gas sample is after the last one (earlier ones are dropped as late), so only the
+            # electrical sample at or before that time is still needed to interpolate
+            while len(points) > 1 and points[1][0] <= self._last_gas[0]:
+                points.popleft()
+        if len(points) > self.max_electrical:
+            points.popleft() # no gas for a long time (gas_monitor.py down) - its backlog can't reach this far back
+            self._drop("electrical_overflow")
+
+        if current_a >= self.min_current_a:
+            if self._t_first is None:
+                self._t_first = t
+            self._resistance.add(t, (t - self._t_first) / 3600.0, voltage_v / current_a)
+            self._dvdi.add(t, current_a, voltage_v)
+        return self._release()
+
+    def add_gas(self, ts_ms, volume_ml):
+        t = ts_ms / 1000.0
+        last = self._last_gas
+        if last is not None and t <= last[0]:
+            self._drop("late")
+            return []
+        if last is not None:
+            delta_ml = volume_ml - last[1]
+            if delta_ml > 0: # < 0: the counter total was reset
+                kelvin = 273.15 + self.temperature_c
+                self.h2_nl += delta_ml / 1000.0 * (self.pressure_hpa / 1013.25) * (273.15 / kelvin)
+        self._last_gas = (t, volume_ml)
+        self._pending.append((t, self.h2_nl))
+        if len(self._pending) > self.max_pending:
+            self._pending.popleft() # the electrical stream has been away for a long time
+            self._drop("overflow")
+        return self._release()
+
+    def _charge_energy_at(self, t):
+        """Electrical totals linearly interpolated to t (inside the buffered samples)."""
+        points = self._electrical
+        while len(points) > 1 and points[1][0] <= t:
+            points.popleft() # later gas samples are later in time too
+        t0, q0, e0 = points[0]
+        if len(points) == 1 or t <= t0:
+            return q0, e0
+        t1, q1, e1 = points[1]
+        f = (t - t0) / (t1 - t0)
+        return q0 + (q1 - q0) * f, e0 + (e1 - e0) * f
+
+    def _release(self):
+        out = []
+        while self._pending and self._electrical and self._pending[0][0] <= self._electrical[-1][0]:
+            t, h2_nl = self._pending.popleft()
+            if t < self._electrical[0][0]:
+                self._drop("unaligned") # before the first electrical sample we have
+                continue
+            charge_c, energy_j = self._charge_energy_at(t)
+            window = self._window
+            window.append((t, charge_c, energy_j, h2_nl))
+            while len(window) > 1 and window[1][0] <= t - self.window_s:
+                window.popleft()
+            out.append((int(t * 1000), self._values(t, charge_c, energy_j, h2_nl)))
+        self.released += len(out)
+        return out
+
+    def _values(self, t, charge_c, energy_j, h2_nl):
+        values = {
+            "stack_charge_Ah": round(charge_c / 3600.0, 6),
+            "stack_energy_kWh": round(energy_j / 3.6e6, 6),
+            "h2_volume_Nl": round(h2_nl, 4),
+        }
+        t0, charge0, energy0, h2_0 = self._window[0]
+        if t - t0 >= self.min_span_s and (self._gap_until is None or t0 >= self._gap_until):
+            charge = charge_c - charge0
+            h2 = h2_nl - h2_0
+            if charge > 0:
+                theoretical_nl = self.cells * charge / (2.0 * FARADAY_C_PER_MOL) * NORMAL_LITRES_PER_MOL
+                values["faradayEfficiency_pct"] = round(100.0 * h2 / theoretical_nl, 2)
+            if h2 > 0:
+                values["specificEnergy_kWh_per_Nm3"] = round((energy_j - energy0) / 3.6e6 / (h2 / 1000.0), 3)
+        if self._resistance.sw:
+            values["stack_resistance_ohm"] = round(self._resistance.mean_y, 5)
+            trend = self._resistance.slope(min_var_x=(60.0 / 3600.0) ** 2) # at least ~a minute of samples
+            if trend is not None:
+                values["stack_resistanceTrend_mohm_per_h"] = round(trend * 1000.0, 4)
+            dvdi = self._dvdi.slope(min_var_x=0.05 ** 2) # needs the current to have moved
+            if dvdi is not None:
+                values["stack_differentialResistance_ohm"] = round(dvdi, 5)
+        return values
+
+    def feed(self, source, records, electrical_source="sensors", psu_device=None):
+        """Routes a script's telemetry records [(ts_ms, values[, device]), ...] to the streams above."""
+        out = []
+        current_key, current_scale, voltage_key, voltage_scale, power_key, power_scale = ELECTRICAL_KEYS[electrical_source]
+        for record in records:
+            ts, values = record[0], record[1]
+            device = record[2] if len(record) > 2 else None
+            if source == "sensors":
+                self.add_conditions(ts, values.get("pressure_hPa"), values.get("sht40_temperature_C"))
+            if source == electrical_source and device == psu_device and current_key in values and voltage_key in values:
+                power = values.get(power_key)
+                out += self.add_electrical(ts, values[current_key] * current_scale, values[voltage_key] * voltage_scale,
+                                           power * power_scale if power is not None else None)
+            if source == "gas_monitor" and "totalVolume_ml" in values:
+                out += self.add_gas(ts, values["totalVolume_ml"])
+        return out
+
+    def stats(self):
+        return {"released": self.released, "pending": len(self._pending), "dropped": dict(self.dropped)}
+
+
+class DerivedFeed:
+    """A TelemetryBatcher sink (use in a TeeSink) that sends copies of the records to the daemon.
+
+    Never blocks: if the daemon isn't running or its socket buffer is full the records are skipped.
+    """
+
+    def __init__(self, socket_path, source, chunk_records=50):
+        self.socket_path = socket_path
+        self.source = source # the script name, the daemon routes on it
+        self.chunk_records = chunk_records # keeps each datagram well under the socket buffer size
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self.sent = 0
+        self.skipped = 0
+
+    def put_many(self, records):
+        for i in range(0, len(records), self.chunk_records):
+            chunk = records[i:i + self.chunk_records]
+            data = json.dumps({"source": self.source, "records": [list(record) for record in chunk]}, separators=(",", ":")).encode()
+            try:
+                self._sock.sendto(data, self.socket_path)
+                self.sent += len(chunk)
+            except OSError: # no daemon (ENOENT/ECONNREFUSED) or it's behind (EAGAIN)
+                self.skipped += len(chunk)
+
+    def close(self):
+        self._sock.close()
+
+
+def _demo():
+    import random
+    import time
+
+    rng = random.Random(1)
+    cells, efficiency, hours = 2, 0.93, 6
+    processor = DerivedMetrics(cells=cells, window_s=WINDOW_SECONDS)
+    # PSU every 2 s, gas counter every 5 s. Each script's batch arrives on its own schedule
+    # (10 s and 30 s), so the gas samples are always behind or ahead of the electrical ones.
+    start_ms = 1760000000000
+    psu, gas = [], []
+    volume_ml, current = 0.0, 2.0
+    for i in range(int(hours * 3600 / 2)):
+        t = i * 2.0
+        if i % 900 == 0:
+            current = rng.choice((1.0, 2.0, 3.0, 4.0))
+        voltage = cells * (1.5 + 0.2 * current) # 0.2 ohm per cell
+        psu.append((start_ms + int(t * 1000), {"psu_current": current, "psu_voltage": voltage, "psu_power": current * voltage}))
+        # at 20 degC and 1013.25 hPa the gas takes 293.15/273.15 of its normal volume
+        volume_ml += efficiency * cells * current * 2.0 / (2 * FARADAY_C_PER_MOL) * NORMAL_LITRES_PER_MOL * 1000 * 293.15 / 273.15
+        if i % 5 == 2:
+            gas.append((start_ms + int(t * 1000), {"totalVolume_ml": round(volume_ml, 2)}))
+    deliveries = [(("ka3005p_controller", psu[i:i + 5])) for i in range(0, len(psu), 5)]
+    deliveries += [("gas_monitor", gas[i:i + 6]) for i in range(0, len(gas), 6)]
+    deliveries.sort(key=lambda d: d[1][-1][0] + (10000 if d[0] == "ka3005p_controller" else 30000)) # arrival time
+    started = time.perf_counter()
+    released = []
+    for source, records in deliveries:
+        released += processor.feed(source, records, electrical_source="ka3005p_controller")
+    elapsed = time.perf_counter() - started
+    samples = len(psu) + len(gas)
+    last = released[-1][1]
+    efficiencies = [values["faradayEfficiency_pct"] for _, values in released if "faradayEfficiency_pct" in values]
+    print(f"{samples} samples over {hours} h in {elapsed * 1000:.0f} ms ({elapsed / samples * 1e6:.1f} us/sample), {processor.stats()}")
+    print(f"Faraday efficiency {min(efficiencies):.2f}..{max(efficiencies):.2f} % (simulated {efficiency * 100:.0f} %)")
+    print(f"last: {last}")
+    expected_kwh = 1.5 / efficiency * 2 * FARADAY_C_PER_MOL / NORMAL_LITRES_PER_MOL / 3.6e3 # at 0 A overpotential
+    print(f"(specific energy is at least {expected_kwh:.2f} kWh/Nm3 at 1.5 V/cell, resistance 0.2 ohm/cell * {cells} cells = {0.2 * cells} ohm dV/dI)")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if "--demo" in sys.argv:
+        _demo()
+        sys.exit(0)
+
+    from edge_metrics import start_export
+    from tb_batcher import TelemetryBatcher
+
+    if UPLINK_SOCKET:
+        from mqtt_uplink import UplinkClient
+        client = UplinkClient(UPLINK_SOCKET, DERIVED_ACCESS_TOKEN)
+        client.loop_start()
+        outbox, sink = None, client
+    else:
+        import paho.mqtt.client as mqtt
+        from telemetry_outbox import TelemetryOutbox
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="pem_derived_metrics")
+        client.username_pw_set(DERIVED_ACCESS_TOKEN)
+        client.connect_async(MQTT_HOST, MQTT_PORT, 60)
+        client.loop_start()
+        outbox = sink = TelemetryOutbox(OUTBOX_FILE, client)
+        outbox.start()
+    batcher = TelemetryBatcher(sink, max_age_s=TB_BATCH_SECONDS, name="derived")
+    batcher.start()
+    metrics = start_export("derived_metrics", textfile=METRICS_TEXTFILE, port=METRICS_PORT)
+
+    processor = DerivedMetrics(cells=STACK_CELLS, window_s=WINDOW_SECONDS, pressure_hpa=GAS_PRESSURE_HPA, temperature_c=GAS_TEMPERATURE_C)
+    if os.path.exists(DERIVED_SOCKET):
+        os.unlink(DERIVED_SOCKET) # stale socket from a previous run
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(DERIVED_SOCKET)
+    os.chmod(DERIVED_SOCKET, 0o660)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024) # room for a burst of backlog
+    print(f"Derived metrics listening on {DERIVED_SOCKET}, electrical stream from {ELECTRICAL_SOURCE}")
+    try:
+        while True:
+            data = server.recv(1024 * 1024)
+            try:
+                message = json.loads(data)
+                derived = processor.feed(message["source"], message["records"], electrical_source=ELECTRICAL_SOURCE, psu_device=PSU_DEVICE)
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Bad message on {DERIVED_SOCKET}: {e}")
+                continue
+            for ts, values in derived:
+                batcher.add(values, ts=ts)
+    except KeyboardInterrupt:
+        print(f"Exiting. {processor.stats()}")
+    finally:
+        server.close()
+        os.unlink(DERIVED_SOCKET)
+        metrics.close()
+        batcher.close()
+        if outbox:
+            outbox.close()
+        client.loop_stop()
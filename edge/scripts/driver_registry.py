@@ -0,0 +1,259 @@
+# Background, parallel device opening (used by sensors.py and KA3005P_controller.py)
+# Opening the hardware used to happen in line at import: the I2C bus and three sensor drivers one
+# after another, then the PSU's serial port. One missing or slow device either killed the script or
+# left it degraded until someone restarted it (a PSU that failed to open was never retried).
+# DriverRegistry opens every device on its own thread, straight away and in parallel, so the
+# script starts publishing whatever is ready and the rest joins in as it comes up:
+#   - an open that takes longer than timeout_s is reported (the attempt keeps going; a hung
+#     open isn't started twice), a failed one is retried with exponential backoff,
+#   - devices can depend on another (the sensors on the I2C bus) and get it passed in,
+#   - after max_errors reads in a row fail (report_error), the device is closed and reopened.
+# get() never blocks: it returns None until the device is ready. Metrics: edge_driver_ready,
+# edge_driver_open_seconds, edge_driver_open_failures_total and edge_time_to_first_sample_seconds,
+# the time from process start (so imports and a systemd restart count) to each device's first sample.
+# Benchmark against simulated devices (one slow, one failing twice):  python driver_registry.py
+import os
+import threading
+import time
+from concurrent.futures import Future, wait
+
+from edge_metrics import REGISTRY
+
+READY = REGISTRY.gauge("edge_driver_ready", "1 if the device is open and usable", ["device"])
+OPEN_SECONDS = REGISTRY.histogram("edge_driver_open_seconds", "Time taken by a successful device open", ["device"])
+OPEN_FAILURES = REGISTRY.counter("edge_driver_open_failures_total", "Failed or timed out device opens", ["device"])
+FIRST_SAMPLE = REGISTRY.gauge("edge_time_to_first_sample_seconds", "Process start to the first sample from the device", ["device"])
+
+
+def process_age_s():
+    """Seconds since this process started (from /proc), or since this module was imported elsewhere."""
+    try:
+        with open("/proc/self/stat") as f:
+            started_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime_s = float(f.read().split()[0])
+        return max(0.0, uptime_s - started_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _IMPORTED
+
+
+_IMPORTED = time.monotonic()
+
+
+class _Device:
+    def __init__(self, name, open_fn, close_fn, requires, timeout_s, on_ready):
+        self.name = name
+        self.open_fn = open_fn
+        self.close_fn = close_fn
+        self.requires = tuple(requires)
+        self.timeout_s = timeout_s
+        self.on_ready = on_ready
+        self.driver = None
+        self.ready = threading.Event()
+        self.reopen = threading.Event()
+        self.errors_in_row = 0
+        self.attempts = 0
+        self.opened_at_s = None # process age when it first became ready
+        self.first_sample_s = None
+        self.last_error = None
+
+
+class DriverRegistry:
+    """Opens devices in the background, in parallel, retrying with backoff. get() never blocks."""
+
+    def __init__(self, name="drivers", timeout_s=2.0, backoff_s=1.0, max_backoff_s=60.0, max_errors=10):
+        self.name = name
+        self.timeout_s = timeout_s
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.max_errors = max_errors # reads failing in a row before the device is reopened
+        self._devices = {}
+        self._stop = threading.Event()
+        self._all_sampled = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def add(self, name, open_fn, close_fn=None, requires=(), timeout_s=None, on_ready=None):
+        """open_fn(*required drivers) -> driver. on_ready(driver) is called on every (re)open."""
+        self._devices[name] = _Device(name, open_fn, close_fn, requires, timeout_s or self.timeout_s, on_ready)
+        READY.labels(device=name).set(0)
+        return self
+
+    def start(self):
+        for device in self._devices.values():
+            thread = threading.Thread(target=self._supervise, args=(device,), name=f"{self.name}-{device.name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def _attempt(self, device, drivers):
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(device.open_fn(*drivers))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name=f"{self.name}-{device.name}-open", daemon=True).start()
+        return future
+
+    def _supervise(self, device):
+        backoff = self.backoff_s
+        while not self._stop.is_set():
+            # Dependencies first (e.g. the I2C bus), waiting for them without giving up
+            drivers = []
+            for required in device.requires:
+                dependency = self._devices[required]
+                while not dependency.ready.wait(0.1):
+                    if self._stop.is_set():
+                        return
+                drivers.append(dependency.driver)
+
+            device.attempts += 1
+            started = time.monotonic()
+            future = self._attempt(device, drivers)
+            timed_out = False
+            while not wait([future], timeout=0.1 if timed_out else device.timeout_s).done:
+                if self._stop.is_set():
+                    return
+                if not timed_out:
+                    timed_out = True
+                    OPEN_FAILURES.labels(device=device.name).inc()
+                    print(f"{device.name}: still opening after {device.timeout_s:g} s, carrying on without it")
+            error = future.exception()
+
+            if error is None:
+                elapsed = time.monotonic() - started
+                OPEN_SECONDS.labels(device=device.name).observe(elapsed)
+                driver = future.result()
+                with self._lock:
+                    device.driver = driver
+                    device.errors_in_row = 0
+                    device.last_error = None
+                if device.opened_at_s is None:
+                    device.opened_at_s = process_age_s()
+                print(f"{device.name}: ready in {elapsed:.3f} s" + (f" (attempt {device.attempts})" if device.attempts > 1 else ""))
+                if device.on_ready:
+                    try:
+                        device.on_ready(driver)
+                    except Exception as e:
+                        print(f"Error in {device.name} on_ready: {e}")
+                device.ready.set()
+                READY.labels(device=device.name).set(1)
+                backoff = self.backoff_s
+                # Until reads keep failing (report_error) or we're closing
+                while not device.reopen.wait(0.5):
+                    if self._stop.is_set():
+                        return
+                device.reopen.clear()
+                self._drop(device)
+                if self._stop.wait(self.backoff_s):
+                    return
+                continue
+
+            if not timed_out:
+                OPEN_FAILURES.labels(device=device.name).inc()
+            device.last_error = error
+            print(f"{device.name}: failed to open ({error}), retrying in {backoff:g} s")
+            if self._stop.wait(backoff):
+                return
+            backoff = min(backoff * 2, self.max_backoff_s)
+
+    def _drop(self, device):
+        with self._lock:
+            driver, device.driver = device.driver, None
+        device.ready.clear()
+        READY.labels(device=device.name).set(0)
+        print(f"{device.name}: reopening ({device.last_error})")
+        if device.close_fn and driver is not None:
+            try:
+                device.close_fn(driver)
+            except Exception as e:
+                print(f"Error closing {device.name}: {e}")
+        # Devices opened on top of this one (the sensors on a reopened I2C bus) are reopened too
+        for other in self._devices.values():
+            if device.name in other.requires and other.ready.is_set():
+                other.last_error = f"{device.name} reopened"
+                other.reopen.set()
+
+    def get(self, name):
+        """The device's driver, or None while it isn't open."""
+        return self._devices[name].driver
+
+    def wait(self, name, timeout=None):
+        """Blocks until the device is ready (for code that can't do anything without it)."""
+        if self._devices[name].ready.wait(timeout):
+            return self._devices[name].driver
+        return None
+
+    def sampled(self, name):
+        """A read from the device worked. Records the time to its first sample."""
+        device = self._devices[name]
+        device.errors_in_row = 0
+        if device.first_sample_s is None:
+            device.first_sample_s = process_age_s()
+            FIRST_SAMPLE.labels(device=name).set(device.first_sample_s)
+            # Buses (devices others are opened on) aren't sampled themselves
+            buses = {required for d in self._devices.values() for required in d.requires}
+            if all(d.first_sample_s is not None for d in self._devices.values() if d.name not in buses):
+                self._all_sampled.set()
+                print(f"{self.name}: every device sampled, {device.first_sample_s:.3f} s after start")
+
+    def report_error(self, name, error):
+        """A read from the device failed. After max_errors in a row it's closed and reopened."""
+        device = self._devices[name]
+        device.errors_in_row += 1
+        device.last_error = error
+        if device.errors_in_row >= self.max_errors and device.ready.is_set() and not device.reopen.is_set():
+            device.last_error = f"{self.max_errors} reads failed in a row, last: {error}"
+            device.reopen.set()
+
+    def wait_all_sampled(self, timeout=None):
+        return self._all_sampled.wait(timeout)
+
+    def stats(self):
+        return {name: {"ready": d.ready.is_set(), "attempts": d.attempts, "opened_at_s": d.opened_at_s and round(d.opened_at_s, 3),
+                       "first_sample_s": d.first_sample_s and round(d.first_sample_s, 3), "last_error": str(d.last_error) if d.last_error else None}
+                for name, d in self._devices.items()}
+
+    def close(self):
+        """Stops the retries and closes the open devices that have a close_fn."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+        for device in reversed(list(self._devices.values())): # devices before the buses they're on
+            driver, device.driver = device.driver, None
+            if device.close_fn and driver is not None:
+                try:
+                    device.close_fn(driver)
+                except Exception as e:
+                    print(f"Error closing {device.name}: {e}")
+
+
+if __name__ == "__main__":
+    # A bus, two sensors on it, one slow device that times out once and one failing twice
+    failures = {"flaky": 2}
+
+    def flaky():
+        if failures["flaky"]:
+            failures["flaky"] -= 1
+            raise OSError("no ACK")
+        return "flaky"
+
+    registry = DriverRegistry("bench", timeout_s=0.5, backoff_s=0.2)
+    registry.add("bus", lambda: (time.sleep(0.05), "bus")[1])
+    registry.add("fast", lambda bus: (time.sleep(0.02), "fast")[1], requires=["bus"])
+    registry.add("slow", lambda: (time.sleep(0.8), "slow")[1])
+    registry.add("flaky", flaky)
+    started = time.monotonic()
+    registry.start()
+    while not registry.wait_all_sampled(0.01):
+        for name in ("fast", "slow", "flaky"):
+            if registry.get(name):
+                registry.sampled(name)
+    print(f"first sample (fast) after {registry.stats()['fast']['first_sample_s']:.3f} s of process age, "
+          f"everything after {time.monotonic() - started:.3f} s of registry time")
+    for name, stats in registry.stats().items():
+        print(f"  {name}: {stats}")
+    registry.close()
@@ -0,0 +1,288 @@
+# Prometheus metrics for the edge scripts' own performance (no extra dependencies)
+# Helper modules record into the process wide REGISTRY (sensor read latency, serial command
+# latency, MQTT publish latency, outbox depth, loop overruns, pulse handler time) and each script
+# calls start_export() to expose it:
+#   - as a textfile for node_exporter's textfile collector (see the node_exporter service in the
+#     README, --collector.textfile.directory), rewritten atomically every interval_s, and/or
+#   - on its own HTTP port at /metrics for a local Prometheus to scrape.
+# Every series gets a script="..." label so the scripts' files don't clash in the collector.
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 100 us .. 10 s - covers an I2C register read up to a stuck MQTT publish
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, **labels):
+        """The child for one label combination (cache it in hot paths)."""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._children[key] = self._new_child()
+        return child
+
+    def _samples(self, const_labels):
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            labels = const_labels + tuple(zip(self.labelnames, key))
+            yield from child.samples(self.name, labels)
+
+    def render(self, const_labels=()):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self._samples(const_labels):
+            lines.append(f"{name}{_labels_text(labels)} {_number(value)}")
+        return "\n".join(lines)
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount # single writer per child in practice; a lost update only under-counts
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1, **labels):
+        self.labels(**labels).inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function() at export time instead - free on the hot path."""
+        self.function = function
+
+    def samples(self, name, labels):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                return
+        yield name, labels, value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value, **labels):
+        self.labels(**labels).set(value)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (("le", _number(float(bound))),), cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, cumulative
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+
+class Registry:
+    """Named metrics plus the constant labels (script=...) added on export."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self.const_labels = ()
+
+    def _get(self, cls, name, documentation, labelnames, **kwargs):
+        # Get-or-create, so every PsuWorker/outbox/... instance can ask for the same metric
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"metric {name} already registered with a different type or labels")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render(self.const_labels) for metric in metrics) + "\n"
+
+    def write_textfile(self, path):
+        """Atomic replace, so the collector never reads half a file (it ignores the .tmp name)."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # one line per scrape is just noise in the journal
+
+
+class MetricsExporter:
+    """Writes the registry to a textfile every interval_s and/or serves it on /metrics."""
+
+    def __init__(self, registry=REGISTRY, textfile=None, port=None, interval_s=15.0, addr=""):
+        self.registry = registry
+        self.textfile = textfile
+        self.port = port
+        self.interval_s = interval_s
+        self.addr = addr
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def _textfile_loop(self):
+        while True:
+            stopping = self._stop.wait(self.interval_s)
+            try:
+                self.registry.write_textfile(self.textfile)
+            except OSError as e:
+                print(f"Error writing metrics to {self.textfile}: {e}")
+            if stopping:
+                break # that was the final write
+
+    def start(self):
+        if self.port:
+            handler = type("Handler", (_MetricsHandler,), {"registry": self.registry})
+            self._server = ThreadingHTTPServer((self.addr, self.port), handler)
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        if self.textfile:
+            self._thread = threading.Thread(target=self._textfile_loop, name="metrics-textfile", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join() # writes the final values on the way out
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def start_export(script, textfile=None, port=None, interval_s=15.0):
+    """Labels everything in REGISTRY with script=... and starts exporting it. Returns the exporter."""
+    REGISTRY.const_labels = (("script", script),)
+    if textfile and not os.path.isdir(os.path.dirname(os.path.abspath(textfile))):
+        print(f"Metrics textfile directory for {textfile} doesn't exist (is node_exporter's textfile collector set up?), not writing it")
+        textfile = None
+    exporter = MetricsExporter(REGISTRY, textfile=textfile, port=port, interval_s=interval_s)
+    exporter.start()
+    return exporter
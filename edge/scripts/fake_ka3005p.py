@@ -0,0 +1,82 @@
+# Stand-in for ka3005p.PowerSupply that needs no hardware
+# Models the serial round trip of every command (the real KA3005P needs ~50 ms per command over
+# its USB virtual COM port), so the PSU code paths can be benchmarked and tested on any machine.
+import threading
+import time
+
+
+class FakePowerSupply:
+    """Same properties/methods the controller uses on ka3005p.PowerSupply."""
+
+    def __init__(self, port="fake", latency_s=0.05, max_voltage=30.0, max_current=5.0, load_ohm=6.0, load=None, sleep=time.sleep):
+        self.port = port
+        self.latency_s = latency_s
+        self.max_voltage = max_voltage
+        self.max_current = max_current
+        self.load_ohm = load_ohm # simple resistive load, so readbacks look plausible
+        self.load = load # or anything with operating_point(voltage_limit, current_limit) -> (V, A), e.g. profile_sim.ElectrolyserModel
+        self.sleep = sleep # profile_sim.py passes its virtual clock's
+        self._voltage_set = 0.0
+        self._current_set = 0.0
+        self._enabled = False
+        self._busy = threading.Lock() # a real serial port garbles interleaved commands - flag it
+        self.commands = 0
+        self.writes = 0
+        self.reads = 0
+        self.collisions = 0
+
+    def _command(self):
+        if not self._busy.acquire(blocking=False):
+            self.collisions += 1
+            self._busy.acquire()
+        try:
+            self.commands += 1
+            if self.latency_s:
+                self.sleep(self.latency_s)
+        finally:
+            self._busy.release()
+
+    def _output(self):
+        # Constant voltage until the load would draw more than the current limit, then constant current
+        if not self._enabled:
+            return 0.0, 0.0
+        if self.load is not None:
+            return self.load.operating_point(self._voltage_set, self._current_set)
+        current = min(self._voltage_set / self.load_ohm, self._current_set)
+        voltage = current * self.load_ohm
+        return voltage, current
+
+    @property
+    def voltage(self):
+        self._command()
+        self.reads += 1
+        return round(self._output()[0], 2)
+
+    @voltage.setter
+    def voltage(self, value):
+        self._command()
+        self.writes += 1
+        self._voltage_set = max(0.0, min(float(value), self.max_voltage))
+
+    @property
+    def current(self):
+        self._command()
+        self.reads += 1
+        return round(self._output()[1], 3)
+
+    @current.setter
+    def current(self, value):
+        self._command()
+        self.writes += 1
+        self._current_set = max(0.0, min(float(value), self.max_current))
+
+    def enable(self):
+        self._command()
+        self._enabled = True
+
+    def disable(self):
+        self._command()
+        self._enabled = False
+
+    def close(self):
+        pass
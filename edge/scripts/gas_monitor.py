@@ -5,14 +5,29 @@ import time
 import json
 import os
 import paho.mqtt.client as mqtt
-from gpiozero import Button # Import Button for switch handling
 from signal import pause # For keeping the script alive cleanly
 import threading # For the periodic MQTT publishing/flow rate calculation
+from pulse_journal import PulseJournal # Crash-safe storage for the cumulative volume
+from pulse_ring import PulseRing, FlowEstimator # Pulse timestamps and flow rate estimation
+from pulse_capture import PulseCapture, LgpioEdgeSource # Kernel timestamped reed switch edges
+from telemetry_outbox import TelemetryOutbox # Store-and-forward so readings survive broker/WAN outages
+from tb_batcher import TelemetryBatcher, TeeSink # Groups timestamped samples into one MQTT message
+from telemetry_compression import TelemetryCompressor # Report by exception (deadband/swinging door)
+from prom_remote_write import RemoteWriteSink # Optional copy of the readings into the cloud Prometheus
+from derived_metrics import DerivedFeed # Optional copy of the readings for derived_metrics.py
+from history_store import start_history # Optional local history with an HTTP query API
+from mqtt_uplink import UplinkClient # Shared MQTT connection via the mqtt_uplink.py daemon
+from tb_protobuf import gas_monitor_schema # Optional compact protobuf payloads
+from edge_metrics import REGISTRY, start_export # This script's own performance metrics for Prometheus
 
 # Config
 GPIO_PIN = 17  # GPIO pin connected to the reed switch
     # REF https://www.ritter.de/en/operation-manuals/operation-manual-mgc
 VOLUME_PER_PULSE_ML = 3.26  # CHANGE THIS - Volume of gas per reed switch trigger in mL, check side of the meter used. 
+CAPTURE_BACKEND = "lgpio"  # "lgpio" uses kernel edge timestamps (recommended). "gpiozero" is the old Button based capture
+GPIO_CHIP = 0  # gpiochip the pin is on. 0 on current Pi 5 kernels, 4 on older ones - check with `gpioinfo`
+DEBOUNCE_SECONDS = 0.03  # The switch must have been open this long before a closure counts as a pulse
+MIN_PULSE_INTERVAL_SECONDS = 0.2  # Pulses closer than this are counted but flagged as suspicious (closure time is ~0.1 s)
 
 
 # MQTT Configuration for ThingsBoard Edge
@@ -21,49 +36,97 @@ MQTT_PORT = 1883           # Default MQTT port for ThingsBoard
 THINGSBOARD_ACCESS_TOKEN = "e0000060600000ch0000" # <<< IMPORTANT: REPLACE WITH YOUR DEVICE'S ACCESS TOKEN
 TB_MQTT_TELEMETRY_TOPIC = "v1/devices/me/telemetry" # ThingsBoard default telemetry topic
 MQTT_CLIENT_ID = "raspberry_pi_gas_monitor" # You might  want to CHANGE THIS
+TELEMETRY_FORMAT = "json" # or "protobuf" - the TB device profile then needs Protobuf payloads with `python tb_protobuf.py --proto gas_monitor`
+UPLINK_SOCKET = None # Set to the mqtt_uplink.py socket (e.g. "/tmp/pem_iot_uplink.sock") to use its shared connection instead
 
 # Measurement intervals
-FLOW_RATE_INTERVAL_SECONDS = 30  # Calculate flow rate every __ seconds
-MQTT_PUBLISH_INTERVAL_SECONDS = 30  # Publish data to MQTT every __ seconds
+FLOW_RATE_INTERVAL_SECONDS = 30  # Sliding window (seconds) used for the flow rate. It's measured between pulses, so it isn't quantised to whole pulses per window
+FLOW_RATE_EWMA_SECONDS = 10  # Time constant of the smoothed (EWMA) flow rate
+PULSE_RING_SIZE = 4096  # Number of pulse timestamps kept in memory (32 kB)
+PULSE_STATS_PULSES = 256  # Pulse interval percentiles/jitter are worked out over this many pulses
+TELEMETRY_SAMPLE_INTERVAL_SECONDS = 5  # Record volume/flow rate every __ seconds
+MQTT_PUBLISH_INTERVAL_SECONDS = 30  # Publish data to MQTT every __ seconds (all the samples since the last publish go in one message)
 
 # File to store cumulative volume for persistence
 DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gas_data.json")
+# Pulses are appended to this journal in the background and folded into DATA_FILE now and then
+JOURNAL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gas_data.journal")
+JOURNAL_COMMIT_INTERVAL_SECONDS = 1.0 # Max time a pulse waits in memory before it is written to the SD card
+JOURNAL_MAX_PENDING_PULSES = 50 # ...or commit early once this many pulses are waiting. Together these bound what a power cut can lose
+JOURNAL_COMPACT_RECORDS = 3600 # Fold the journal into DATA_FILE after this many records (~1 hour at 1 commit/s)
+# Telemetry is stored here first and sent when MQTT is up
+OUTBOX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gas_outbox.db")
+OUTBOX_MAX_BYTES = 20 * 1024 * 1024 # Oldest readings are dropped beyond this
+# Report by exception: a key is only sent to ThingsBoard when it can't be reconstructed within the given error
+# from what was already sent (see telemetry_compression.py), and at least every TELEMETRY_HEARTBEAT_SECONDS.
+# Keys not listed are sent with every sample. Set to {} to send everything.
+TELEMETRY_COMPRESSION = {
+    "totalVolume_ml": {"swinging_door": VOLUME_PER_PULSE_ML / 2}, # steps of one pulse, a straight line is fine in between
+    "flowRate*": {"swinging_door_pct": 1},
+    "pulseInterval_*": {"deadband_pct": 5},
+    "pulseJitter_s": {"deadband_pct": 10},
+    "pulseMaxLag_s": {"deadband_pct": 10},
+    "pulseBouncesRejected": {"deadband": 0}, # counters: whenever they change
+    "pulseMissedEdges": {"deadband": 0},
+    "pulseSuspicious": {"deadband": 0},
+}
+TELEMETRY_HEARTBEAT_SECONDS = 300
+# Optional: also write the readings straight into the cloud Prometheus with remote_write, see prom_remote_write.py.
+# They're buffered on disk in REMOTE_WRITE_FILE while it can't be reached.
+REMOTE_WRITE_URL = None # e.g. "http://yourhost.net:9090/api/v1/write"
+REMOTE_WRITE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gas_remote_write.db")
+# Set to derived_metrics.py's socket (e.g. "/tmp/pem_iot_derived.sock") to send it a copy of the readings for the
+# Faraday efficiency / kWh per Nm3 calculation. Nothing waits if the daemon isn't running.
+DERIVED_SOCKET = None
+# Local history of the samples for commissioning, queried over HTTP without ThingsBoard or the WAN, see history_store.py
+HISTORY_PORT = None # e.g. 8766, then curl 'http://raspberrypi:8766/query?series=flowRate_ml_per_min&start=-1h'
+HISTORY_DIR = None # None keeps it in memory only. "/dev/shm/pem_history/gas_monitor" survives restarts, not reboots
+HISTORY_KEYS = ("*",) # Patterns of the keys kept, ~5.7 MB each once full (see the README)
+# Pulse handler time, MQTT publish latency, queue depth... for node_exporter's textfile collector (see the README)
+METRICS_TEXTFILE = "/var/lib/node_exporter/textfile_collector/gas_monitor.prom" # None to disable
+METRICS_PORT = None # e.g. 9102 to also serve /metrics
 
 # Globals
 cumulative_volume_ml = 0.00
-pulse_count_current_interval = 0
-last_flow_rate_calc_time = time.time()
-last_mqtt_publish_time = time.time()
+last_sample_time = time.time()
 current_flow_rate_ml_per_min = 0.0000
+pulse_ring = PulseRing(PULSE_RING_SIZE) # Monotonic timestamp of every pulse
+flow_estimator = FlowEstimator(pulse_ring, VOLUME_PER_PULSE_ML, window_s=FLOW_RATE_INTERVAL_SECONDS, ewma_tau_s=FLOW_RATE_EWMA_SECONDS)
 client = None # Global MQTT client instance
-gas_sensor = None # Global gpiozero Button object instance
+tick_seconds = REGISTRY.histogram("edge_loop_seconds", "Time taken by one pass of a periodic loop", ["loop"]).labels(loop="gas_tick")
+gas_sensor = None # Global PulseCapture (or gpiozero Button) instance
+journal = None # Global PulseJournal instance
+outbox = None # Global TelemetryOutbox instance
+batcher = None # Global TelemetryBatcher instance
+remote_write = None # Global RemoteWriteSink instance, if REMOTE_WRITE_URL is set
+compressor = None # Global TelemetryCompressor instance, if TELEMETRY_COMPRESSION is set
+derived_feed = None # Global DerivedFeed instance, if DERIVED_SOCKET is set
+history = None # Global HistoryStore instance, if HISTORY_PORT or HISTORY_DIR is set
+history_server = None
 
 
 
 def load_data():
-    """Loads cumulative volume from a file."""
-    global cumulative_volume_ml
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'r') as f:
-                data = json.load(f)
-                cumulative_volume_ml = data.get("cumulative_volume_ml", 0.00)
-                print(f"Loaded cumulative volume: {cumulative_volume_ml:.2f} mL")
-        except (IOError, json.JSONDecodeError) as e:
-            print(f"Error loading data from {DATA_FILE}: {e}. Starting with 0 volume.")
-            cumulative_volume_ml = 0.00
-    else:
-        print("Data file not found. Starting with 0 volume.")
-        cumulative_volume_ml = 0.00
+    """Loads cumulative volume from the snapshot file and replays the pulse journal."""
+    global cumulative_volume_ml, journal
+    journal = PulseJournal(
+        DATA_FILE,
+        JOURNAL_FILE,
+        commit_interval_s=JOURNAL_COMMIT_INTERVAL_SECONDS,
+        max_pending=JOURNAL_MAX_PENDING_PULSES,
+        compact_records=JOURNAL_COMPACT_RECORDS,
+    )
+    cumulative_volume_ml = journal.open()
+    print(f"Loaded cumulative volume: {cumulative_volume_ml:.2f} mL")
+    journal.start() # Background group commit
 
 def save_data():
-    """Saves cumulative volume to a file."""
-    data = {"cumulative_volume_ml": cumulative_volume_ml}
-    try:
-        with open(DATA_FILE, 'w') as f:
-            json.dump(data, f)
-    except IOError as e:
-        print(f"Error saving data to {DATA_FILE}: {e}")
+    """Commits any pending pulses and compacts the journal into the data file."""
+    if journal:
+        try:
+            journal.close()
+        except IOError as e:
+            print(f"Error saving data to {DATA_FILE}: {e}")
 
 def on_connect(client_instance, userdata, flags, rc):
     """Callback for when the client connects to the MQTT broker."""
@@ -72,102 +135,141 @@ def on_connect(client_instance, userdata, flags, rc):
     else:
         print(f"Failed to connect to MQTT, return code {rc}\n")
 
-def pulse_detected():
-    """Callback function for reed switch trigger."""
-    global cumulative_volume_ml, pulse_count_current_interval
+def pulse_detected(ts=None):
+    """Callback function for reed switch trigger. ts is the edge time on the monotonic clock, if known."""
+    global cumulative_volume_ml
     
-    cumulative_volume_ml += VOLUME_PER_PULSE_ML
-    pulse_count_current_interval += 1
+    pulse_ring.append(ts if ts is not None else time.monotonic())
+    cumulative_volume_ml = journal.add(VOLUME_PER_PULSE_ML) # No disk I/O here, the journal commits in the background
     print(f"DEBUG: Pulse detected! Cumulative volume: {cumulative_volume_ml:.2f} mL")
-    save_data() # Save after each pulse for better persistence
 
 def calculate_and_publish_data():
     """Calculates gas flow rate and publishes data."""
-    global pulse_count_current_interval, last_flow_rate_calc_time, current_flow_rate_ml_per_min, last_mqtt_publish_time
+    global current_flow_rate_ml_per_min, last_sample_time
     
     current_time = time.time()
+    now = time.monotonic() # Pulse timestamps are on the monotonic clock
     
-    # Calculate flow rate periodically
-    time_diff_flow_rate = current_time - last_flow_rate_calc_time
-    if time_diff_flow_rate >= FLOW_RATE_INTERVAL_SECONDS:
-        print(f"DEBUG: time_diff_flow_rate = {time_diff_flow_rate:.4f} seconds")
-        print(f"DEBUG: pulse_count_current_interval = {pulse_count_current_interval} pulses")
-
-        
-        volume_in_interval = pulse_count_current_interval * VOLUME_PER_PULSE_ML
-        
-        if time_diff_flow_rate > 0:
-            current_flow_rate_ml_per_min = (volume_in_interval / time_diff_flow_rate) * 60 # Convert to mL/minute
-        else:
-            current_flow_rate_ml_per_min = 0.0000 # Avoid division by zero
-            
-        print(f"DEBUG: Calculated flow rate: {current_flow_rate_ml_per_min:.4f} mL/min")
-        
-        pulse_count_current_interval = 0 # Reset pulse count for next interval
-        last_flow_rate_calc_time = current_time
+    # Flow rate from the pulse timestamps. Cheap, so it's refreshed on every tick (every second)
+    current_flow_rate_ml_per_min = flow_estimator.windowed(now)
+    flow_estimator.update(now)
 
-    # Publish to MQTT periodically
-    time_diff_mqtt_publish = current_time - last_mqtt_publish_time
-    if time_diff_mqtt_publish >= MQTT_PUBLISH_INTERVAL_SECONDS:
+    # Record a sample periodically. The batcher sends them to MQTT every MQTT_PUBLISH_INTERVAL_SECONDS
+    time_diff_sample = current_time - last_sample_time
+    if time_diff_sample >= TELEMETRY_SAMPLE_INTERVAL_SECONDS:
         try:
             # Prepare telemetry data as a JSON object for ThingsBoard
             telemetry_data = {
                 "totalVolume_ml": round(cumulative_volume_ml, 2),
-                "flowRate_ml_per_min": round(current_flow_rate_ml_per_min, 4)
+                "flowRate_ml_per_min": round(current_flow_rate_ml_per_min, 4),
+                "flowRateInst_ml_per_min": round(flow_estimator.instantaneous(now), 4),
+                "flowRateEwma_ml_per_min": round(flow_estimator.ewma_ml_per_min, 4),
             }
+            # Pulse interval distribution - useful for spotting bounce or a sticking reed switch
+            stats = pulse_ring.interval_stats(PULSE_STATS_PULSES)
+            if stats:
+                telemetry_data.update({
+                    "pulseInterval_p50_s": round(stats["p50_s"], 4),
+                    "pulseInterval_p90_s": round(stats["p90_s"], 4),
+                    "pulseInterval_p99_s": round(stats["p99_s"], 4),
+                    "pulseJitter_s": round(stats["jitter_s"], 4),
+                })
+            if isinstance(gas_sensor, PulseCapture):
+                capture_stats = gas_sensor.stats()
+                telemetry_data.update({
+                    "pulseBouncesRejected": capture_stats["bounces"],
+                    "pulseMissedEdges": capture_stats["missed_edges"],
+                    "pulseSuspicious": capture_stats["suspicious"],
+                    "pulseMaxLag_s": round(capture_stats["max_lag_s"], 4),
+                })
+            print(f"DEBUG: {len(pulse_ring.since(now - FLOW_RATE_INTERVAL_SECONDS))} pulses in the last {FLOW_RATE_INTERVAL_SECONDS} s, flow rate {current_flow_rate_ml_per_min:.4f} mL/min")
             
-            # Publish the JSON data to the ThingsBoard telemetry topic
-            client.publish(TB_MQTT_TELEMETRY_TOPIC, json.dumps(telemetry_data), qos=1)
-            print(f"DEBUG: Published telemetry to ThingsBoard: {json.dumps(telemetry_data)}")
+            # Queue for the ThingsBoard telemetry topic. The outbox sends it (with this timestamp)
+            # once MQTT is connected - paho reconnects by itself in the background
+            batcher.add(telemetry_data)
+            print(f"DEBUG: Queued telemetry for ThingsBoard: {json.dumps(telemetry_data)}")
         except Exception as e:
-            print(f"Error publishing to MQTT: {e}")
-            # Attempt to reconnect if connection is lost
-            try:
-                client.reconnect()
-            except Exception as re_e:
-                print(f"Error during MQTT reconnect attempt: {re_e}")
+            print(f"Error queueing telemetry: {e}")
 
-        last_mqtt_publish_time = current_time
+        last_sample_time = current_time
 
 def main():
-    global client, gas_sensor
+    global client, gas_sensor, outbox, batcher, remote_write, compressor, derived_feed, history, history_server
     
     # Load previously saved data
     load_data()
 
     # GPIO Setup - also see the README
-    # Button class represents a push button or switch connected to a GPIO pin.
-    # When pull_up=True, gpiozero enables an internal pull-up, so we dont need an external pull up resistor
-    # active_state=False means the button is active (pressed/closed) when the pin is LOW (connected to GND).
-    # bounce_time can be tweaked if not performing correctly
-    # Note close time is supposed to be ±0.1s, so bounce should be less than that. I got good results with 30ms, maybe it could be lower?
+    # The reed switch pulls the pin LOW (to GND) when it closes, with the internal pull-up enabled,
+    # so we dont need an external pull up resistor.
+    # Note close time is supposed to be ±0.1s, so debounce should be less than that. I got good results with 30ms, maybe it could be lower?
     # https://www.ritter.de/en/data-sheets/pulse-generator-v6.0-reed-contact/
-    gas_sensor = Button(GPIO_PIN, pull_up=True, bounce_time=0.03)
-    
-    # Attach the pulse_detected function to the when_pressed event
-    gas_sensor.when_pressed = pulse_detected
+    if CAPTURE_BACKEND == "lgpio":
+        # Edges are timestamped by the kernel and debounced on those timestamps, so a busy Pi
+        # can delay the callback without delaying or merging pulses.
+        gas_sensor = PulseCapture(
+            LgpioEdgeSource(GPIO_PIN, chip=GPIO_CHIP, pull_up=True),
+            pulse_detected,
+            debounce_s=DEBOUNCE_SECONDS,
+            min_pulse_interval_s=MIN_PULSE_INTERVAL_SECONDS,
+        )
+        gas_sensor.start()
+    else:
+        from gpiozero import Button # Import Button for switch handling
+        # active_state=False means the button is active (pressed/closed) when the pin is LOW (connected to GND).
+        gas_sensor = Button(GPIO_PIN, pull_up=True, bounce_time=DEBOUNCE_SECONDS)
+        # Attach the pulse_detected function to the when_pressed event
+        gas_sensor.when_pressed = pulse_detected
 
-    # MQTT client setup
-    client = mqtt.Client(client_id=MQTT_CLIENT_ID)
-    client.on_connect = on_connect
-    
-    # Set ThingsBoard Access Token for authentication
-    client.username_pw_set(THINGSBOARD_ACCESS_TOKEN) 
-    
-    try:
-        client.connect(MQTT_BROKER, MQTT_PORT, 60) # 60 seconds keepalive
-    except Exception as e:
-        print(f"Initial connection to MQTT broker failed: {e}")
-        # Allow the script to continue and attempt reconnects in the loop
+    if UPLINK_SOCKET:
+        # The uplink daemon holds the MQTT connection and the outbox
+        client = UplinkClient(UPLINK_SOCKET, THINGSBOARD_ACCESS_TOKEN)
+        client.loop_start()
+        telemetry_sink = client
+        if TELEMETRY_FORMAT == "protobuf":
+            print("TELEMETRY_FORMAT protobuf is ignored with UPLINK_SOCKET, the uplink daemon sends JSON")
+    else:
+        # MQTT client setup
+        client = mqtt.Client(client_id=MQTT_CLIENT_ID)
+        client.on_connect = on_connect
+        
+        # Set ThingsBoard Access Token for authentication
+        client.username_pw_set(THINGSBOARD_ACCESS_TOKEN) 
         
-    client.loop_start()  # Start the MQTT client loop in a separate thread
+        try:
+            # connect_async so the client loop keeps retrying if the broker isn't up yet
+            client.connect_async(MQTT_BROKER, MQTT_PORT, 60) # 60 seconds keepalive
+        except Exception as e:
+            print(f"Initial connection to MQTT broker failed: {e}")
+            
+        client.loop_start()  # Start the MQTT client loop in a separate thread
+        encoder = gas_monitor_schema() if TELEMETRY_FORMAT == "protobuf" else None
+        outbox = TelemetryOutbox(OUTBOX_FILE, client, topic=TB_MQTT_TELEMETRY_TOPIC, max_bytes=OUTBOX_MAX_BYTES, encoder=encoder)
+        outbox.start()
+        telemetry_sink = outbox
+    if TELEMETRY_COMPRESSION: # only what goes to ThingsBoard, remote_write gets every reading
+        compressor = TelemetryCompressor(telemetry_sink, TELEMETRY_COMPRESSION, heartbeat_s=TELEMETRY_HEARTBEAT_SECONDS, name="gas_monitor")
+        telemetry_sink = compressor
+    if REMOTE_WRITE_URL:
+        remote_write = RemoteWriteSink(REMOTE_WRITE_URL, REMOTE_WRITE_FILE, labels={"job": "pem_edge", "script": "gas_monitor"})
+        remote_write.start()
+        telemetry_sink = TeeSink(telemetry_sink, remote_write)
+    if DERIVED_SOCKET:
+        derived_feed = DerivedFeed(DERIVED_SOCKET, "gas_monitor")
+        telemetry_sink = TeeSink(telemetry_sink, derived_feed)
+    if HISTORY_PORT or HISTORY_DIR:
+        history, history_server = start_history(HISTORY_DIR, HISTORY_PORT, keys=HISTORY_KEYS)
+    batcher = TelemetryBatcher(telemetry_sink, max_age_s=MQTT_PUBLISH_INTERVAL_SECONDS, name="gas_monitor", tap=history)
+    batcher.start()
+    metrics = start_export("gas_monitor", textfile=METRICS_TEXTFILE, port=METRICS_PORT)
 
     print(f"Monitoring reed switch on GPIO {GPIO_PIN}. Press Ctrl+C to exit.")
     
     try:
         # Schedule the periodic data calculation and publishing
         def periodic_task_scheduler():
-            calculate_and_publish_data()
+            with tick_seconds.time():
+                calculate_and_publish_data()
             # Reschedule the timer to run again in 1 second
             # This creates a recurring task without waiting in a loop
             threading.Timer(1.0, periodic_task_scheduler).start()
@@ -184,9 +286,25 @@ def main():
         print(f"An unexpected error occurred: {e}")
     finally:
         save_data() # Save data one last time on exit
+        metrics.close()
         if gas_sensor:
-            gas_sensor.close() # Clean up gpiozero pins
+            gas_sensor.close() # Clean up GPIO pins
             print("GPIO pins cleaned up.")
+        if batcher:
+            batcher.close()
+        if compressor:
+            compressor.close() # sends the points it's still holding
+            print(f"Telemetry compression: {compressor.stats()}")
+        if outbox:
+            outbox.close()
+        if remote_write:
+            remote_write.close()
+        if derived_feed:
+            derived_feed.close()
+        if history_server:
+            history_server.close()
+        if history:
+            history.close()
         if client: # Ensure client exists before attempting to stop and disconnect
             client.loop_stop()
             client.disconnect()
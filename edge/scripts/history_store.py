@@ -0,0 +1,554 @@
+# Local history of the readings with a query API (optional, used by all the edge scripts)
+# Looking at the last hour of stack current during commissioning otherwise means ThingsBoard
+# dashboards (TB Edge's Postgres) or the cloud over the tunnel. HistoryStore keeps every reading
+# in the script's own process, in fixed size rings per series and tier:
+#   raw     every sample (the 50 Hz INA260 samples, not the 5 s window summaries), ~10 min
+#   1 s     count/sum/min/max per second, 24 h
+#   1 min   count/sum/min/max per minute, 30 d
+# (DEFAULT_TIERS), about 5.7 MB per series once full - every numeric key unless keys/exclude say
+# otherwise. A reading updates every tier, so nothing is recomputed later and
+# memory doesn't grow: the rings are mmap'ed columns of doubles (files in HISTORY_DIR, or
+# anonymous memory if None), only the pages being written and read are resident. With a
+# HISTORY_DIR the history survives restarts - /dev/shm keeps it off the SD card (lost on reboot).
+# HistoryServer answers on HISTORY_PORT (no dependencies, JSON):
+#   /series                                        every series with its last value
+#   /query?series=current_mA&start=-1h&step=10s     mean/min/max/count per step, from the finest tier
+#                                                  that still covers start (end defaults to now)
+#   /aggregate?series=current_mA,voltage_V&start=-10m   count/mean/min/max over the range
+# start/end are epoch ms or relative to now (-30s, -10m, -1h, -7d); step defaults to whatever
+# keeps the answer under max_points. e.g.  curl 'http://raspberrypi:8765/query?series=current_mA&start=-1h'
+# Benchmark (ingest cost, query times over a filled store):  python history_store.py --bench
+import bisect
+import fnmatch
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from edge_metrics import REGISTRY
+from telemetry_outbox import now_ms
+
+QUERY_SECONDS = REGISTRY.histogram("edge_history_query_seconds", "Time taken to answer a local history query", ["endpoint"])
+
+# (resolution s, retention s), resolution 0 = raw samples
+DEFAULT_TIERS = ((0, 600), (1, 24 * 3600), (60, 30 * 24 * 3600))
+
+_MAGIC = b"PEMHIST2"
+_HEADER = struct.Struct("<8sqqqq") # magic, capacity, width, then two counters the tier keeps (see below)
+_HEADER_BYTES = 64
+_DURATION = re.compile(r"^(\d+(?:\.\d+)?)(ms|s|m|h|d)$")
+_UNITS_MS = {"ms": 1, "s": 1000, "m": 60000, "h": 3600000, "d": 86400000}
+_COUNTERS = struct.Struct("<qq")
+_SAVE_EVERY = 64 # raw samples between saves of the write counter (a restart may lose the ones since)
+
+
+def parse_duration_ms(text):
+    """'10s', '5m', '1h', '500ms', '7d' (or plain seconds) -> ms."""
+    match = _DURATION.match(text.strip())
+    if match:
+        return float(match.group(1)) * _UNITS_MS[match.group(2)]
+    return float(text) * 1000.0
+
+
+def parse_time_ms(text, now):
+    """'now', epoch ms, or relative to now ('-10m')."""
+    text = text.strip()
+    if text in ("", "now"):
+        return now
+    if text.startswith("-"):
+        return now - parse_duration_ms(text[1:])
+    return float(text)
+
+
+def _tier_label(resolution_ms):
+    return "raw" if not resolution_ms else f"{resolution_ms / 1000.0:g}s"
+
+
+class _Ring:
+    """width columns of capacity doubles in an mmap (column major, so a range is a slice), plus two
+    persisted counters."""
+
+    def __init__(self, path, capacity, width):
+        self.path = path
+        self.capacity = capacity
+        size = _HEADER_BYTES + capacity * width * 8
+        if path is None:
+            self._mmap = mmap.mmap(-1, size) # zero filled, pages allocated as they're touched
+        else:
+            fresh = not os.path.exists(path) or os.path.getsize(path) != size
+            with open(path, "a+b") as f:
+                if fresh:
+                    f.truncate(0)
+                    f.truncate(size) # sparse
+                self._mmap = mmap.mmap(f.fileno(), size)
+            magic, stored_capacity, stored_width, _, _ = _HEADER.unpack_from(self._mmap, 0)
+            if not fresh and (magic, stored_capacity, stored_width) != (_MAGIC, capacity, width):
+                print(f"History file {path} has a different layout (tiers changed?), starting it again")
+                self._mmap[:size] = bytes(size)
+        self.a, self.b = _COUNTERS.unpack_from(self._mmap, 24)
+        _HEADER.pack_into(self._mmap, 0, _MAGIC, capacity, width, self.a, self.b)
+        self._slots = memoryview(self._mmap)[_HEADER_BYTES:].cast("d")
+        self.columns = [self._slots[c * capacity:(c + 1) * capacity] for c in range(width)]
+
+    def save_counters(self):
+        _COUNTERS.pack_into(self._mmap, 24, self.a, self.b)
+
+    def read(self, column, first, last):
+        """Logical positions first..last (inclusive, at most capacity apart) of a column as a list."""
+        col, capacity = self.columns[column], self.capacity
+        p0, p1 = first % capacity, last % capacity
+        if p0 <= p1:
+            return col[p0:p1 + 1].tolist()
+        return col[p0:].tolist() + col[:p1 + 1].tolist()
+
+    def close(self):
+        self.save_counters()
+        for col in self.columns:
+            col.release()
+        self._slots.release()
+        self._mmap.close()
+
+
+class _RawTier:
+    """Every sample, columns ts and value, oldest overwritten first. Samples are expected in time order.
+    Counter a is the number of samples ever written."""
+
+    resolution_ms = 0
+
+    def __init__(self, path, capacity, retention_s):
+        self.ring = _Ring(path, capacity, 2)
+        self.retention_ms = retention_s * 1000.0
+        self._ts, self._values = self.ring.columns
+
+    def add(self, ts, value):
+        ring = self.ring
+        i = ring.a % ring.capacity
+        self._ts[i] = ts
+        self._values[i] = value
+        ring.a += 1
+        if not ring.a % _SAVE_EVERY:
+            ring.save_counters()
+
+    def last(self):
+        ring = self.ring
+        if not ring.a:
+            return None
+        i = (ring.a - 1) % ring.capacity
+        return self._ts[i], self._values[i]
+
+    def covers(self, start, now):
+        # Everything since the series started is still here, or the ring reaches back to start
+        ring = self.ring
+        return ring.a > 0 and (ring.a <= ring.capacity or self._ts[ring.a % ring.capacity] <= start)
+
+    def _first_at_or_after(self, ts):
+        ring, col = self.ring, self._ts
+        lo, hi = max(0, ring.a - ring.capacity), ring.a
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if col[mid % ring.capacity] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def span(self, start, end):
+        """Logical positions (first, last) of start..end. Under the store lock."""
+        return self._first_at_or_after(start), self._first_at_or_after(end + 1e-6) - 1
+
+    def read(self, first, last):
+        """(ts, counts, sums, mins, maxs) lists for a span; counts None (one sample each). No lock
+        needed: samples overwritten while copying are dropped afterwards."""
+        if last < first:
+            return [], None, [], [], []
+        ts, values = self.ring.read(0, first, last), self.ring.read(1, first, last)
+        stale = self.ring.a - self.ring.capacity - first
+        if stale > 0:
+            del ts[:stale], values[:stale]
+        return ts, None, values, values, values
+
+
+class _BucketTier:
+    """count/sum/min/max per resolution_s bucket in columns ts/count/sum/min/max. A bucket's slot is
+    fixed (bucket % capacity), and every slot between the first and last bucket written is either
+    that bucket's or marked empty, so a range is just slices. Counters: first and last bucket + 1."""
+
+    def __init__(self, path, resolution_s, retention_s):
+        self.resolution_ms = resolution_s * 1000.0
+        self.retention_ms = retention_s * 1000.0
+        self.ring = _Ring(path, int(math.ceil(retention_s / resolution_s)), 5)
+        self._ts, self._count, self._sum, self._min, self._max = self.ring.columns
+
+    def _empty(self, bucket):
+        i = bucket % self.ring.capacity
+        self._ts[i] = bucket * self.resolution_ms
+        self._count[i] = self._sum[i] = 0.0
+        self._min[i] = math.inf
+        self._max[i] = -math.inf
+
+    def add(self, ts, value):
+        ring = self.ring
+        bucket = int(ts // self.resolution_ms)
+        first, last = ring.a - 1, ring.b - 1
+        if not ring.b:
+            self._empty(bucket)
+            ring.a = ring.b = bucket + 1
+            ring.save_counters()
+        elif bucket > last:
+            for gap in range(max(last + 1, bucket - ring.capacity + 1), bucket + 1):
+                self._empty(gap) # also clears out what the slots held a whole retention ago
+            ring.b = bucket + 1
+            if bucket - ring.capacity + 1 > first:
+                ring.a = bucket - ring.capacity + 2
+            ring.save_counters()
+        elif bucket < first:
+            if bucket <= last - ring.capacity:
+                return # older than the retention
+            for gap in range(bucket, first):
+                self._empty(gap)
+            ring.a = bucket + 1
+            ring.save_counters()
+        i = bucket % ring.capacity
+        self._count[i] += 1
+        self._sum[i] += value
+        if value < self._min[i]:
+            self._min[i] = value
+        if value > self._max[i]:
+            self._max[i] = value
+
+    def covers(self, start, now):
+        return start >= now - self.retention_ms
+
+    def span(self, start, end):
+        """Buckets (first, last) from start to end. Under the store lock."""
+        ring = self.ring
+        if not ring.b:
+            return 0, -1
+        first = max(int(start // self.resolution_ms), ring.a - 1, ring.b - ring.capacity)
+        last = min(int(end // self.resolution_ms), ring.b - 1)
+        return first, last
+
+    def read(self, first, last):
+        """(ts, counts, sums, mins, maxs) lists for a span of buckets, empty ones included. No lock
+        needed: buckets recycled for newer ones while copying are dropped afterwards (the bucket
+        being filled may be one sample behind in some columns)."""
+        if last < first:
+            return [], [], [], [], []
+        columns = tuple(self.ring.read(c, first, last) for c in range(5))
+        stale = self.ring.b - self.ring.capacity - first
+        if stale > 0:
+            for column in columns:
+                del column[:stale]
+        return columns
+
+
+class _Series:
+    def __init__(self, name, tiers):
+        self.name = name
+        self.tiers = tiers # finest first
+        self.last = None # (ts, value)
+
+
+class HistoryStore:
+    """Tiered, fixed memory history of numeric readings. put()/put_many() in, query()/aggregate() out."""
+
+    def __init__(self, directory=None, tiers=DEFAULT_TIERS, raw_rate_hz=50.0, keys=("*",), exclude=(), max_points=2000):
+        self.directory = directory
+        self.tiers = tuple(sorted(tiers))
+        if not self.tiers or self.tiers[0][0] != 0 or any(resolution <= 0 for resolution, _ in self.tiers[1:]):
+            raise ValueError("tiers must be (0, raw retention s) followed by (resolution s, retention s) with resolution > 0")
+        self.raw_rate_hz = raw_rate_hz # sizes the raw ring: retention x rate samples per series
+        self.keys = tuple(keys) # patterns of the keys to keep
+        self.exclude = tuple(exclude)
+        self.max_points = max_points
+        self._lock = threading.Lock()
+        self._series = {}
+        self._wanted = {}
+        self.samples = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            for filename in sorted(os.listdir(directory)):
+                if filename.endswith(".raw.ring"): # reopen what was there before a restart
+                    self._open(filename[:-len(".raw.ring")])
+
+    def _filename(self, name, resolution_s):
+        return os.path.join(self.directory, f"{name}.{_tier_label(resolution_s * 1000.0)}.ring") if self.directory else None
+
+    def _open(self, name):
+        tiers = []
+        for resolution_s, retention_s in self.tiers:
+            if resolution_s:
+                tiers.append(_BucketTier(self._filename(name, resolution_s), resolution_s, retention_s))
+            else:
+                tiers.append(_RawTier(self._filename(name, 0), max(1, int(retention_s * self.raw_rate_hz)), retention_s))
+        series = self._series[name] = _Series(name, tiers)
+        series.last = tiers[0].last()
+        return series
+
+    def _is_wanted(self, name):
+        wanted = self._wanted.get(name)
+        if wanted is None:
+            wanted = self._wanted[name] = (
+                re.fullmatch(r"[A-Za-z0-9_.:-]+", name) is not None # it becomes a file name
+                and any(fnmatch.fnmatchcase(name, p) for p in self.keys)
+                and not any(fnmatch.fnmatchcase(name, p) for p in self.exclude)
+            )
+        return wanted
+
+    def put(self, ts, values, device=None):
+        """One sample: ts in ms, {key: number}. Text and non finite values are skipped."""
+        with self._lock:
+            for key, value in values.items():
+                if not isinstance(value, (int, float)):
+                    continue
+                value = float(value)
+                if not math.isfinite(value):
+                    continue
+                name = key if device is None else f"{device}:{key}"
+                if not self._is_wanted(name):
+                    continue
+                series = self._series.get(name) or self._open(name)
+                for tier in series.tiers:
+                    tier.add(ts, value)
+                series.last = (ts, value)
+                self.samples += 1
+
+    def put_many(self, records):
+        """TelemetryBatcher sink interface, [(ts, values), ...] or (ts, values, device)."""
+        for record in records:
+            self.put(record[0], record[1], record[2] if len(record) > 2 else None)
+
+    def series(self):
+        with self._lock:
+            return {name: {"last_ts": s.last[0], "last": s.last[1]} if s.last else {} for name, s in sorted(self._series.items())}
+
+    def _pick_tier(self, series, start, end, step_ms, now):
+        """The coarsest tier no coarser than step that still covers start, else the longest kept."""
+        if step_ms is None:
+            step_ms = max(0.0, (end - start) / self.max_points)
+        covering = [tier for tier in series.tiers if tier.covers(start, now)]
+        if not covering:
+            return series.tiers[-1]
+        fine_enough = [tier for tier in covering if tier.resolution_ms <= step_ms]
+        return fine_enough[-1] if fine_enough else covering[0]
+
+    def _read(self, name, start, end, step_ms, now):
+        # Only finding the range holds the lock. Copying it (up to 86400 rows for a day of 1 s
+        # buckets) doesn't, so a query can't hold up put() on the 50 Hz sampler thread.
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                raise KeyError(name)
+            tier = self._pick_tier(series, start, end, step_ms, now)
+            first, last = tier.span(start, end)
+        return tier, tier.read(first, last)
+
+    def query(self, name, start, end=None, step_ms=None):
+        """[(ts, mean, min, max, count)] per step_ms (default: what fits max_points) from start to end (ms)."""
+        now = now_ms()
+        end = now if end is None else end
+        tier, (ts, counts, sums, mins, maxs) = self._read(name, start, end, step_ms, now)
+        if step_ms is None:
+            step_ms = max(tier.resolution_ms, (end - start) / self.max_points)
+        if counts is None:
+            counts = [1] * len(ts)
+        if step_ms <= tier.resolution_ms:
+            points = [(int(t), s / c, low, high, int(c)) for t, c, s, low, high in zip(ts, counts, sums, mins, maxs) if c]
+            return _tier_label(tier.resolution_ms), step_ms, points
+        points = []
+        i = 0
+        bucket_start = start
+        while i < len(ts):
+            bucket_start = max(bucket_start, ts[i] - (ts[i] - start) % step_ms) # skip empty steps
+            j = bisect.bisect_left(ts, bucket_start + step_ms, i)
+            count = sum(counts[i:j])
+            if count:
+                points.append((int(bucket_start), sum(sums[i:j]) / count, min(mins[i:j]), max(maxs[i:j]), int(count)))
+            i = j
+        return _tier_label(tier.resolution_ms), step_ms, points
+
+    def aggregate(self, name, start, end=None):
+        """count/mean/min/max from start to end (ms), from the finest tier covering the range."""
+        now = now_ms()
+        end = now if end is None else end
+        tier, (ts, counts, sums, mins, maxs) = self._read(name, start, end, None, now)
+        count = len(ts) if counts is None else sum(counts)
+        return {
+            "tier": _tier_label(tier.resolution_ms),
+            "count": int(count),
+            "mean": sum(sums) / count if count else None,
+            "min": min(mins) if count else None,
+            "max": max(maxs) if count else None,
+        }
+
+    def close(self):
+        with self._lock:
+            for series in self._series.values():
+                for tier in series.tiers:
+                    tier.ring.close()
+            self._series = {}
+
+
+class _HistoryHandler(BaseHTTPRequestHandler):
+    store = None
+
+    def _reply(self, status, body):
+        data = json.dumps(body, separators=(",", ":")).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Access-Control-Allow-Origin", "*") # for a page on the laptop plotting it
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        endpoint = url.path.strip("/") or "series"
+        if endpoint not in ("series", "query", "aggregate"):
+            self._reply(404, {"error": "use /series, /query or /aggregate"})
+            return
+        started = time.perf_counter()
+        try:
+            if endpoint == "series":
+                result = {"series": self.store.series()}
+            else:
+                now = now_ms()
+                names = [name for name in params.get("series", "").split(",") if name]
+                if not names:
+                    raise ValueError("series=... is required")
+                start = parse_time_ms(params.get("start", "-10m"), now)
+                end = parse_time_ms(params.get("end", "now"), now)
+                result = {}
+                for name in names:
+                    if endpoint == "query":
+                        step = parse_duration_ms(params["step"]) if "step" in params else None
+                        tier, step_ms, points = self.store.query(name, start, end, step)
+                        result[name] = {"tier": tier, "step_ms": step_ms, "columns": ["ts", "mean", "min", "max", "count"], "points": points}
+                    else:
+                        result[name] = self.store.aggregate(name, start, end)
+        except KeyError as e:
+            self._reply(404, {"error": f"no series {e}"})
+            return
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+            return
+        elapsed = time.perf_counter() - started
+        QUERY_SECONDS.labels(endpoint=endpoint).observe(elapsed)
+        result["query_ms"] = round(elapsed * 1000, 3)
+        self._reply(200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HistoryServer:
+    """Serves a HistoryStore over HTTP on port (see the top of this file)."""
+
+    def __init__(self, store, port, addr=""):
+        handler = type("Handler", (_HistoryHandler,), {"store": store})
+        self._server = ThreadingHTTPServer((addr, port), handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="history-http", daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def start_history(directory=None, port=None, tiers=DEFAULT_TIERS, raw_rate_hz=50.0, keys=("*",), exclude=()):
+    """A HistoryStore, served on port if given. Returns (store, server or None)."""
+    store = HistoryStore(directory, tiers=tiers, raw_rate_hz=raw_rate_hz, keys=keys, exclude=exclude)
+    server = None
+    if port is not None: # 0 picks a free port
+        server = HistoryServer(store, port)
+        server.start()
+        print(f"Local history on http://localhost:{server.port}/series")
+    return store, server
+
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    import resource
+    import tempfile
+    import urllib.request
+
+    parser = argparse.ArgumentParser(description="Ingest cost and query times of the local history store")
+    parser.add_argument("--bench", action="store_true", help="fill a store with 30 days of history and time queries")
+    parser.add_argument("--dir", help="history directory (default: a temporary one)")
+    parser.add_argument("--days", type=float, default=30.0)
+    args = parser.parse_args()
+    if not args.bench:
+        parser.print_help()
+        raise SystemExit
+
+    directory = args.dir or tempfile.mkdtemp(prefix="pem_history_")
+    store, server = start_history(directory, port=0)
+    rng = random.Random(1)
+    end = now_ms()
+
+    # Slow keys: one sample every 5 s for the whole period, as sensors.py's window summaries would be
+    started = time.perf_counter()
+    count = int(args.days * 86400 / 5)
+    for i in range(count):
+        ts = end - (count - i) * 5000
+        store.put(ts, {"pressure_hPa": 1013 + 5 * math.sin(i / 5000), "water_temp_C": 20 + rng.gauss(0, 0.1)})
+    slow_s = time.perf_counter() - started
+    # The INA260 at 50 Hz for the raw tier's 10 minutes
+    started = time.perf_counter()
+    raw = int(600 * 50)
+    for i in range(raw):
+        ts = end - (raw - i) * 20
+        store.put(ts, {"current_mA": 2000 + 50 * math.sin(i / 8) + rng.gauss(0, 2), "voltage_V": 3.6 + rng.gauss(0, 0.001)})
+    raw_s = time.perf_counter() - started
+    print(f"ingest: {store.samples} values, {(slow_s + raw_s) / store.samples * 1e6:.1f} us per value")
+
+    def timed(path):
+        url = f"http://localhost:{server.port}{path}"
+        started = time.perf_counter()
+        with urllib.request.urlopen(url) as response:
+            body = json.loads(response.read())
+        return (time.perf_counter() - started) * 1000, body
+
+    # The 50 Hz sampler keeps calling put() while the queries run, as in sensors.py
+    put_ms, querying = [], threading.Event()
+
+    def sampler():
+        while not querying.wait(0.02):
+            started = time.perf_counter()
+            store.put(now_ms(), {"current_mA": 2000 + rng.gauss(0, 2)})
+            put_ms.append((time.perf_counter() - started) * 1000)
+
+    sampler_thread = threading.Thread(target=sampler, daemon=True)
+    sampler_thread.start()
+    for path in ("/series",
+                 "/query?series=current_mA&start=-1m", "/query?series=current_mA&start=-10m",
+                 "/query?series=current_mA,voltage_V&start=-10m&step=1s", "/aggregate?series=current_mA,voltage_V&start=-10m",
+                 "/query?series=pressure_hPa&start=-1h", "/query?series=pressure_hPa&start=-24h",
+                 "/query?series=pressure_hPa&start=-30d", "/aggregate?series=pressure_hPa,water_temp_C&start=-30d"):
+        wall_ms, body = timed(path)
+        detail = {name: (value["tier"], len(value["points"])) if "points" in value else value.get("tier")
+                  for name, value in body.items() if isinstance(value, dict) and name != "series"}
+        print(f"  {path:62} {wall_ms:6.1f} ms over HTTP ({body['query_ms']} ms in the store) {detail}")
+
+    querying.set()
+    sampler_thread.join()
+    put_ms.sort()
+    print(f"put() during the queries: {len(put_ms)} calls, p50 {put_ms[len(put_ms) // 2]:.3f} ms, max {put_ms[-1]:.3f} ms")
+
+    disk = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+    used = sum(os.stat(os.path.join(directory, f)).st_blocks * 512 for f in os.listdir(directory))
+    print(f"files: {disk / 1e6:.0f} MB allocated size ({disk / 1e6 / len(store.series()):.1f} MB per series once full), "
+          f"{used / 1e6:.0f} MB written, max rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    server.close()
+    store.close()
@@ -0,0 +1,408 @@
+# Local MQTT uplink daemon shared by the edge scripts
+# Instead of every script opening its own paho connection to TB Edge, this daemon keeps one
+# persistent MQTT connection per device access token and the scripts hand it telemetry, attribute
+# updates and subscriptions over a Unix domain socket. Reconnects, QoS and the store-and-forward
+# outbox (telemetry_outbox.py) all live here, in one place.
+#
+# Run it (e.g. as a systemd service) before the scripts:
+#   python mqtt_uplink.py
+# and set UPLINK_SOCKET in sensors.py / gas_monitor.py / KA3005P_controller.py to the same path.
+#
+# Wire protocol: newline delimited JSON in both directions.
+#   script -> daemon  {"op": "hello", "token": ...}            (first frame on a connection)
+#                     {"op": "telemetry", "records": [[ts_ms, {values}], ...]}   (or [ts_ms, {values}, device]
+#                                                                           for a gateway token's devices)
+#                     {"op": "publish", "topic": ..., "payload": "...", "qos": 1}
+#                     {"op": "subscribe", "topic": ...}
+#   daemon -> script  {"event": "connected"} / {"event": "disconnected"}
+#                     {"event": "message", "topic": ..., "payload": "..."}
+import hashlib
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+from telemetry_outbox import TelemetryOutbox
+
+# Config
+MQTT_HOST = "localhost" # ThingsBoard Edge on the same Pi
+MQTT_PORT = 1883
+UPLINK_SOCKET = "/tmp/pem_iot_uplink.sock" # CHANGE THIS if you like, must match the scripts
+OUTBOX_DIR = os.path.dirname(os.path.abspath(__file__)) # one outbox database per device token lives here
+OUTBOX_MAX_BYTES = 50 * 1024 * 1024 # per device
+MAX_QUEUED_MESSAGES = 1000 # cap on paho's in-memory queue for non-telemetry publishes while offline
+MAX_CLIENT_BACKLOG = 1000 # frames waiting for a script that isn't reading; beyond this it's disconnected
+CLIENT_FLUSH_SECONDS = 2.0 # UplinkClient.loop_stop() waits this long for queued frames to reach the daemon
+
+
+class DeviceUplink:
+    """One persistent MQTT session + telemetry outbox for a device token."""
+
+    def __init__(self, token, host, port):
+        import paho.mqtt.client as mqtt # only the daemon needs paho, not the scripts using UplinkClient
+
+        self.token = token
+        self.label = hashlib.sha1(token.encode()).hexdigest()[:12] # don't put the token itself in file names/logs
+        self._sessions_lock = threading.Lock()
+        self._sessions = set() # handler connections using this device
+        self._subscriptions = set()
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"uplink-{self.label}")
+        self.client.username_pw_set(token)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+        self.client.max_queued_messages_set(MAX_QUEUED_MESSAGES)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.connect_async(host, port, 60)
+        self.client.loop_start()
+
+        self.outbox = TelemetryOutbox(os.path.join(OUTBOX_DIR, f"uplink_{self.label}.db"), self.client, max_bytes=OUTBOX_MAX_BYTES)
+        self.outbox.start()
+        self.gateway_outbox = None # opened on the first record naming a device (v1/gateway/telemetry)
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        print(f"Device {self.label} connected to ThingsBoard Edge: {reason_code}")
+        for topic in list(self._subscriptions):
+            client.subscribe(topic)
+        self.broadcast({"event": "connected"})
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        print(f"Device {self.label} disconnected: {reason_code}")
+        self.broadcast({"event": "disconnected"})
+
+    def _on_message(self, client, userdata, msg):
+        self.broadcast({"event": "message", "topic": msg.topic, "payload": msg.payload.decode("utf-8")})
+
+    def put_many(self, records):
+        """Telemetry from a script: [ts, values] for this device, [ts, values, device] for a gateway's devices."""
+        own = [record for record in records if len(record) < 3 or record[2] is None]
+        devices = [record for record in records if len(record) > 2 and record[2] is not None]
+        if own:
+            self.outbox.put_many(own)
+        if devices:
+            if self.gateway_outbox is None:
+                self.gateway_outbox = TelemetryOutbox(os.path.join(OUTBOX_DIR, f"uplink_{self.label}_gateway.db"), self.client,
+                                                      max_bytes=OUTBOX_MAX_BYTES, gateway=True)
+                self.gateway_outbox.start()
+            self.gateway_outbox.put_many(devices)
+
+    def subscribe(self, topic):
+        if topic not in self._subscriptions:
+            self._subscriptions.add(topic)
+            if self.client.is_connected():
+                self.client.subscribe(topic)
+
+    def attach(self, session):
+        with self._sessions_lock:
+            self._sessions.add(session)
+        if self.client.is_connected():
+            session.send({"event": "connected"})
+
+    def detach(self, session):
+        with self._sessions_lock:
+            self._sessions.discard(session)
+
+    def broadcast(self, frame):
+        with self._sessions_lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            session.send(frame)
+
+    def close(self):
+        self.outbox.close()
+        if self.gateway_outbox:
+            self.gateway_outbox.close()
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class UplinkServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, host=MQTT_HOST, port=MQTT_PORT):
+        if os.path.exists(path):
+            os.unlink(path) # stale socket from a previous run
+        self.mqtt_host = host
+        self.mqtt_port = port
+        self.devices = {}
+        self.devices_lock = threading.Lock()
+        super().__init__(path, UplinkHandler)
+        os.chmod(path, 0o660)
+
+    def device(self, token):
+        with self.devices_lock:
+            device = self.devices.get(token)
+            if device is None:
+                device = self.devices[token] = DeviceUplink(token, self.mqtt_host, self.mqtt_port)
+            return device
+
+    def server_close(self):
+        super().server_close()
+        for device in self.devices.values():
+            device.close()
+
+
+class UplinkHandler(socketserver.StreamRequestHandler):
+    """One script's connection."""
+
+    def setup(self):
+        super().setup()
+        self.device = None
+        # send() is called from paho's network thread, so it only queues; a writer thread per
+        # script does the blocking writes and one stalled script can't hold up the others
+        self._outgoing = queue.Queue(maxsize=MAX_CLIENT_BACKLOG)
+        self._stalled = False
+        self._writer = threading.Thread(target=self._write_loop, name="uplink-writer", daemon=True)
+        self._writer.start()
+
+    def send(self, frame):
+        try:
+            self._outgoing.put_nowait((json.dumps(frame) + "\n").encode())
+        except queue.Full:
+            if not self._stalled:
+                self._stalled = True
+                print(f"Uplink client not reading ({MAX_CLIENT_BACKLOG} frames waiting), disconnecting it")
+                self._disconnect()
+
+    def _disconnect(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR) # ends handle(); the script reconnects and resubscribes
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        while True:
+            data = self._outgoing.get()
+            if data is None:
+                return
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                return # the script went away, handle() will notice
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                frame = json.loads(line)
+                op = frame.get("op")
+                if op == "hello":
+                    self.device = self.server.device(frame["token"])
+                    self.device.attach(self)
+                elif self.device is None:
+                    print("Uplink client sent data before hello, closing it")
+                    return
+                elif op == "telemetry":
+                    self.device.put_many(frame["records"])
+                elif op == "publish":
+                    self.device.client.publish(frame["topic"], frame["payload"], qos=frame.get("qos", 1))
+                elif op == "subscribe":
+                    self.device.subscribe(frame["topic"])
+            except (ValueError, KeyError) as e:
+                print(f"Bad frame from uplink client: {e}")
+
+    def finish(self):
+        if self.device:
+            self.device.detach(self)
+        while True: # what's left can't be delivered any more
+            try:
+                self._outgoing.get_nowait()
+            except queue.Empty:
+                break
+        self._outgoing.put(None) # stops the writer
+        super().finish()
+
+
+class PublishInfo:
+    """What UplinkClient.publish() returns, like paho's MQTTMessageInfo. The message counts as published
+    once it's been handed to the daemon, which owns its delivery from there (QoS, reconnects)."""
+
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = 0 # MQTT_ERR_SUCCESS
+        self._written = threading.Event()
+
+    def wait_for_publish(self, timeout=None):
+        if self.rc == 0:
+            self._written.wait(timeout)
+
+    def is_published(self):
+        return self._written.is_set()
+
+
+class UplinkClient:
+    """What the scripts use instead of a paho client when UPLINK_SOCKET is set.
+
+    Covers the bits of paho the scripts use (publish, subscribe, on_connect/on_message with the
+    paho VERSION2 callback signatures, is_connected, loop_start/loop_stop, disconnect) and is also
+    a sink for TelemetryBatcher (put_many). Frames are queued (up to max_pending, then the oldest
+    are dropped) and written to the daemon by a writer thread, so publish() never blocks on the
+    socket; they wait in the queue while the daemon is unreachable.
+    """
+
+    def __init__(self, socket_path, token, max_pending=10000):
+        self.socket_path = socket_path
+        self.token = token
+        self.on_connect = None
+        self.on_message = None
+        self.max_pending = max_pending
+        self._pending = deque() # (data, PublishInfo or None)
+        self._subscriptions = []
+        self._sock = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._writer = None
+        self._mid = 0
+        self._connected = False # the daemon's MQTT session for our token is up
+        self.dropped = 0
+
+    def _send(self, frame, info=None):
+        data = (json.dumps(frame) + "\n").encode()
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                _, dropped = self._pending.popleft()
+                self.dropped += 1
+                if dropped is not None:
+                    dropped.rc = 15 # MQTT_ERR_QUEUE_SIZE, never sent
+            self._pending.append((data, info))
+        self._wake.set()
+        return info
+
+    def _write_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(1.0)
+            self._wake.clear()
+            while not self._stop.is_set():
+                with self._lock:
+                    sock = self._sock
+                    if sock is None or not self._pending:
+                        break
+                    data, info = self._pending.popleft()
+                try:
+                    sock.sendall(data) # blocks if the daemon falls behind - that's the backpressure
+                except OSError:
+                    with self._lock:
+                        self._pending.appendleft((data, info)) # sent again after the reconnect
+                        if self._sock is sock:
+                            self._drop_socket()
+                    break
+                if info is not None:
+                    info._written.set()
+
+    def _drop_socket(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+            self._connected = False
+
+    def _open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        # Not shared with the writer yet, so these go first
+        sock.sendall((json.dumps({"op": "hello", "token": self.token}) + "\n").encode())
+        for topic in subscriptions:
+            sock.sendall((json.dumps({"op": "subscribe", "topic": topic}) + "\n").encode())
+        with self._lock:
+            self._sock = sock
+        self._wake.set() # the writer sends what queued up meanwhile
+        return sock
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                sock = self._open()
+            except OSError:
+                self._stop.wait(1.0) # daemon not up (yet)
+                continue
+            try:
+                for line in sock.makefile("rb"):
+                    self._dispatch(json.loads(line))
+            except (OSError, ValueError):
+                pass
+            with self._lock:
+                if self._sock is sock:
+                    self._drop_socket()
+
+    def _dispatch(self, frame):
+        event = frame.get("event")
+        if event == "connected":
+            self._connected = True
+            if self.on_connect:
+                self.on_connect(self, None, {}, 0, None)
+        elif event == "disconnected":
+            self._connected = False
+        elif event == "message" and self.on_message:
+            msg = SimpleNamespace(topic=frame["topic"], payload=frame["payload"].encode("utf-8"))
+            self.on_message(self, None, msg)
+
+    # paho-like API
+    def publish(self, topic, payload, qos=1):
+        with self._lock:
+            self._mid += 1
+            info = PublishInfo(self._mid)
+        return self._send({"op": "publish", "topic": topic, "payload": payload, "qos": qos}, info)
+
+    def subscribe(self, topic):
+        if topic not in self._subscriptions:
+            self._subscriptions.append(topic)
+        self._send({"op": "subscribe", "topic": topic})
+
+    def is_connected(self):
+        return self._connected
+
+    def loop_start(self):
+        self._thread = threading.Thread(target=self._run, name="uplink-client", daemon=True)
+        self._thread.start()
+        self._writer = threading.Thread(target=self._write_loop, name="uplink-client-writer", daemon=True)
+        self._writer.start()
+
+    def loop_stop(self):
+        deadline = time.monotonic() + CLIENT_FLUSH_SECONDS
+        while self._pending and self._sock is not None and time.monotonic() < deadline:
+            time.sleep(0.01) # e.g. the last batch flushed on exit
+        self._stop.set()
+        self._wake.set()
+        with self._lock:
+            if self._sock is not None:
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR) # wakes the reader (and a blocked writer)
+                except OSError:
+                    pass
+        for thread in (self._thread, self._writer):
+            if thread:
+                thread.join()
+
+    def disconnect(self):
+        with self._lock:
+            self._drop_socket()
+
+    # TelemetryBatcher sink
+    def put_many(self, records):
+        """[(ts, values), ...] or (ts, values, device) for a gateway token's devices."""
+        self._send({"op": "telemetry", "records": [list(record) for record in records]})
+
+
+if __name__ == "__main__":
+    server = UplinkServer(UPLINK_SOCKET)
+    print(f"MQTT uplink listening on {UPLINK_SOCKET}, forwarding to {MQTT_HOST}:{MQTT_PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Exiting.")
+    finally:
+        server.server_close()
+        if os.path.exists(UPLINK_SOCKET):
+            os.unlink(UPLINK_SOCKET)
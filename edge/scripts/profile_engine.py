@@ -0,0 +1,141 @@
+# Power profile execution (used by KA3005P_controller.py)
+# Every step is scheduled against an absolute monotonic deadline (start + sum of the previous
+# durations) instead of sleeping for the step duration after doing the I/O, so serial/MQTT latency
+# never accumulates into drift. Steps can be fractional seconds and can ramp linearly from the
+# previous level. cancel() wakes the engine straight away and no setpoint is written after it returns.
+# The clock is pluggable: profile_sim.py runs the same engine (and PsuWorker) against a virtual clock, much faster than real time.
+# Benchmark:  python profile_engine.py --steps 200 --step-seconds 0.05
+import math
+import threading
+import time
+
+
+class RealClock:
+    """time.monotonic, and waits that end early when an event is set."""
+
+    monotonic = staticmethod(time.monotonic)
+    time = staticmethod(time.time)
+    Event = threading.Event
+
+    @staticmethod
+    def wait(event, timeout):
+        return event.wait(timeout)
+
+
+class ProfileEngine:
+    """Runs [{"duration": s, "power_pct": %, "ramp": bool}, ...] against set_current(amps)."""
+
+    def __init__(self, steps, set_current, max_current, ramp_interval_s=0.1, on_step=None, name="profile", clock=None):
+        self.steps = steps
+        self.set_current = set_current
+        self.max_current = max_current
+        self.ramp_interval_s = ramp_interval_s # setpoint update period while ramping
+        self.on_step = on_step # called with a telemetry dict at the start of every step
+        self.name = name
+        self.clock = clock or RealClock
+
+        self._cancel = threading.Event()
+        self._lock = threading.Lock() # held while writing a setpoint, so cancel() can fence it off
+        self.current = None # last setpoint written
+
+        # Timing stats: actual - planned start of each step
+        self.steps_run = 0
+        self.max_abs_error_s = 0.0
+        self.total_error_s = 0.0
+
+    def cancel(self):
+        """Stops the profile. Once this returns the engine won't write another setpoint."""
+        with self._lock:
+            self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def _apply(self, amps):
+        with self._lock:
+            if self._cancel.is_set():
+                return False
+            self.set_current(amps)
+            self.current = amps
+            return True
+
+    def _wait_until(self, deadline):
+        """Sleeps until the deadline. False if cancelled meanwhile."""
+        wait = deadline - self.clock.monotonic()
+        if wait > 0:
+            return not self.clock.wait(self._cancel, wait)
+        return not self._cancel.is_set()
+
+    def run(self):
+        """Runs all steps (blocking). Returns True if it completed, False if cancelled."""
+        deadline = self.clock.monotonic()
+        for index, step in enumerate(self.steps):
+            duration_s = float(step["duration"])
+            target = (float(step["power_pct"]) / 100.0) * self.max_current
+            planned = deadline
+            deadline = planned + duration_s
+
+            error_s = self.clock.monotonic() - planned
+            self.steps_run += 1
+            self.total_error_s += error_s
+            self.max_abs_error_s = max(self.max_abs_error_s, abs(error_s))
+            if self.on_step:
+                self.on_step({
+                    "profile_step": index,
+                    "psu_commandedCurrent": target,
+                    "profile_timingError_ms": round(error_s * 1000.0, 3),
+                })
+
+            start = self.current
+            if step.get("ramp") and start is not None and duration_s > 0:
+                # Linear ramp from the previous level, reaching the target at the end of the step
+                points = max(1, math.ceil(duration_s / self.ramp_interval_s))
+                for i in range(1, points + 1):
+                    if not self._wait_until(planned + duration_s * i / points):
+                        return False
+                    if not self._apply(start + (target - start) * i / points):
+                        return False
+            else:
+                if not self._apply(target):
+                    return False
+                if not self._wait_until(deadline):
+                    return False
+        return not self.cancelled
+
+    def stats(self):
+        return {
+            "steps": self.steps_run,
+            "max_abs_error_ms": round(self.max_abs_error_s * 1000.0, 3),
+            "mean_error_ms": round(self.total_error_s / self.steps_run * 1000.0, 3) if self.steps_run else 0.0,
+            "cancelled": self.cancelled,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Step timing of ProfileEngine against a fake setpoint writer")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--step-seconds", type=float, default=0.05)
+    parser.add_argument("--write-latency", type=float, default=0.01, help="time each set_current call takes (s)")
+    args = parser.parse_args()
+
+    profile = [{"duration": args.step_seconds, "power_pct": (i * 7) % 100, "ramp": i % 4 == 0} for i in range(args.steps)]
+    engine = ProfileEngine(profile, lambda amps: time.sleep(args.write_latency), max_current=5.0, ramp_interval_s=args.step_seconds / 5)
+    started = time.monotonic()
+    engine.run()
+    elapsed = time.monotonic() - started
+    planned = args.steps * args.step_seconds
+    print(f"{args.steps} steps planned {planned:.3f} s, took {elapsed:.3f} s (drift {1000 * (elapsed - planned):.1f} ms)")
+    print(f"stats: {engine.stats()}")
+
+    # Cancel latency: a long step cancelled from another thread
+    engine = ProfileEngine([{"duration": 60, "power_pct": 50}], lambda amps: None, max_current=5.0)
+    thread = threading.Thread(target=engine.run)
+    thread.start()
+    time.sleep(0.2)
+    cancelled_at = time.monotonic()
+    engine.cancel()
+    thread.join()
+    print(f"cancel took effect in {1000 * (time.monotonic() - cancelled_at):.2f} ms")
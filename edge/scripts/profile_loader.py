@@ -0,0 +1,209 @@
+# Streaming, cached power profile loader (used by KA3005P_controller.py)
+# The CSV (header line, then duration,power_pct[,ramp] per row) is parsed and validated line by
+# line while it downloads, into array columns (17 bytes per step instead of a dict per row). The
+# result is cached on disk keyed by URL together with the server's ETag/Last-Modified. Re-running
+# the same profile then costs one conditional request (304 Not Modified), or none if the server
+# can't be reached. Steps are always executed from the cache file through mmap, so even a
+# week-long 1 s profile only occupies page cache, not Python heap.
+# Benchmark:  python profile_loader.py --rows 604800
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+from array import array
+
+from pulse_journal import atomic_write_json, _fsync_dir
+
+# Cache file: header (magic, step count), then the duration column (float64), the power_pct
+# column (float64) and the ramp column (uint8). Native byte order - the cache never leaves the Pi.
+HEADER = struct.Struct("=8sQ")
+MAGIC = b"PEMPROF1"
+
+
+class ProfileSteps:
+    """Read-only step columns. Indexing/iterating gives the dicts ProfileEngine expects."""
+
+    def __init__(self, durations, power_pcts, ramps, mm=None):
+        self.durations = durations
+        self.power_pcts = power_pcts
+        self.ramps = ramps
+        self._mmap = mm
+        self.source = None # set by ProfileLoader: "download", "not_modified" or "offline_cache"
+
+    @classmethod
+    def open(cls, path):
+        """Maps a cache file. Nothing is read until a step is used."""
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or len(mm) != HEADER.size + 17 * count:
+            mm.close()
+            raise ValueError(f"{path} is not a valid profile cache file")
+        view = memoryview(mm)
+        start = HEADER.size
+        durations = view[start:start + 8 * count].cast("d")
+        power_pcts = view[start + 8 * count:start + 16 * count].cast("d")
+        ramps = view[start + 16 * count:start + 17 * count]
+        view.release()
+        return cls(durations, power_pcts, ramps, mm)
+
+    def write(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(self)))
+            for column in (self.durations, self.power_pcts, self.ramps):
+                f.write(column)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(path)
+
+    def __len__(self):
+        return len(self.durations)
+
+    def __getitem__(self, index):
+        return {"duration": self.durations[index], "power_pct": self.power_pcts[index], "ramp": bool(self.ramps[index])}
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def total_duration_s(self):
+        return math.fsum(self.durations)
+
+    def close(self):
+        if self._mmap is not None:
+            for column in (self.durations, self.power_pcts, self.ramps):
+                column.release()
+            self._mmap.close()
+            self._mmap = None
+
+
+def parse_rows(lines):
+    """Parses CSV lines (header first) into ProfileSteps. Raises ValueError naming the bad line."""
+    durations, power_pcts, ramps = array("d"), array("d"), array("B")
+    for number, line in enumerate(lines, start=1):
+        if number == 1:
+            continue # header
+        line = line.strip()
+        if not line:
+            continue
+        fields = line.split(",")
+        if len(fields) not in (2, 3):
+            raise ValueError(f"line {number}: expected duration,power_pct[,ramp], got {line!r}")
+        try:
+            duration = float(fields[0])
+            power_pct = float(fields[1])
+        except ValueError:
+            raise ValueError(f"line {number}: not a number in {line!r}") from None
+        if not math.isfinite(duration):
+            # 0 (an instant setpoint) and negative durations are fine, ProfileEngine's deadlines handle them
+            raise ValueError(f"line {number}: duration must be a finite number of seconds, got {fields[0]!r}")
+        if not 0 <= power_pct <= 100:
+            raise ValueError(f"line {number}: power_pct must be 0-100, got {fields[1]!r}")
+        durations.append(duration)
+        power_pcts.append(power_pct)
+        ramps.append(len(fields) > 2 and fields[2].strip().lower() in ("1", "true", "ramp", "yes"))
+    if not durations:
+        raise ValueError("profile has no steps")
+    return ProfileSteps(durations, power_pcts, ramps)
+
+
+class ProfileLoader:
+    """Downloads profiles into an on-disk cache keyed by URL, revalidated with ETag/Last-Modified."""
+
+    def __init__(self, cache_dir, timeout_s=10):
+        self.cache_dir = cache_dir
+        self.timeout_s = timeout_s
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock() # several PSUs may load (the same) profile at once
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + ".bin", base + ".json"
+
+    def load(self, url):
+        """Returns mmap-backed ProfileSteps for url (caller closes them).
+
+        Raises requests.exceptions.RequestException if the download fails and nothing is cached,
+        ValueError if the profile is invalid.
+        """
+        with self._lock:
+            steps, source = self._load(url)
+        steps.source = source
+        return steps
+
+    def _load(self, url):
+        import requests
+
+        data_path, meta_path = self._paths(url)
+        meta = None
+        if os.path.exists(data_path) and os.path.exists(meta_path):
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = None
+
+        headers = {}
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=self.timeout_s) as response:
+                if meta and response.status_code == 304:
+                    return ProfileSteps.open(data_path), "not_modified"
+                response.raise_for_status()
+                response.encoding = response.encoding or "utf-8"
+                steps = parse_rows(response.iter_lines(decode_unicode=True))
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except requests.exceptions.RequestException:
+            if meta:
+                return ProfileSteps.open(data_path), "offline_cache" # run what we have rather than nothing
+            raise
+
+        # The meta is what makes a cache entry valid (its ETag vouches for the .bin), so it goes first
+        # and comes back last: a crash in between leaves no entry rather than an old ETag on new steps
+        try:
+            os.remove(meta_path)
+        except FileNotFoundError:
+            pass
+        steps.write(data_path)
+        atomic_write_json(meta_path, {"url": url, "etag": etag, "last_modified": last_modified, "steps": len(steps)})
+        return ProfileSteps.open(data_path), "download" # the parsed columns are dropped, execution runs off the map
+
+
+if __name__ == "__main__":
+    import argparse
+    import io
+    import resource
+    import tempfile
+    import time
+
+    parser = argparse.ArgumentParser(description="Parse + cache + map a synthetic profile")
+    parser.add_argument("--rows", type=int, default=604800, help="steps (604800 = one week at 1 s)")
+    args = parser.parse_args()
+
+    text = "duration,power_pct\n" + "".join(f"1,{(i * 7) % 101}\n" for i in range(args.rows))
+    started = time.perf_counter()
+    steps = parse_rows(io.StringIO(text))
+    parsed = time.perf_counter() - started
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "profile.bin")
+        steps.write(path)
+        del steps
+        started = time.perf_counter()
+        mapped = ProfileSteps.open(path)
+        opened = time.perf_counter() - started
+        print(f"{args.rows} rows parsed in {parsed:.2f} s, cache {os.path.getsize(path) / 1e6:.1f} MB, mapped in {opened * 1000:.2f} ms")
+        print(f"{len(mapped)} steps, {mapped.total_duration_s() / 3600:.1f} h, step[1000] = {mapped[1000]}")
+        print(f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB (includes the CSV text held for the benchmark)")
+        mapped.close()
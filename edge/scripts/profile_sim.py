@@ -0,0 +1,431 @@
+# Time-accelerated power profile simulation (checks profiles before they go to KA3005P_controller.py)
+# Runs the controller's own ProfileEngine and PsuWorker._run loop (setpoint slots, write skipping, polls
+# between writes) on their own threads against a virtual clock, a FakePowerSupply with its serial round
+# trip (+-SERIAL_JITTER), and a simple PEM electrolyser model as the load. The clock jumps ahead whenever
+# both threads wait, so nothing really sleeps and a day-long 1 s profile takes seconds:
+#   python profile_sim.py solar_day.csv wind_week.csv
+#   python profile_sim.py --demo                       # a synthetic day of solar + wind
+#   python profile_sim.py --check profiles/*.csv       # exit code 1 on a limit violation or slow setpoints
+# For each profile it reports:
+#   limits     time at >MAX_CELL_VOLTAGE per cell, at 0 < current < MIN_LOAD_PCT (gas crossover), voltage
+#              limited by the PSU (couldn't deliver the commanded current), over --max-power, setpoint
+#              jumps over --max-step
+#   timing     setpoint lag: profile asks -> PSU holds the value (waiting behind polls/other writes on the
+#              serial port), plus ramp points that were superseded. The profile starts at a random point of
+#              the poll cycle (--seed repeats a run), as the lag depends on where the steps fall in it. Step
+#              start error isn't reported, on a virtual clock it's 0 by construction (python profile_engine.py)
+#   totals     energy, charge, H2 (Faraday efficiency with crossover), kWh/Nm3
+# The model: cell voltage = E_rev(T) + (RT/aF) asinh(j / 2 j0) + r j, hydrogen = cells I (1 - j_cross/j) / 2F.
+# It's for comparing profiles and catching regressions in the controller, not for predicting the stack.
+import heapq
+import math
+import random
+import threading
+import time
+
+from derived_metrics import FARADAY_C_PER_MOL, NORMAL_LITRES_PER_MOL
+from fake_ka3005p import FakePowerSupply
+from profile_engine import ProfileEngine
+from psu_worker import PsuWorker
+
+GAS_CONSTANT = 8.314462618 # J/(mol K)
+
+# Defaults, as in KA3005P_controller.py's config
+MAX_CURRENT = 5.0 # A
+VOLTAGE_SETPOINT = 30.0 # V
+PSU_POLL_INTERVAL_SECONDS = 0.25
+PROFILE_RAMP_INTERVAL_SECONDS = 0.1
+SERIAL_LATENCY_SECONDS = 0.05 # KA3005P round trip per command
+SERIAL_JITTER = 0.2 # +-20 % on each round trip
+# Stack limits
+MAX_CELL_VOLTAGE = 2.2 # V per cell, degradation above this
+MIN_LOAD_PCT = 5.0 # % of MAX_CURRENT - running but below this, H2 crossing into the O2 side builds up
+
+
+class _Waiter:
+    __slots__ = ("event", "woken")
+
+    def __init__(self, event):
+        self.event = event
+        self.woken = False
+
+
+class _ClockEvent:
+    """threading.Event for threads on a VirtualClock: set() makes the threads waiting on it runnable."""
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._flag = False
+        self._waiters = []
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        with self._clock._cond:
+            self._flag = True
+            for waiter in self._waiters:
+                self._clock._resume(waiter)
+            self._waiters.clear()
+
+    def clear(self):
+        self._flag = False
+
+    def wait(self, timeout=None):
+        return self._clock.wait(self, timeout)
+
+
+class VirtualClock:
+    """Simulated time for real threads. It only moves on once every thread started on it (and the one
+    that made it) is waiting on it, and then jumps straight to the earliest deadline. So ProfileEngine
+    and PsuWorker run their own loops, in the same order as on the real clock, with no real sleeps."""
+
+    def __init__(self, epoch=1.7e9):
+        self.now = 0.0
+        self.epoch = epoch # what time() reads at now == 0
+        self._cond = threading.Condition()
+        self._running = 1 # threads not waiting on the clock, starting with this one
+        self._deadlines = [] # (when, seq, waiter)
+        self._seq = 0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.epoch + self.now
+
+    def Event(self):
+        return _ClockEvent(self)
+
+    def sleep(self, seconds):
+        self.wait(None, seconds)
+
+    def run_until(self, deadline):
+        self.wait(None, deadline - self.now)
+
+    def wait(self, event, timeout):
+        """Blocks until event (a _ClockEvent, or any event nothing else sets) is set or timeout has passed."""
+        with self._cond:
+            if event is not None and event.is_set():
+                return True
+            waiter = _Waiter(event)
+            if isinstance(event, _ClockEvent):
+                event._waiters.append(waiter)
+            if timeout is not None:
+                self._seq += 1
+                heapq.heappush(self._deadlines, (self.now + max(0.0, timeout), self._seq, waiter))
+            self._running -= 1
+            if not self._running and not self._advance():
+                raise RuntimeError("every simulated thread is waiting, with no timeout")
+            while not waiter.woken:
+                self._cond.wait()
+            return event is not None and event.is_set()
+
+    def thread(self, target, name):
+        """Starts target() on a thread that runs on this clock. Returns an event, set when it's returned."""
+        finished = self.Event()
+
+        def run():
+            try:
+                target()
+            finally:
+                with self._cond:
+                    finished.set()
+                    self._running -= 1
+                    if not self._running:
+                        self._advance()
+
+        with self._cond:
+            self._running += 1
+        threading.Thread(target=run, name=name, daemon=True).start()
+        return finished
+
+    def _resume(self, waiter):
+        if not waiter.woken:
+            waiter.woken = True
+            self._running += 1
+            self._cond.notify_all()
+
+    def _advance(self):
+        # Everyone is waiting: wake whoever's deadline comes first (together with any due at the same time)
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][2].woken:
+            heapq.heappop(deadlines)
+        if not deadlines:
+            return False
+        self.now = max(self.now, deadlines[0][0])
+        while deadlines and deadlines[0][0] <= self.now:
+            waiter = heapq.heappop(deadlines)[2]
+            if not waiter.woken:
+                if isinstance(waiter.event, _ClockEvent):
+                    waiter.event._waiters.remove(waiter)
+                self._resume(waiter)
+        return True
+
+class ElectrolyserModel:
+    """PEM stack: steady state I-V curve and H2 production (no thermal or double layer dynamics)."""
+
+    def __init__(self, cells=1, area_cm2=25.0, temperature_c=60.0, j0_a_cm2=1e-3, alpha=0.5, r_ohm_cm2=0.15, j_cross_a_cm2=0.002):
+        self.cells = cells
+        self.area_cm2 = area_cm2
+        self.temperature_c = temperature_c
+        self.j0 = j0_a_cm2 # exchange current density (anode, effective)
+        self.r = r_ohm_cm2 # area specific resistance: membrane + contacts
+        self.j_cross = j_cross_a_cm2 # H2 crossover as an equivalent current density
+        temperature_k = temperature_c + 273.15
+        self.e_rev = 1.229 - 0.0009 * (temperature_k - 298.15)
+        self.tafel = GAS_CONSTANT * temperature_k / (alpha * FARADAY_C_PER_MOL)
+        self._cache = {}
+
+    def cell_voltage(self, amps):
+        j = amps / self.area_cm2
+        return self.e_rev + self.tafel * math.asinh(j / (2 * self.j0)) + self.r * j
+
+    def operating_point(self, voltage_limit, current_limit):
+        """Where a CC/CV supply set to (voltage_limit, current_limit) settles on this stack: (V, A)."""
+        key = (voltage_limit, current_limit)
+        point = self._cache.get(key)
+        if point is None:
+            if len(self._cache) > 100000:
+                self._cache.clear()
+            point = self._cache[key] = self._operating_point(voltage_limit, current_limit)
+        return point
+
+    def _operating_point(self, voltage_limit, current_limit):
+        open_circuit = self.cells * self.e_rev
+        if current_limit <= 0 or voltage_limit <= open_circuit:
+            return min(voltage_limit, open_circuit), 0.0
+        voltage = self.cells * self.cell_voltage(current_limit)
+        if voltage <= voltage_limit:
+            return voltage, current_limit # constant current
+        low, high = 0.0, current_limit # constant voltage: the current where the stack needs voltage_limit
+        for _ in range(50):
+            mid = (low + high) / 2
+            if self.cells * self.cell_voltage(mid) > voltage_limit:
+                high = mid
+            else:
+                low = mid
+        return voltage_limit, low
+
+    def h2_nl_per_s(self, amps):
+        if amps <= 0:
+            return 0.0
+        efficiency = max(0.0, 1.0 - self.j_cross * self.area_cm2 / amps)
+        return self.cells * amps * efficiency / (2 * FARADAY_C_PER_MOL) * NORMAL_LITRES_PER_MOL
+
+
+class _Limit:
+    def __init__(self):
+        self.events = 0
+        self.seconds = 0.0
+        self.first_at_s = None
+        self._active = False
+
+    def update(self, violated, start, seconds):
+        if violated:
+            if not self._active:
+                self.events += 1
+                if self.first_at_s is None:
+                    self.first_at_s = start
+            self.seconds += seconds
+        self._active = violated
+
+    def report(self):
+        return {"events": self.events, "seconds": round(self.seconds, 3), "first_at_s": None if self.first_at_s is None else round(self.first_at_s, 3)}
+
+
+class _SimPowerSupply(FakePowerSupply):
+    """FakePowerSupply on the virtual clock that integrates energy, charge and H2, and checks limits."""
+
+    def __init__(self, clock, model, max_current, max_cell_voltage, min_load_pct, max_power_w, max_step_a, jitter=0.0, rng=None, **kwargs):
+        rng = rng or random.Random()
+        # A USB serial round trip isn't the same every time: +-jitter of latency_s
+        sleep = (lambda seconds: clock.sleep(seconds * rng.uniform(1 - jitter, 1 + jitter))) if jitter else clock.sleep
+        super().__init__(max_current=max_current, load=model, sleep=sleep, **kwargs)
+        self.clock = clock
+        self.model = model
+        self.max_cell_voltage = max_cell_voltage
+        self.min_load_a = max_current * min_load_pct / 100.0
+        self.max_power_w = max_power_w
+        self.max_step_a = max_step_a
+        self.limits = {name: _Limit() for name in ("cell_voltage", "low_load", "voltage_limited", "power", "setpoint_step")}
+        self._since = 0.0
+        self._last_current_set = 0.0
+        self.energy_j = self.charge_c = self.h2_nl = 0.0
+        self.peak_power_w = 0.0
+
+    def _command(self):
+        super()._command()
+        self.account() # up to the moment this command takes effect
+
+    def account(self):
+        """Integrates the output held since the last call (the output only changes on a command)."""
+        now = self.clock.now
+        seconds = now - self._since
+        if seconds <= 0:
+            return
+        start, self._since = self._since, now
+        voltage, current = self._output()
+        power = voltage * current
+        self.energy_j += power * seconds
+        self.charge_c += current * seconds
+        self.h2_nl += self.model.h2_nl_per_s(current) * seconds
+        self.peak_power_w = max(self.peak_power_w, power)
+        limits = self.limits
+        limits["cell_voltage"].update(current > 0 and voltage / self.model.cells > self.max_cell_voltage, start, seconds)
+        limits["low_load"].update(0 < current < self.min_load_a, start, seconds)
+        limits["voltage_limited"].update(self._enabled and current < self._current_set - 0.0005, start, seconds)
+        limits["power"].update(self.max_power_w is not None and power > self.max_power_w, start, seconds)
+        step = abs(self._current_set - self._last_current_set)
+        limits["setpoint_step"].update(self.max_step_a is not None and step > self.max_step_a, start, 0.0)
+        self._last_current_set = self._current_set
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+def simulate(steps, model=None, max_current=MAX_CURRENT, voltage=VOLTAGE_SETPOINT, poll_interval_s=PSU_POLL_INTERVAL_SECONDS,
+             ramp_interval_s=PROFILE_RAMP_INTERVAL_SECONDS, serial_latency_s=SERIAL_LATENCY_SECONDS,
+             serial_jitter=SERIAL_JITTER, max_cell_voltage=MAX_CELL_VOLTAGE, min_load_pct=MIN_LOAD_PCT, max_power_w=None,
+             max_step_a=None, seed=None):
+    """Runs steps (ProfileSteps or a list of step dicts) through the controller path. Returns a report dict."""
+    model = model or ElectrolyserModel()
+    if seed is None:
+        seed = random.randrange(2**32) # reported, so a run can be repeated with --seed
+    rng = random.Random(seed)
+    clock = VirtualClock()
+    psu = _SimPowerSupply(clock, model, max_current, max_cell_voltage, min_load_pct, max_power_w, max_step_a,
+                          jitter=serial_jitter, rng=rng, latency_s=serial_latency_s)
+    worker = PsuWorker(psu, poll_interval_s=poll_interval_s, name="sim", clock=clock)
+    # As KA3005P_controller.open_psu(), then the worker's own loop on the virtual clock
+    worker.set_voltage(voltage)
+    worker.set_current(0.0)
+    worker.enable()
+    serial = clock.thread(worker._run, "sim-serial")
+    # The profile starts at a random point of the poll cycle, as it would when triggered from the dashboard
+    phase_s = rng.uniform(0.0, poll_interval_s or 1.0)
+    clock.run_until(1.0 + phase_s)
+
+    lags = []
+
+    def set_current(amps):
+        requested = clock.now
+        worker.set_current(amps, on_written=lambda value, error=None: error is None and lags.append(clock.now - requested))
+
+    started = time.perf_counter()
+    profile_start = clock.now
+    engine = ProfileEngine(steps, set_current, max_current, ramp_interval_s=ramp_interval_s, name="sim-profile", clock=clock)
+    engine.run()
+    profile_s = clock.now - profile_start
+    clock.run_until(clock.now + 2 * (poll_interval_s + 2 * serial_latency_s)) # the last write and a poll
+    worker._stop.set()
+    worker._wake.set()
+    clock.wait(serial, None)
+    psu.account()
+    wall_s = time.perf_counter() - started
+
+    lags.sort()
+    worker_stats = worker.stats()
+    energy_kwh = psu.energy_j / 3.6e6
+    h2_nm3 = psu.h2_nl / 1000.0
+    return {
+        "steps": len(steps),
+        "profile_h": round(profile_s / 3600.0, 3),
+        "wall_s": round(wall_s, 3),
+        "speedup": round(profile_s / wall_s) if wall_s else None,
+        "limits": {name: limit.report() for name, limit in psu.limits.items()},
+        "seed": seed,
+        "phase_ms": round(1000 * phase_s, 1),
+        "setpoint_lag_ms": {
+            "p50": round(1000 * _percentile(lags, 0.5), 1) if lags else None,
+            "p99": round(1000 * _percentile(lags, 0.99), 1) if lags else None,
+            "max": round(1000 * lags[-1], 1) if lags else None,
+        },
+        "serial": {"writes": worker_stats["writes"], "skipped_writes": worker_stats["skipped_writes"], "polls": worker_stats["polls"],
+                   "collisions": psu.collisions},
+        "energy_kwh": round(energy_kwh, 4),
+        "charge_ah": round(psu.charge_c / 3600.0, 3),
+        "h2_nl": round(psu.h2_nl, 2),
+        "kwh_per_nm3": round(energy_kwh / h2_nm3, 2) if h2_nm3 else None,
+        "peak_power_w": round(psu.peak_power_w, 2),
+    }
+
+
+def demo_profile(hours=24.0, step_s=1.0, seed=1):
+    """A synthetic renewable day: solar bell curve with clouds plus gusty wind, in % of MAX_CURRENT."""
+    import random
+
+    rng = random.Random(seed)
+    steps = []
+    wind = 30.0
+    cloud = 1.0
+    for i in range(int(hours * 3600 / step_s)):
+        hour = (i * step_s / 3600.0) % 24
+        solar = max(0.0, math.sin(math.pi * (hour - 6) / 12)) * 70 if 6 <= hour <= 18 else 0.0
+        cloud = min(1.0, max(0.2, cloud + rng.gauss(0, 0.01)))
+        wind = min(60.0, max(0.0, wind + rng.gauss(0, 0.5)))
+        power_pct = min(100.0, solar * cloud + wind)
+        steps.append({"duration": step_s, "power_pct": round(power_pct, 1), "ramp": False})
+    return steps
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import sys
+
+    from profile_loader import parse_rows
+
+    parser = argparse.ArgumentParser(description="Run power profiles through the controller against a simulated KA3005P and stack")
+    parser.add_argument("profiles", nargs="*", help="profile CSV files (duration,power_pct[,ramp], as served to the controller)")
+    parser.add_argument("--demo", action="store_true", help="also run a synthetic 24 h solar + wind profile at 1 s steps")
+    parser.add_argument("--max-current", type=float, default=MAX_CURRENT, help="A at 100 %%")
+    parser.add_argument("--voltage", type=float, default=VOLTAGE_SETPOINT, help="PSU voltage setpoint (V)")
+    parser.add_argument("--poll", type=float, default=PSU_POLL_INTERVAL_SECONDS, help="PSU status poll interval (s)")
+    parser.add_argument("--ramp-interval", type=float, default=PROFILE_RAMP_INTERVAL_SECONDS, help="setpoint period in ramp steps (s)")
+    parser.add_argument("--serial-latency", type=float, default=SERIAL_LATENCY_SECONDS, help="round trip per serial command (s)")
+    parser.add_argument("--serial-jitter", type=float, default=SERIAL_JITTER, help="+- fraction of --serial-latency, per command")
+    parser.add_argument("--seed", type=int, help="for the jitter and the profile's start in the poll cycle (random by default)")
+    parser.add_argument("--cells", type=int, default=1)
+    parser.add_argument("--area", type=float, default=25.0, help="active area per cell (cm2)")
+    parser.add_argument("--temperature", type=float, default=60.0, help="stack temperature (C)")
+    parser.add_argument("--max-cell-voltage", type=float, default=MAX_CELL_VOLTAGE)
+    parser.add_argument("--min-load", type=float, default=MIN_LOAD_PCT, help="%% of --max-current")
+    parser.add_argument("--max-power", type=float, help="W")
+    parser.add_argument("--max-step", type=float, help="largest setpoint jump allowed (A)")
+    parser.add_argument("--check", action="store_true", help="exit code 1 if any limit is violated or setpoint lag p99 is over --max-lag")
+    parser.add_argument("--max-lag", type=float, default=200.0, help="ms, for --check")
+    parser.add_argument("--json", action="store_true", help="print the reports as JSON")
+    args = parser.parse_args()
+
+    runs = []
+    for path in args.profiles:
+        with open(path) as f:
+            runs.append((path, parse_rows(f)))
+    if args.demo or not runs:
+        runs.append(("demo: 24 h solar + wind", demo_profile()))
+
+    failed = False
+    reports = {}
+    for name, steps in runs:
+        model = ElectrolyserModel(cells=args.cells, area_cm2=args.area, temperature_c=args.temperature)
+        report = simulate(steps, model, max_current=args.max_current, voltage=args.voltage, poll_interval_s=args.poll,
+                          ramp_interval_s=args.ramp_interval, serial_latency_s=args.serial_latency,
+                          serial_jitter=args.serial_jitter, seed=args.seed,
+                          max_cell_voltage=args.max_cell_voltage, min_load_pct=args.min_load, max_power_w=args.max_power,
+                          max_step_a=args.max_step)
+        reports[name] = report
+        violations = {limit: value for limit, value in report["limits"].items() if value["events"]}
+        slow = report["setpoint_lag_ms"]["p99"] is not None and report["setpoint_lag_ms"]["p99"] > args.max_lag
+        failed = failed or bool(violations) or slow
+        if args.json:
+            continue
+        print(f"{name}: {report['steps']} steps, {report['profile_h']} h simulated in {report['wall_s']} s ({report['speedup']}x)")
+        print(f"  energy {report['energy_kwh']} kWh, {report['charge_ah']} Ah, H2 {report['h2_nl']} Nl, {report['kwh_per_nm3']} kWh/Nm3, peak {report['peak_power_w']} W")
+        print(f"  setpoint lag {report['setpoint_lag_ms']} ms (seed {report['seed']}, starting {report['phase_ms']} ms into a poll cycle), serial {report['serial']}")
+        print(f"  limits: {violations or 'none violated'}")
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    if args.check and failed:
+        sys.exit(1)
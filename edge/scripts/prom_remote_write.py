@@ -0,0 +1,416 @@
+# Prometheus remote_write sink for process telemetry (optional, used by all the edge scripts)
+# The readings that go to ThingsBoard (stack voltage/current, H2 flow, temperatures, ...) can also
+# be written straight into the cloud Prometheus (run with --web.enable-remote-write-receiver), so
+# long range Grafana queries hit its TSDB instead of ThingsBoard's Postgres.
+# Readings are flattened to one row per sample in a small SQLite (WAL) buffer and a background
+# thread sends them, oldest timestamp first, as snappy compressed protobuf WriteRequests of up to
+# max_samples samples. While the server is unreachable they wait on disk (within max_bytes).
+# The protobuf and snappy encoders are built in; python-snappy is used instead if installed.
+#
+# Try it without a server:
+#   python prom_remote_write.py --serve 9201                # stand-in receiver, prints what arrives
+#   python prom_remote_write.py --demo http://localhost:9201/api/v1/write
+import math
+import re
+import socket
+import sqlite3
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from edge_metrics import REGISTRY
+
+try:
+    import snappy as _snappy # python-snappy, much faster than the pure Python encoder below
+except ImportError:
+    _snappy = None
+
+ROW_OVERHEAD_BYTES = 40 # rough per-sample cost on top of the metric/device names, for the disk budget
+
+SEND_SECONDS = REGISTRY.histogram("edge_remote_write_seconds", "Time taken by one successful remote_write request")
+QUEUED_SAMPLES = REGISTRY.gauge("edge_remote_write_queued_samples", "Samples waiting in the remote_write buffer")
+
+
+# Snappy block format (https://github.com/google/snappy/blob/main/format_description.txt)
+def _varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _snappy_literal(out, data, start, end):
+    length = end - start
+    if not length:
+        return
+    n = length - 1
+    if n < 60:
+        out.append(n << 2)
+    else:
+        size = (n.bit_length() + 7) // 8
+        out.append((59 + size) << 2)
+        out += n.to_bytes(size, "little")
+    out += data[start:end]
+
+
+def snappy_compress(data):
+    if _snappy is not None:
+        return _snappy.compress(data)
+    data = bytes(data)
+    out = bytearray(_varint(len(data)))
+    table = {} # 4 byte sequence -> last position seen
+    n = len(data)
+    pos = literal_start = 0
+    while pos + 4 <= n:
+        key = data[pos:pos + 4]
+        candidate = table.get(key)
+        table[key] = pos
+        if candidate is None or pos - candidate > 0xFFFF:
+            pos += 1
+            continue
+        length = 4
+        while pos + length < n and data[candidate + length] == data[pos + length]:
+            length += 1
+        _snappy_literal(out, data, literal_start, pos)
+        offset = pos - candidate
+        remaining = length
+        while remaining:
+            chunk = min(remaining, 64) # copy with 2 byte offset: 1..64 bytes
+            out.append(((chunk - 1) << 2) | 2)
+            out += struct.pack("<H", offset)
+            remaining -= chunk
+        pos += length
+        literal_start = pos
+    _snappy_literal(out, data, literal_start, n)
+    return bytes(out)
+
+
+def snappy_decompress(data):
+    if _snappy is not None:
+        return _snappy.uncompress(data)
+    length, pos = _read_varint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            n = tag >> 2
+            if n >= 60:
+                size = n - 59
+                n = int.from_bytes(data[pos:pos + size], "little")
+                pos += size
+            n += 1
+            out += data[pos:pos + n]
+            pos += n
+            continue
+        if kind == 1:
+            n = 4 + ((tag >> 2) & 7)
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif kind == 2:
+            n = (tag >> 2) + 1
+            offset = struct.unpack_from("<H", data, pos)[0]
+            pos += 2
+        else:
+            n = (tag >> 2) + 1
+            offset = struct.unpack_from("<I", data, pos)[0]
+            pos += 4
+        start = len(out) - offset
+        for i in range(n): # byte by byte - copies may overlap their own output
+            out.append(out[start + i])
+    if len(out) != length:
+        raise ValueError("snappy: length mismatch")
+    return bytes(out)
+
+
+# Protobuf for prometheus.WriteRequest:
+#   WriteRequest { repeated TimeSeries timeseries = 1; }
+#   TimeSeries   { repeated Label labels = 1; repeated Sample samples = 2; }
+#   Label        { string name = 1; string value = 2; }
+#   Sample       { double value = 1; int64 timestamp = 2; }
+def _field(number, payload):
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def encode_write_request(series):
+    """series: [(labels dict incl. __name__, [(ts_ms, value), ...]), ...] -> WriteRequest bytes."""
+    out = bytearray()
+    for labels, samples in series:
+        body = bytearray()
+        for name in sorted(labels): # Prometheus wants labels sorted by name
+            body += _field(1, _field(1, name.encode()) + _field(2, str(labels[name]).encode()))
+        for ts, value in samples:
+            body += _field(2, b"\x09" + struct.pack("<d", value) + b"\x10" + _varint(ts))
+        out += _field(1, bytes(body))
+    return bytes(out)
+
+
+def _fields(data):
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        number, wire = key >> 3, key & 7
+        if wire == 2:
+            length, pos = _read_varint(data, pos)
+            yield number, data[pos:pos + length]
+            pos += length
+        elif wire == 1:
+            yield number, data[pos:pos + 8]
+            pos += 8
+        elif wire == 0:
+            value, pos = _read_varint(data, pos)
+            yield number, value
+        else:
+            raise ValueError(f"protobuf: unsupported wire type {wire}")
+
+
+def decode_write_request(data):
+    """The inverse of encode_write_request (for the stand-in receiver and checks)."""
+    series = []
+    for _, ts_bytes in _fields(data):
+        labels, samples = {}, []
+        for number, payload in _fields(ts_bytes):
+            fields = dict(_fields(payload))
+            if number == 1:
+                labels[fields[1].decode()] = fields.get(2, b"").decode()
+            else:
+                samples.append((fields.get(2, 0), struct.unpack("<d", fields[1])[0]))
+        series.append((labels, samples))
+    return series
+
+
+def metric_name(key, prefix):
+    return prefix + re.sub(r"[^a-zA-Z0-9_:]", "_", key)
+
+
+class RemoteWriteSink:
+    """Disk buffered remote_write client. A sink for TelemetryBatcher (put_many)."""
+
+    def __init__(self, url, path, labels=None, metric_prefix="pem_", max_samples=2000, max_bytes=50 * 1024 * 1024,
+                 batches_per_s=2.0, timeout_s=10.0, headers=None):
+        self.url = url
+        self.path = path
+        self.labels = dict(labels or {}) # added to every series, e.g. job/instance/script
+        self.labels.setdefault("instance", socket.gethostname())
+        self.metric_prefix = metric_prefix
+        self.max_samples = max_samples
+        self.max_bytes = max_bytes
+        self.min_batch_gap_s = 1.0 / batches_per_s if batches_per_s else 0.0
+        self.timeout_s = timeout_s
+        self.headers = dict(headers or {}) # e.g. {"Authorization": "Basic ..."} behind a reverse proxy
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL, metric TEXT NOT NULL, device TEXT, value REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts, id)")
+        rows, name_bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(metric) + COALESCE(LENGTH(device), 0)), 0) FROM samples").fetchone()
+        self._bytes = name_bytes + rows * ROW_OVERHEAD_BYTES
+
+        # Stats
+        self.queued = rows
+        self.sent = 0
+        self.requests = 0
+        self.rejected = 0 # samples the server refused (4xx) - dropped, retrying can't help
+        self.dropped = 0 # oldest samples dropped to stay inside max_bytes
+        self.last_request = {}
+        if rows:
+            print(f"Remote write buffer {path} has {rows} samples waiting from a previous run")
+        QUEUED_SAMPLES.labels().set_function(lambda: self.queued)
+
+    def put_many(self, records):
+        """Stores the numeric values of [(ts_ms, values), ...] (or (ts_ms, values, device)) as samples."""
+        rows = []
+        for record in records:
+            ts, values = record[0], record[1]
+            device = record[2] if len(record) > 2 else None
+            for key, value in values.items():
+                if isinstance(value, bool):
+                    value = float(value)
+                elif not isinstance(value, (int, float)) or not math.isfinite(value):
+                    continue # text/None/NaN readings only go to ThingsBoard
+                rows.append((ts, metric_name(key, self.metric_prefix), device, float(value)))
+        if not rows:
+            return
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT INTO samples (ts, metric, device, value) VALUES (?, ?, ?, ?)", rows)
+            self._bytes += sum(len(metric) + len(device or "") + ROW_OVERHEAD_BYTES for _, metric, device, _ in rows)
+            self.queued += len(rows)
+            if self._bytes > self.max_bytes:
+                self._enforce_budget()
+        self._wake.set()
+
+    def _enforce_budget(self):
+        # Drop the oldest samples (by timestamp) until we're back under 90% of the budget
+        target = self.max_bytes * 0.9
+        while self._bytes > target:
+            rows = self._db.execute("SELECT id, LENGTH(metric) + COALESCE(LENGTH(device), 0) FROM samples ORDER BY ts, id LIMIT 1000").fetchall()
+            if not rows:
+                self._bytes = 0
+                break
+            ids = []
+            for row_id, length in rows:
+                self._bytes -= length + ROW_OVERHEAD_BYTES
+                ids.append((row_id,))
+                if self._bytes <= target:
+                    break
+            self._db.executemany("DELETE FROM samples WHERE id = ?", ids)
+            self.queued -= len(ids)
+            self.dropped += len(ids)
+        print(f"Remote write buffer over its {self.max_bytes} byte budget, {self.dropped} oldest samples dropped so far")
+
+    def _next_batch(self):
+        with self._lock:
+            return self._db.execute("SELECT id, ts, metric, device, value FROM samples ORDER BY ts, id LIMIT ?", (self.max_samples,)).fetchall()
+
+    def _request_body(self, rows):
+        series = {}
+        for _, ts, metric, device, value in rows: # rows are in timestamp order, so every series is too
+            key = (metric, device)
+            if key not in series:
+                labels = dict(self.labels, __name__=metric)
+                if device is not None:
+                    labels["device"] = device
+                series[key] = (labels, [])
+            series[key][1].append((ts, value))
+        return snappy_compress(encode_write_request(series.values()))
+
+    def _send(self, rows):
+        """True if the batch is done with (sent or rejected), False to retry it later."""
+        body = self._request_body(rows)
+        request = urllib.request.Request(self.url, data=body, method="POST", headers=dict(self.headers, **{
+            "Content-Encoding": "snappy",
+            "Content-Type": "application/x-protobuf",
+            "X-Prometheus-Remote-Write-Version": "0.1.0",
+            "User-Agent": "pem-iot-edge",
+        }))
+        started = time.monotonic()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 429 or e.code >= 500:
+                return False
+            # e.g. 400 out of bounds/duplicate samples - the server will never take this batch
+            self.rejected += len(rows)
+            print(f"Remote write rejected {len(rows)} samples: HTTP {e.code} {e.read()[:200]!r}")
+        except (urllib.error.URLError, OSError):
+            return False
+        else:
+            self.sent += len(rows)
+            self.requests += 1
+            self.last_request = {"samples": len(rows), "bytes": len(body), "send_s": time.monotonic() - started}
+            SEND_SECONDS.observe(self.last_request["send_s"])
+        with self._lock:
+            self._db.executemany("DELETE FROM samples WHERE id = ?", [(row[0],) for row in rows])
+            self._bytes -= sum(len(row[2]) + len(row[3] or "") + ROW_OVERHEAD_BYTES for row in rows)
+            self.queued -= len(rows)
+        return True
+
+    def _drain_loop(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            self._wake.wait(1.0)
+            self._wake.clear()
+            while not self._stop.is_set():
+                rows = self._next_batch()
+                if not rows:
+                    break
+                started = time.monotonic()
+                try:
+                    done = self._send(rows)
+                except Exception as e:
+                    print(f"Error sending remote write batch: {e}")
+                    done = False
+                if not done:
+                    self._stop.wait(backoff) # server down - leave it on disk and back off
+                    backoff = min(backoff * 2, 60.0)
+                    continue
+                backoff = 1.0
+                self._stop.wait(max(0.0, self.min_batch_gap_s - (time.monotonic() - started)))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._drain_loop, name="remote-write", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            self._db.close()
+
+    def stats(self):
+        return {"queued": self.queued, "sent": self.sent, "requests": self.requests, "rejected": self.rejected, "dropped": self.dropped}
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    parser = argparse.ArgumentParser(description="Stand-in remote_write receiver / demo sender")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="run a receiver that decodes and prints requests")
+    parser.add_argument("--demo", metavar="URL", help="send a day of synthetic 1 s readings to URL")
+    parser.add_argument("--seconds", type=int, default=86400)
+    args = parser.parse_args()
+
+    if args.serve:
+        class Receiver(BaseHTTPRequestHandler):
+            def do_POST(self):
+                series = decode_write_request(snappy_decompress(self.rfile.read(int(self.headers["Content-Length"]))))
+                samples = sum(len(s) for _, s in series)
+                first = min(ts for _, s in series for ts, _ in s)
+                last = max(ts for _, s in series for ts, _ in s)
+                print(f"{len(series)} series, {samples} samples, {time.strftime('%H:%M:%S', time.localtime(first / 1000))}"
+                      f" .. {time.strftime('%H:%M:%S', time.localtime(last / 1000))}, e.g. {series[0][0]}")
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *a):
+                pass
+
+        print(f"Stand-in remote_write receiver on http://localhost:{args.serve}/api/v1/write")
+        ThreadingHTTPServer(("", args.serve), Receiver).serve_forever()
+
+    elif args.demo:
+        with tempfile.TemporaryDirectory() as tmp:
+            sink = RemoteWriteSink(args.demo, os.path.join(tmp, "rw.db"), labels={"job": "pem_demo"}, batches_per_s=0)
+            start_ms = int(time.time() * 1000) - args.seconds * 1000
+            records = [(start_ms + i * 1000, {"psu_voltage": 29.5 + math.sin(i / 600), "psu_current": 2.0 + (i % 7) / 10, "mode": "auto"})
+                       for i in range(args.seconds)]
+            started = time.perf_counter()
+            sink.put_many(records)
+            print(f"buffered {sink.queued} samples in {time.perf_counter() - started:.2f} s")
+            started = time.perf_counter()
+            sink.start()
+            while sink.queued and time.perf_counter() - started < 600:
+                time.sleep(0.2)
+            elapsed = time.perf_counter() - started
+            sink.close()
+            print(f"sent in {elapsed:.2f} s, stats: {sink.stats()}, last request: {sink.last_request}")
@@ -0,0 +1,267 @@
+# Control state for one KA3005P (used by KA3005P_controller.py)
+# Everything that used to be module globals in the controller script - mode, manual setpoint,
+# profile download/execution, setpoint latency - lives in a PsuController per power supply, so
+# one process can drive several electrolyser stacks. How a controller talks to ThingsBoard is
+# behind a small link object: DeviceLink for a single PSU connected as a normal TB device
+# (v1/devices/me/...), GatewayLink for one of several PSUs behind one TB gateway connection
+# (v1/gateway/...). Both share the process' MQTT client, telemetry batcher and outbox.
+import json
+import logging
+import threading
+import time
+
+import requests
+
+from profile_engine import ProfileEngine
+
+
+class DeviceLink:
+    """ThingsBoard device API: the MQTT client is authenticated as this device."""
+
+    def __init__(self, client, batcher):
+        self.client = client
+        self.batcher = batcher
+
+    def publish_attributes(self, attributes):
+        self.client.publish("v1/devices/me/attributes", json.dumps(attributes))
+
+    def rpc_reply(self, rpc_id, data):
+        self.client.publish(f"v1/devices/me/rpc/response/{rpc_id}", json.dumps(data))
+
+    def add_telemetry(self, values, ts=None, priority=False):
+        self.batcher.add(values, ts=ts, priority=priority)
+
+
+class GatewayLink:
+    """ThingsBoard gateway API: the MQTT client is the gateway, this is one device behind it."""
+
+    def __init__(self, client, batcher, device):
+        self.client = client
+        self.batcher = batcher
+        self.device = device
+
+    def publish_attributes(self, attributes):
+        self.client.publish("v1/gateway/attributes", json.dumps({self.device: attributes}))
+
+    def rpc_reply(self, rpc_id, data):
+        self.client.publish("v1/gateway/rpc", json.dumps({"device": self.device, "id": rpc_id, "data": data}))
+
+    def add_telemetry(self, values, ts=None, priority=False):
+        self.batcher.add(values, ts=ts, priority=priority, device=self.device)
+
+
+class PsuController:
+    """Manual/auto mode, dashboard setpoints and power profiles for one PSU."""
+
+    def __init__(self, name, worker, link, profile_loader, max_current, ramp_interval_s=0.1):
+        self.name = name
+        self.worker = worker # PsuWorker, or None if the PSU couldn't be opened
+        self.attached = time.monotonic() # when the current worker was attached
+        self.link = link
+        self.profile_loader = profile_loader
+        self.max_current = max_current
+        self.ramp_interval_s = ramp_interval_s
+
+        self.mode = "manual"
+        self.manual_current_pct = 0
+        self.profile_url = ""
+        self.profile_data = None # ProfileSteps of the last loaded profile
+        self.profile_status = "idle"
+        self.profile_thread = None
+        self.profile_engine = None
+
+    def attach(self, worker):
+        """Swaps in a (re)opened PSU worker. A running profile carries on with it from its current setpoint."""
+        self.worker = worker
+        self.attached = time.monotonic()
+        engine = self.profile_engine
+        if worker and engine and self.profile_thread and self.profile_thread.is_alive():
+            with engine._lock: # so a step written meanwhile isn't overwritten with the previous one
+                if not engine.cancelled and engine.current is not None:
+                    worker.set_current(engine.current) # the reopen left the output at 0 A
+        # (in manual mode the next sample() re-asserts the manual setpoint)
+
+    def _set_current(self, amps):
+        # Looks the worker up on every call: the PSU may have been reopened since the profile started
+        worker = self.worker
+        if worker:
+            worker.set_current(amps)
+
+    def _set_profile_status(self, status):
+        self.profile_status = status
+        self.link.publish_attributes({"profileStatus": status})
+
+    def apply_manual_current(self, received, rpc_id=None):
+        """Pushes the manual setpoint to the PSU now (not on the next main loop pass).
+
+        received is the time.monotonic() the MQTT message arrived. Once the serial write is done, the
+        MQTT receipt -> PSU latency is recorded as psu_setpointLatency_ms (and sent as the RPC reply).
+        """
+        target = (self.manual_current_pct / 100.0) * self.max_current
+
+        def on_written(amps, error=None):
+            if error is not None:
+                return # the worker retries the write and calls back again once the PSU holds the value
+            latency_ms = round((time.monotonic() - received) * 1000.0, 1)
+            self.link.add_telemetry({"psu_commandedCurrent": amps, "psu_setpointLatency_ms": latency_ms}, priority=True)
+            if rpc_id is not None:
+                self.link.rpc_reply(rpc_id, {"current": amps, "latency_ms": latency_ms})
+
+        if self.worker:
+            self.worker.set_current(target, on_written=on_written)
+        elif rpc_id is not None:
+            self.link.rpc_reply(rpc_id, {"error": "power supply not connected"})
+
+    def handle_rpc(self, rpc_id, method, params, received):
+        """RPC from the dashboard: setManualCurrentPct / setControllerMode, same handling as the shared attributes."""
+        if method == "setManualCurrentPct" and isinstance(params, (int, float)) and 0 <= params <= 100:
+            self.handle_attributes({"manualCurrentPct": params}, received, rpc_id)
+        elif method == "setControllerMode" and params in ("manual", "auto"):
+            self.handle_attributes({"controllerMode": params}, received, rpc_id)
+        else:
+            logging.warning(f"{self.name}: unsupported RPC request {method}({params})")
+            self.link.rpc_reply(rpc_id, {"error": f"unsupported request {method}({params})"})
+
+    def handle_attributes(self, attributes, received, rpc_id=None):
+        # Check for manual current change
+        if "manualCurrentPct" in attributes:
+            self.manual_current_pct = attributes["manualCurrentPct"]
+            if self.mode == "manual" and "controllerMode" not in attributes:
+                self.apply_manual_current(received, rpc_id)
+            elif rpc_id is not None:
+                self.link.rpc_reply(rpc_id, {"manualCurrentPct": self.manual_current_pct, "applied": False})
+
+        # Check for mode change (manual  or auto)
+        if "controllerMode" in attributes:
+            self.mode = attributes["controllerMode"]
+            logging.info(f"{self.name}: controller mode switched to: {self.mode}")
+
+            if self.mode == "manual":
+                if self.profile_thread and self.profile_thread.is_alive():
+                    logging.warning(f"{self.name}: automated profile cancelled due to mode switch.")
+                    if self.profile_engine:
+                        self.profile_engine.cancel() # no profile setpoint is written after this returns
+                    self._set_profile_status("idle")
+                self.apply_manual_current(received, rpc_id)
+            elif rpc_id is not None:
+                self.link.rpc_reply(rpc_id, {"controllerMode": self.mode})
+
+        # Check for power profile URL change
+        if "profileUrl" in attributes:
+            self.profile_url = attributes["profileUrl"]
+
+        # Check for new power profile trigger
+        if "newProfileReady" in attributes and attributes["newProfileReady"] == True:
+            if self.profile_url:
+                self.link.publish_attributes({"newProfileReady": False})
+
+                if self.profile_thread and self.profile_thread.is_alive():
+                    logging.warning(f"{self.name}: new profile request received, but a profile is already running.")
+                    return
+
+                self.profile_thread = threading.Thread(target=self.run_automated_profile, name=f"{self.name}-profile")
+                self.profile_thread.start()
+
+            else:
+                logging.warning(f"{self.name}: new profile flag set but URL is missing.")
+
+    def run_automated_profile(self):
+        if self.mode != "auto":
+            logging.warning(f"{self.name}: cannot start automated profile: controller not in 'auto' mode.")
+            self._set_profile_status("idle")
+            return
+
+        if not self.worker:
+            logging.error(f"{self.name}: cannot start automated profile: power supply not connected.")
+            self._set_profile_status("idle")
+            return
+
+        try:
+          # Stream and parse the power profile csv from the specified URL (or re-use the cached copy if it's unchanged)
+            self._set_profile_status("downloading")
+
+            if self.profile_data is not None:
+                self.profile_data.close()
+                self.profile_data = None
+            self.profile_data = self.profile_loader.load(self.profile_url)
+
+            logging.info(f"{self.name}: power profile loaded ({self.profile_data.source}): {len(self.profile_data)} steps, {self.profile_data.total_duration_s():.0f} s.")
+
+        except requests.exceptions.RequestException as e:
+            self._set_profile_status("download_error")
+            logging.error(f"{self.name}: error downloading profile from {self.profile_url}: {e}")
+            return
+        except Exception as e:
+            self._set_profile_status("parsing_error")
+            logging.error(f"{self.name}: error parsing profile data: {e}")
+            return
+
+        logging.info(f"{self.name}: automated profile execution started.")
+        self._set_profile_status("executing")
+
+      # run the power profile against absolute deadlines, so I/O latency doesn't add up into drift
+        def on_step(telemetry):
+            logging.info(f"{self.name}: profile step {telemetry['profile_step']}: {telemetry['psu_commandedCurrent']:.2f}A, started {telemetry['profile_timingError_ms']:.1f} ms late")
+            self.link.add_telemetry(telemetry)
+
+        self.profile_engine = ProfileEngine(self.profile_data, self._set_current, self.max_current,
+                                            ramp_interval_s=self.ramp_interval_s, on_step=on_step, name=f"{self.name}-profile")
+        if self.mode != "auto":
+            self.profile_engine.cancel() # switched to manual while downloading
+        try:
+            completed = self.profile_engine.run()
+        except Exception as e:
+            completed = False
+            logging.error(f"{self.name}: failed to run profile: {e}")
+
+        stats = self.profile_engine.stats()
+        self.link.add_telemetry({"profile_timingErrorMax_ms": stats["max_abs_error_ms"], "profile_timingErrorMean_ms": stats["mean_error_ms"]})
+        if completed:
+            logging.info(f"{self.name}: automated profile execution finished. Timing: {stats}")
+        else:
+            logging.info(f"{self.name}: automated profile execution interrupted by user. Timing: {stats}")
+        self._set_profile_status("idle")
+
+    def sample(self):
+        """One main loop pass: re-assert the manual setpoint and record telemetry from the latest poll."""
+        commanded_current = 0
+
+      # manually control PSU
+        if self.mode == "manual":
+            commanded_current = (self.manual_current_pct / 100.0) * self.max_current
+            if self.worker:
+                self.worker.set_current(commanded_current) # the worker skips the write if it hasn't changed
+
+        elif self.mode == "auto":
+            if self.worker:
+                commanded_current = self.worker.setpoint_current or 0.0
+
+      # publish the telemetry from the PSU reported values - the latest poll by the serial worker
+        status = self.worker.status if self.worker else None
+        if status:
+            voltage_v = status["voltage"]
+            current_a = status["current"]
+            power_w = voltage_v * current_a
+
+            telemetry = {
+                "psu_voltage": voltage_v,
+                "psu_current": current_a,
+                "psu_power": power_w,
+                "psu_commandedCurrent": commanded_current
+            }
+            self.link.add_telemetry(telemetry, ts=int(status["ts"] * 1000))
+        else:
+            telemetry = {
+                "psu_commandedCurrent": commanded_current
+            }
+            self.link.add_telemetry(telemetry)
+
+    def close(self):
+        if self.profile_engine:
+            self.profile_engine.cancel()
+        if self.worker:
+            self.worker.disable()
+            self.worker.close()
+            self.worker = None
+        if self.profile_data is not None and not (self.profile_thread and self.profile_thread.is_alive()):
+            self.profile_data.close()
@@ -0,0 +1,242 @@
+# Serial owner thread for the KA3005P (used by KA3005P_controller.py)
+# Only this worker thread ever talks to the serial port, so the profile thread, MQTT callbacks
+# and the main loop can't interleave commands. Setpoints are "latest value wins" slots: a write is
+# skipped if the value hasn't changed since it was last written, and several updates queued
+# while the port was busy collapse into one write. Status (voltage + current) is polled back to
+# back on the same thread and kept as a snapshot, so readers never touch the port.
+# Benchmark against the fake PSU:  python psu_worker.py --latency 0.05 --seconds 5
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from edge_metrics import REGISTRY
+from profile_engine import RealClock
+
+SERIAL_SECONDS = REGISTRY.histogram("edge_psu_serial_command_seconds", "Serial round trip of one PSU command", ["psu", "command"])
+SERIAL_ERRORS = REGISTRY.counter("edge_psu_serial_errors_total", "Failed PSU serial commands", ["psu"])
+
+
+class PsuWorker:
+    """Serialises all access to one PowerSupply through a single thread."""
+
+    def __init__(self, psu, poll_interval_s=0.25, on_status=None, name="psu", clock=None):
+        self.psu = psu
+        self.poll_interval_s = poll_interval_s
+        self.on_status = on_status # called on the worker thread with each status snapshot
+        self.name = name
+        self.clock = clock or RealClock # profile_sim.py runs _run() on a virtual one
+
+        self._lock = threading.Lock()
+        self._wake = self.clock.Event()
+        self._stop = self.clock.Event()
+        self._commands = queue.SimpleQueue() # ordered one-off commands (enable, disable, ...)
+        self._wanted = {} # setpoint name -> latest requested value
+        self._written = {} # setpoint name -> value last written to the PSU
+        self._callbacks = {} # setpoint name -> on_written callbacks waiting for the pending write
+        self._in_flight = None # (name, value) being written right now
+        self._thread = None
+        self.status = None # {"voltage": V, "current": A, "ts": time.time(), "mono": time.monotonic()}
+        self._serial_seconds = {command: SERIAL_SECONDS.labels(psu=name, command=command)
+                                for command in ("set_current", "set_voltage", "get_voltage", "get_current", "call")}
+        self._serial_errors = SERIAL_ERRORS.labels(psu=name)
+
+        # Stats
+        self.writes = 0
+        self.skipped_writes = 0 # unchanged or superseded before they reached the port
+        self.polls = 0
+        self.errors = 0
+
+    # Setpoints - cheap, never block on the serial port.
+    # on_written(value) is called once the PSU holds the value: on the worker thread right after the
+    # serial write, or straight away if it already did. A write superseded by a newer value calls
+    # back when the newer one is written. If a serial write fails it's also called with error=the
+    # exception (after every failed attempt); the value stays pending and is retried, and the callback
+    # stays registered, so it's still called with the value once the write goes through.
+    def set_current(self, amps, on_written=None):
+        self._set("current", round(float(amps), 3), on_written) # the KA3005P has 1 mA resolution
+
+    def set_voltage(self, volts, on_written=None):
+        self._set("voltage", round(float(volts), 2), on_written) # and 10 mV
+
+    def _set(self, name, value, on_written=None):
+        with self._lock:
+            pending = self._wanted.pop(name, None)
+            superseded = pending is not None
+            if superseded and self._in_flight != (name, pending):
+                self.skipped_writes += 1 # replaced before it reached the port
+            if self._written.get(name) == value:
+                if not superseded:
+                    self.skipped_writes += 1 # unchanged
+                callbacks = self._callbacks.pop(name, [])
+                if on_written:
+                    callbacks.append(on_written)
+            else:
+                self._wanted[name] = value
+                if on_written:
+                    self._callbacks.setdefault(name, []).append(on_written)
+                callbacks = None
+        if callbacks is None:
+            self._wake.set()
+        else:
+            self._notify(callbacks, value)
+
+    def _notify(self, callbacks, value, error=None):
+        for callback in callbacks:
+            try:
+                callback(value) if error is None else callback(value, error=error)
+            except Exception as e:
+                print(f"Error in {self.name} setpoint callback: {e}")
+
+    @property
+    def setpoint_current(self):
+        """The current setpoint most recently requested (whether or not it's been written yet)."""
+        with self._lock:
+            return self._wanted.get("current", self._written.get("current"))
+
+    def call(self, fn):
+        """Runs fn(psu) on the worker thread. Returns a Future with the result."""
+        future = Future()
+        self._commands.put((fn, future))
+        self._wake.set()
+        return future
+
+    def enable(self):
+        return self.call(lambda psu: psu.enable())
+
+    def disable(self):
+        # Drop any pending setpoint so it can't be written after the output goes off
+        with self._lock:
+            self._wanted.clear()
+            self._callbacks.clear()
+        return self.call(lambda psu: psu.disable())
+
+    def _apply_setpoints(self):
+        while True:
+            with self._lock:
+                if not self._wanted:
+                    return
+                # Left in _wanted until it's written, so a failed write is retried
+                name, value = next(iter(self._wanted.items()))
+                self._written.pop(name, None) # unknown until the write is done
+                self._in_flight = (name, value)
+            try:
+                with self._serial_seconds["set_" + name].time():
+                    setattr(self.psu, name, value)
+            except Exception as e:
+                with self._lock:
+                    self._in_flight = None
+                    # Left registered for the retry. The callbacks of a newer value arrived meanwhile wait for that one
+                    callbacks = list(self._callbacks.get(name, [])) if self._wanted.get(name) == value else []
+                self._notify(callbacks, value, error=e)
+                raise
+            with self._lock:
+                self._in_flight = None
+                self._written[name] = value
+                if self._wanted.get(name) == value:
+                    del self._wanted[name]
+                    callbacks = self._callbacks.pop(name, [])
+                else:
+                    callbacks = [] # superseded while writing, they're called back with the newer value
+            self.writes += 1
+            self._notify(callbacks, value)
+
+    def _poll(self):
+        with self._serial_seconds["get_voltage"].time():
+            voltage = self.psu.voltage
+        self._apply_setpoints() # a setpoint that arrived meanwhile doesn't wait for the second read
+        with self._serial_seconds["get_current"].time():
+            current = self.psu.current
+        self.status = {"voltage": voltage, "current": current, "ts": self.clock.time(), "mono": self.clock.monotonic()}
+        self.polls += 1
+        if self.on_status:
+            self.on_status(self.status)
+
+    def _run(self):
+        clock = self.clock
+        next_poll = clock.monotonic()
+        while not self._stop.is_set():
+            try:
+                # Setpoints first (so e.g. enable() never turns the output on with stale ones),
+                # then one-off commands in order, then status if it's due
+                self._apply_setpoints()
+                while True:
+                    try:
+                        fn, future = self._commands.get_nowait()
+                    except queue.Empty:
+                        break
+                    try:
+                        with self._serial_seconds["call"].time():
+                            result = fn(self.psu)
+                        future.set_result(result)
+                    except Exception as e:
+                        future.set_exception(e)
+                        raise
+                if self.poll_interval_s and clock.monotonic() >= next_poll:
+                    self._poll()
+                    next_poll = max(next_poll + self.poll_interval_s, clock.monotonic())
+            except Exception as e:
+                self.errors += 1
+                self._serial_errors.inc()
+                print(f"Error talking to {self.name}: {e}")
+                clock.wait(self._stop, 0.5) # don't spin on a dead port
+                if self._wanted:
+                    self._wake.set() # retry the setpoint that failed
+            wait = next_poll - clock.monotonic() if self.poll_interval_s else None
+            if wait is None or wait > 0:
+                clock.wait(self._wake, wait)
+            self._wake.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"{self.name}-serial", daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=5.0):
+        """Stops the worker once queued commands (e.g. disable) have run."""
+        done = self.call(lambda psu: None)
+        try:
+            done.result(timeout)
+        except Exception:
+            pass
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+
+    def stats(self):
+        return {"writes": self.writes, "skipped_writes": self.skipped_writes, "polls": self.polls, "errors": self.errors}
+
+
+if __name__ == "__main__":
+    import argparse
+    import random
+
+    from fake_ka3005p import FakePowerSupply
+
+    parser = argparse.ArgumentParser(description="Command throughput of PsuWorker against a fake KA3005P")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated serial round trip per command (s)")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--setpoint-rate", type=float, default=50.0, help="setpoint updates per second from producers")
+    args = parser.parse_args()
+
+    fake = FakePowerSupply(latency_s=args.latency)
+    worker = PsuWorker(fake, poll_interval_s=0.0001) # poll as fast as the port allows
+    worker.start()
+    worker.enable()
+    end = time.monotonic() + args.seconds
+    levels = [0.5, 1.0, 1.5, 2.0]
+    latencies = []
+    while time.monotonic() < end:
+        # Mostly repeats of the same value, like the main loop re-sending the manual setpoint
+        requested = time.monotonic()
+        if random.random() < 0.2:
+            worker.set_current(random.choice(levels), on_written=lambda amps, requested=requested: latencies.append(time.monotonic() - requested))
+        else:
+            worker.set_current(worker.setpoint_current or 0.0)
+        time.sleep(1.0 / args.setpoint_rate)
+    worker.close()
+    print(f"{fake.commands / args.seconds:.1f} serial commands/s ({fake.reads} reads, {fake.writes} writes, {fake.collisions} collisions)")
+    print(f"{worker.polls / args.seconds:.1f} status polls/s, stats: {worker.stats()}")
+    if latencies:
+        latencies.sort()
+        print(f"new setpoint -> written: median {1000 * latencies[len(latencies) // 2]:.1f} ms, max {1000 * latencies[-1]:.1f} ms")
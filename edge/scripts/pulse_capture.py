@@ -0,0 +1,250 @@
+# Reed switch edge capture for the MilliGascounter (used by gas_monitor.py)
+# lgpio alert callbacks give us the kernel's timestamp of every edge, so a busy Pi delaying the
+# Python callback doesn't change when a pulse is recorded as happening. The callback only queues
+# (level, tick) - debouncing and counting happen on a worker thread using those timestamps.
+# A simulated edge source is included so throughput can be checked without hardware:
+#   python pulse_capture.py --rate 50 --pulses 100000
+import queue
+import threading
+import time
+import random
+
+from edge_metrics import REGISTRY
+
+CALLBACK_SECONDS = REGISTRY.histogram("edge_pulse_callback_seconds", "Time spent in the pulse handler per debounced pulse")
+LAG_SECONDS = REGISTRY.histogram("edge_pulse_lag_seconds", "Delay from the kernel edge timestamp to the pulse being handled")
+
+FALLING = 0 # lgpio level values passed to alert callbacks
+RISING = 1
+WATCHDOG = 2
+
+
+class EdgeDebouncer:
+    """Turns raw (level, tick) edges into debounced pulses using the edge timestamps.
+
+    The reed switch pulls the pin LOW when it closes. A falling edge counts as a pulse only if the
+    line had been HIGH (open) for at least debounce_s before it, so contact bounce on closing and
+    opening is rejected without delaying the pulse timestamp.
+    """
+
+    def __init__(self, debounce_s=0.03, min_pulse_interval_s=0.2):
+        self.debounce_ns = int(debounce_s * 1e9)
+        self.min_pulse_interval_ns = int(min_pulse_interval_s * 1e9)
+        self._level = RISING # pulled up, so idle HIGH
+        self._level_since = None
+        self._last_pulse = None
+
+        self.edges = 0
+        self.pulses = 0
+        self.bounces = 0 # edges rejected as contact bounce
+        self.missed_edges = 0 # same level twice in a row, an edge was lost somewhere
+        self.suspicious = 0 # pulses closer together than the meter can physically produce
+
+    def feed(self, level, tick_ns):
+        """Feeds one edge. Returns the pulse timestamp in ns, or None if it wasn't a pulse."""
+        if level == WATCHDOG:
+            return None
+        self.edges += 1
+        if level == self._level:
+            self.missed_edges += 1
+        previous_since = self._level_since
+        was_high = self._level == RISING
+        self._level = level
+        self._level_since = tick_ns
+        if level != FALLING:
+            return None
+
+        if was_high and previous_since is not None and tick_ns - previous_since < self.debounce_ns:
+            self.bounces += 1
+            return None
+        if self._last_pulse is not None and tick_ns - self._last_pulse < self.min_pulse_interval_ns:
+            # Count it, but flag it - either a very high flow or noise on the line
+            self.suspicious += 1
+        self._last_pulse = tick_ns
+        self.pulses += 1
+        return tick_ns
+
+    def stats(self):
+        return {
+            "edges": self.edges,
+            "pulses": self.pulses,
+            "bounces": self.bounces,
+            "missed_edges": self.missed_edges,
+            "suspicious": self.suspicious,
+        }
+
+
+class LgpioEdgeSource:
+    """Edge source backed by lgpio alerts. Ticks are CLOCK_MONOTONIC ns, same clock as time.monotonic()."""
+
+    def __init__(self, gpio, chip=0, pull_up=True):
+        self.gpio = gpio
+        self.chip = chip # gpiochip0 on current Pi 5 kernels, gpiochip4 on older ones
+        self.pull_up = pull_up
+        self._handle = None
+        self._callback = None
+
+    def start(self, on_edge):
+        import lgpio # Only needed on the Pi
+        self._handle = lgpio.gpiochip_open(self.chip)
+        flags = lgpio.SET_PULL_UP if self.pull_up else 0
+        lgpio.gpio_claim_alert(self._handle, self.gpio, lgpio.BOTH_EDGES, flags)
+        self._callback = lgpio.callback(self._handle, self.gpio, lgpio.BOTH_EDGES, on_edge)
+
+    def stop(self):
+        import lgpio
+        if self._callback:
+            self._callback.cancel()
+            self._callback = None
+        if self._handle is not None:
+            lgpio.gpiochip_close(self._handle)
+            self._handle = None
+
+
+class SimulatedEdgeSource:
+    """Generates reed switch edges (with contact bounce) into the same callback lgpio would call.
+
+    With realtime=False edges are generated as fast as possible with synthetic ticks, which is
+    what you want for throughput testing.
+    """
+
+    def __init__(self, rate_hz, pulses, closure_s=0.1, bounce_edges=2, bounce_s=0.002, jitter=0.1, realtime=False, seed=None):
+        self.rate_hz = rate_hz
+        self.pulses = pulses
+        self.closure_s = min(closure_s, 0.5 / rate_hz) # the switch must open again before the next pulse
+        self.bounce_edges = bounce_edges
+        self.bounce_s = bounce_s
+        self.jitter = jitter
+        self.realtime = realtime
+        self._random = random.Random(seed)
+        self.generated = 0 # pulses sent so far, to compare with what was counted
+        self._stop = threading.Event()
+        self._thread = None
+        self.done = threading.Event()
+
+    def _bounce(self, on_edge, tick, settle_level):
+        # Contact bounce: a few short opposite/same level pairs, ending on settle_level
+        other = RISING if settle_level == FALLING else FALLING
+        step = int(self.bounce_s * 1e9 / (2 * self.bounce_edges + 1))
+        for _ in range(self.bounce_edges):
+            tick += step
+            on_edge(0, 0, other, tick)
+            tick += step
+            on_edge(0, 0, settle_level, tick)
+        return tick
+
+    def _run(self, on_edge):
+        period_ns = 1e9 / self.rate_hz
+        tick = time.monotonic_ns()
+        for _ in range(self.pulses):
+            if self._stop.is_set():
+                break
+            tick += int(period_ns * (1 + self._random.uniform(-self.jitter, self.jitter)))
+            if self.realtime:
+                delay = (tick - time.monotonic_ns()) / 1e9
+                if delay > 0:
+                    time.sleep(delay)
+            self.generated += 1
+            on_edge(0, 0, FALLING, tick)
+            self._bounce(on_edge, tick, FALLING)
+            opened = tick + int(self.closure_s * 1e9)
+            on_edge(0, 0, RISING, opened)
+            self._bounce(on_edge, opened, RISING)
+        self.done.set()
+
+    def start(self, on_edge):
+        self._thread = threading.Thread(target=self._run, args=(on_edge,), name="sim-edges", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+class PulseCapture:
+    """Queues edges from an edge source and debounces them on a worker thread.
+
+    on_pulse(ts) is called from the worker thread with the pulse time in seconds on the
+    time.monotonic() clock.
+    """
+
+    def __init__(self, source, on_pulse, debounce_s=0.03, min_pulse_interval_s=0.2):
+        self.source = source
+        self.on_pulse = on_pulse
+        self.debouncer = EdgeDebouncer(debounce_s, min_pulse_interval_s)
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self.max_queue_depth = 0
+        self.max_lag_s = 0.0 # worst delay between the kernel edge timestamp and us processing it
+
+    def _on_edge(self, chip, gpio, level, tick):
+        # Runs on lgpio's callback thread - keep it to a queue put
+        self._queue.put((level, tick, time.monotonic_ns()))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            depth = self._queue.qsize()
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+            level, tick, delivered_ns = item
+            pulse_ns = self.debouncer.feed(level, tick)
+            if pulse_ns is None:
+                continue
+            started = time.monotonic()
+            # A real edge is delivered after it happened, but the flat-out simulation's synthetic
+            # ticks run ahead of the clock - lag counts from whichever came first
+            lag = started - min(pulse_ns, delivered_ns) / 1e9
+            if lag > self.max_lag_s:
+                self.max_lag_s = lag
+            try:
+                self.on_pulse(pulse_ns / 1e9)
+            except Exception as e:
+                print(f"Error in pulse handler: {e}")
+            LAG_SECONDS.observe(lag)
+            CALLBACK_SECONDS.observe(time.monotonic() - started)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker, name="pulse-capture", daemon=True)
+        self._thread.start()
+        self.source.start(self._on_edge)
+
+    def close(self):
+        self.source.stop()
+        self._queue.put(None)
+        if self._thread:
+            self._thread.join()
+
+    def stats(self):
+        stats = self.debouncer.stats()
+        stats["queue_depth"] = self._queue.qsize()
+        stats["max_queue_depth"] = self.max_queue_depth
+        stats["max_lag_s"] = self.max_lag_s
+        return stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Throughput check of the pulse capture path using simulated edges")
+    parser.add_argument("--rate", type=float, default=50.0, help="pulses per second")
+    parser.add_argument("--pulses", type=int, default=100000)
+    parser.add_argument("--bounce-edges", type=int, default=2)
+    parser.add_argument("--realtime", action="store_true", help="pace edges in real time instead of flat out")
+    args = parser.parse_args()
+
+    received = []
+    source = SimulatedEdgeSource(args.rate, args.pulses, bounce_edges=args.bounce_edges, realtime=args.realtime, seed=1)
+    # Debounce has to be shorter than the time the switch spends open between pulses
+    capture = PulseCapture(source, received.append, debounce_s=min(0.03, 0.25 / args.rate), min_pulse_interval_s=0.5 / args.rate)
+    start = time.perf_counter()
+    capture.start()
+    source.done.wait()
+    capture.close()
+    elapsed = time.perf_counter() - start
+    stats = capture.stats()
+    print(f"{len(received)}/{args.pulses} pulses counted in {elapsed:.2f} s ({stats['edges'] / elapsed:.0f} edges/s)")
+    print(f"Stats: {stats}")
@@ -0,0 +1,196 @@
+# Crash-safe persistence for the gas counter total (used by gas_monitor.py)
+# Instead of rewriting gas_data.json on every reed switch pulse, pulses are counted in memory and
+# a small checksummed record is appended to a journal file in the background (group commit).
+# Every so often the journal is compacted into the snapshot file (gas_data.json) and truncated.
+# On startup the snapshot is loaded and any newer journal records are replayed on top of it.
+# A power cut can lose at most commit_interval_s seconds or max_pending pulses of counts.
+import os
+import json
+import struct
+import threading
+import zlib
+
+# Journal record: sequence number, cumulative volume (mL), crc32 of the first two fields
+RECORD = struct.Struct("<Qd")
+CRC = struct.Struct("<I")
+RECORD_SIZE = RECORD.size + CRC.size
+
+
+def _fsync_dir(path):
+    """fsync the directory holding path so a rename/create survives a power cut."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_json(path, data):
+    """Writes data to path via a temp file + rename, so readers never see a half written file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+
+class PulseJournal:
+    """Append-only journal + snapshot holding a cumulative total."""
+
+    def __init__(self, snapshot_path, journal_path, commit_interval_s=1.0, max_pending=50, compact_records=3600):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.commit_interval_s = commit_interval_s
+        self.max_pending = max_pending
+        self.compact_records = compact_records
+
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock() # only one commit/compact touches the files at a time
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._journal = None
+
+        self.total = 0.0
+        self._seq = 0 # sequence of the last change made in memory
+        self._committed_seq = 0 # sequence of the last record on disk
+        self._committed_total = 0.0
+        self._snapshot_seq = 0
+        self._pending = 0
+        self._journal_records = 0
+
+        # Stats, handy for the DEBUG output
+        self.commits = 0
+        self.compactions = 0
+        self.torn_tails = 0
+
+    def open(self):
+        """Loads the snapshot, replays the journal and returns the recovered total."""
+        self._load_snapshot()
+        self._replay_journal()
+        self._journal = open(self.journal_path, "ab")
+        return self.total
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            print("Data file not found. Starting with 0 volume.")
+            return
+        try:
+            with open(self.snapshot_path, "r") as f:
+                data = json.load(f)
+            self.total = float(data.get("cumulative_volume_ml", 0.0))
+            self._snapshot_seq = int(data.get("seq", 0)) # older gas_data.json files have no seq
+        except (IOError, ValueError) as e:
+            # Snapshots are only ever replaced by rename, so this should not happen. The journal
+            # may still hold the latest total, so carry on and replay it.
+            print(f"Error loading data from {self.snapshot_path}: {e}. Replaying journal only.")
+        self._seq = self._committed_seq = self._snapshot_seq
+        self._committed_total = self.total
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        good_bytes = 0
+        with open(self.journal_path, "rb") as f:
+            while True:
+                raw = f.read(RECORD_SIZE)
+                if len(raw) < RECORD_SIZE:
+                    break
+                body, (crc,) = raw[:RECORD.size], CRC.unpack(raw[RECORD.size:])
+                if zlib.crc32(body) != crc:
+                    break
+                seq, total = RECORD.unpack(body)
+                good_bytes += RECORD_SIZE
+                self._journal_records += 1
+                if seq > self._seq: # records older than the snapshot were already compacted
+                    self._seq = self._committed_seq = seq
+                    self.total = self._committed_total = total
+            torn = f.seek(0, os.SEEK_END) - good_bytes
+        if torn:
+            # A power cut mid-append leaves a partial/corrupt tail. Drop it so new records line up.
+            self.torn_tails += 1
+            print(f"Discarding {torn} bytes of torn journal tail in {self.journal_path}")
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(good_bytes)
+                os.fsync(f.fileno())
+
+    def add(self, amount):
+        """Adds to the total. Cheap enough to call from the GPIO callback - no disk I/O here."""
+        with self._lock:
+            self.total += amount
+            self._seq += 1
+            self._pending += 1
+            if self._pending >= self.max_pending:
+                self._wake.set()
+            return self.total
+
+    def commit(self):
+        """Appends one record for everything added since the last commit and fsyncs it."""
+        with self._io_lock:
+            with self._lock:
+                if self._seq == self._committed_seq or self._journal is None:
+                    return False
+                seq, total = self._seq, self.total
+                self._pending = 0
+            body = RECORD.pack(seq, total)
+            self._journal.write(body + CRC.pack(zlib.crc32(body)))
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._committed_seq, self._committed_total = seq, total
+            self._journal_records += 1
+            self.commits += 1
+            if self._journal_records >= self.compact_records:
+                self._compact_locked()
+            return True
+
+    def compact(self):
+        """Commits, then folds the journal into the snapshot file and truncates it."""
+        self.commit()
+        with self._io_lock:
+            if self._journal_records or self._committed_seq != self._snapshot_seq:
+                self._compact_locked()
+
+    def _compact_locked(self):
+        # The snapshot must match a committed sequence number, so use the committed total rather
+        # than self.total, which may already include pulses that arrived since the last record.
+        seq, total = self._committed_seq, self._committed_total
+        atomic_write_json(self.snapshot_path, {"cumulative_volume_ml": total, "seq": seq})
+        # If we crash before the truncate, replay skips records with seq <= snapshot seq.
+        self._journal.truncate(0)
+        self._journal.seek(0)
+        os.fsync(self._journal.fileno())
+        self._snapshot_seq = seq
+        self._journal_records = 0
+        self.compactions += 1
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.commit_interval_s)
+            self._wake.clear()
+            try:
+                self.commit()
+            except OSError as e:
+                print(f"Error committing pulse journal {self.journal_path}: {e}")
+
+    def start(self):
+        """Starts the background group commit thread."""
+        self._thread = threading.Thread(target=self._flush_loop, name="pulse-journal", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops the commit thread, compacts and closes the journal."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        if self._journal:
+            self.compact()
+            self._journal.close()
+            self._journal = None
@@ -0,0 +1,144 @@
+# Pulse timestamp ring buffer and flow rate estimator (used by gas_monitor.py)
+# Every reed switch pulse is stored as a monotonic timestamp in a fixed size array, so memory use
+# doesn't grow with the flow rate. The flow rate is then worked out from the intervals between
+# pulses rather than from how many pulses landed in a fixed bucket, which avoids the
+# 3.26 mL/30 s steps at low flow.
+import math
+import threading
+from array import array
+
+
+def percentile(sorted_values, pct):
+    """Linear interpolated percentile of an already sorted sequence."""
+    if not sorted_values:
+        return None
+    pos = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+class PulseRing:
+    """Fixed size ring buffer of pulse timestamps (seconds, time.monotonic() clock)."""
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._ts = array("d", bytes(8 * capacity))
+        self._head = 0 # index the next timestamp is written to
+        self._size = 0
+        self._lock = threading.Lock()
+        self.total_pulses = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, ts):
+        """Records one pulse. O(1), no allocation - safe to call from the GPIO callback."""
+        with self._lock:
+            self._ts[self._head] = ts
+            self._head = (self._head + 1) % self.capacity
+            if self._size < self.capacity:
+                self._size += 1
+            self.total_pulses += 1
+
+    def latest(self, n=None):
+        """Returns up to n of the most recent timestamps, oldest first."""
+        with self._lock:
+            return self._latest_locked(n)
+
+    def _latest_locked(self, n):
+        n = self._size if n is None else min(n, self._size)
+        start = (self._head - n) % self.capacity
+        if start + n <= self.capacity:
+            return self._ts[start:start + n]
+        return self._ts[start:] + self._ts[:self._head]
+
+    def since(self, t):
+        """Returns the timestamps >= t, oldest first."""
+        with self._lock:
+            n = 0
+            i = self._head
+            while n < self._size:
+                i = (i - 1) % self.capacity
+                if self._ts[i] < t:
+                    break
+                n += 1
+            return self._latest_locked(n)
+
+    def intervals(self, n=None):
+        """Returns the last n inter-pulse intervals in seconds, oldest first."""
+        ts = self.latest(None if n is None else n + 1)
+        return array("d", (b - a for a, b in zip(ts, ts[1:])))
+
+    def interval_stats(self, n=256):
+        """Percentiles and jitter of the last n inter-pulse intervals, or {} with fewer than 2 pulses."""
+        intervals = self.intervals(n)
+        if not intervals:
+            return {}
+        ordered = sorted(intervals)
+        mean = sum(intervals) / len(intervals)
+        stddev = math.sqrt(sum((x - mean) ** 2 for x in intervals) / len(intervals))
+        # Jitter: mean absolute difference between consecutive intervals
+        diffs = [abs(b - a) for a, b in zip(intervals, intervals[1:])]
+        return {
+            "count": len(intervals),
+            "mean_s": mean,
+            "stddev_s": stddev,
+            "p50_s": percentile(ordered, 50),
+            "p90_s": percentile(ordered, 90),
+            "p99_s": percentile(ordered, 99),
+            "min_s": ordered[0],
+            "max_s": ordered[-1],
+            "jitter_s": sum(diffs) / len(diffs) if diffs else 0.0,
+        }
+
+
+class FlowEstimator:
+    """Flow rate estimates (mL/min) from a PulseRing."""
+
+    def __init__(self, ring, volume_per_pulse_ml, window_s=30.0, ewma_tau_s=10.0):
+        self.ring = ring
+        self.volume_per_pulse_ml = volume_per_pulse_ml
+        self.window_s = window_s
+        self.ewma_tau_s = ewma_tau_s
+        self.ewma_ml_per_min = 0.0
+        self._last_update = None
+
+    def _rate(self, pulses, span_s, now, last_ts):
+        # (pulses - 1) intervals fit between the first and last pulse. Once no pulse has come for
+        # longer than the average interval, the flow must have dropped, so decay towards zero using
+        # the time since the last pulse instead of holding the old rate forever.
+        if pulses < 2 or span_s <= 0:
+            return 0.0
+        interval = span_s / (pulses - 1)
+        interval = max(interval, now - last_ts)
+        return self.volume_per_pulse_ml / interval * 60.0
+
+    def instantaneous(self, now):
+        """Rate from the last inter-pulse interval only. Responds within one pulse."""
+        ts = self.ring.latest(2)
+        if len(ts) < 2:
+            return 0.0
+        return self._rate(2, ts[1] - ts[0], now, ts[1])
+
+    def windowed(self, now, window_s=None):
+        """Rate from the pulses in the last window_s seconds, measured between the pulses.
+
+        At low flow (fewer than two pulses in the window) it falls back to the last two pulses,
+        so the reading stays stable rather than flicking between 0 and one pulse per window.
+        """
+        ts = self.ring.since(now - (window_s or self.window_s))
+        if len(ts) < 2:
+            return self.instantaneous(now)
+        return self._rate(len(ts), ts[-1] - ts[0], now, ts[-1])
+
+    def update(self, now):
+        """Advances the time-weighted EWMA. Call periodically (e.g. every second)."""
+        rate = self.instantaneous(now)
+        if self._last_update is None:
+            self.ewma_ml_per_min = rate
+        else:
+            alpha = 1.0 - math.exp(-(now - self._last_update) / self.ewma_tau_s)
+            self.ewma_ml_per_min += alpha * (rate - self.ewma_ml_per_min)
+        self._last_update = now
+        return self.ewma_ml_per_min
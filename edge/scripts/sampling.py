@@ -0,0 +1,158 @@
+# Multi-rate sampling with on-edge aggregation (used by sensors.py)
+# Each sensor is sampled at its own rate on its own thread (so a slow 1-Wire conversion can't hold
+# up the INA260), and every sample is folded into streaming min/max/mean/stddev for the current
+# publish window. Once per window the summary is published instead of the raw samples, which
+# captures e.g. stack current ripple without sending 50-100 messages a second over MQTT.
+import math
+import threading
+import time
+
+from edge_metrics import REGISTRY
+from telemetry_outbox import now_ms
+
+ALL_STATS = ("mean", "min", "max", "std")
+ABSENT_POLL_S = 0.05 # how often a task whose read_fn returns None (device not open) tries again
+
+OVERRUNS = REGISTRY.counter("edge_loop_overruns_total", "Sample slots skipped because a loop iteration ran late", ["loop"])
+
+
+class RunningStats:
+    """Streaming count/min/max/mean/stddev (Welford), O(1) per sample."""
+
+    __slots__ = ("count", "min", "max", "mean", "_m2", "last")
+
+    def __init__(self):
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.last = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.last = value
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / self.count) if self.count > 1 else 0.0
+
+
+class SensorTask:
+    """One sensor: a read function returning {key: value} (None while it isn't open), its period and what to publish."""
+
+    def __init__(self, name, read_fn, period_s, stats=ALL_STATS):
+        self.name = name
+        self.read_fn = read_fn
+        self.period_s = period_s
+        self.stats = stats # which aggregates to publish for this sensor's keys
+        self.samples = 0
+        self.errors = 0
+        self.overruns = 0 # reads that took so long we skipped one or more sample slots
+        self.read_time = RunningStats()
+        self._failing = False
+
+
+class WindowAggregator:
+    """Per-key RunningStats for the current publish window."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._window = {}
+
+    def add(self, task, values):
+        with self._lock:
+            for key, value in values.items():
+                entry = self._window.get(key)
+                if entry is None:
+                    entry = self._window[key] = (task, RunningStats())
+                entry[1].add(value)
+
+    def swap(self):
+        """Returns the finished window's summary as flat telemetry and starts a new window."""
+        with self._lock:
+            window, self._window = self._window, {}
+        summary = {}
+        for key, (task, stats) in window.items():
+            # The plain key carries the mean, so existing dashboards keep working
+            if "mean" in task.stats:
+                summary[key] = stats.mean
+            for stat in task.stats:
+                if stat != "mean":
+                    summary[f"{key}_{stat}"] = getattr(stats, stat)
+        return summary
+
+
+class SamplingScheduler:
+    """Runs each SensorTask on its own thread against absolute deadlines."""
+
+    def __init__(self, tasks, on_sample=None):
+        self.tasks = list(tasks)
+        self.aggregator = WindowAggregator()
+        self.on_sample = on_sample # called with (ts_ms, values) for every raw sample, e.g. HistoryStore.put
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _run_task(self, task):
+        next_due = time.monotonic()
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                values = task.read_fn()
+                if values is None:
+                    # Device not open (yet), see driver_registry.py - nothing to count, look again soon
+                    self._stop.wait(min(task.period_s, ABSENT_POLL_S))
+                    next_due = time.monotonic()
+                    continue
+                if values:
+                    self.aggregator.add(task, values)
+                    if self.on_sample is not None:
+                        self.on_sample(now_ms(), values)
+                task.samples += 1
+                if task._failing:
+                    print(f"{task.name} reading again")
+                    task._failing = False
+            except Exception as e:
+                task.errors += 1
+                if not task._failing: # don't flood the log at 50 Hz
+                    print(f"Error reading {task.name}: {e}")
+                    task._failing = True
+            end = time.monotonic()
+            task.read_time.add(end - start)
+
+            next_due += task.period_s
+            if next_due < end:
+                # Fell behind - skip the missed slots rather than bursting to catch up
+                missed = math.ceil((end - next_due) / task.period_s)
+                task.overruns += missed
+                OVERRUNS.labels(loop=task.name).inc(missed)
+                next_due += missed * task.period_s
+            self._stop.wait(next_due - end)
+
+    def start(self):
+        for task in self.tasks:
+            thread = threading.Thread(target=self._run_task, args=(task,), name=f"sample-{task.name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def summary(self):
+        """The aggregated window plus per-sensor sample counts/read times, then starts a new window."""
+        summary = self.aggregator.swap()
+        for task in self.tasks:
+            read_time, task.read_time = task.read_time, RunningStats()
+            if read_time.count:
+                summary[f"{task.name}_read_ms"] = round(read_time.mean * 1000, 2)
+                summary[f"{task.name}_samples"] = read_time.count
+        return summary
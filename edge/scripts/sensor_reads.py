@@ -0,0 +1,90 @@
+# Snapshot reads for the I2C sensors in sensors.py
+# Each physical register is read at most once per cycle and everything derived (mV, resistance)
+# is worked out from that snapshot, so the fields in one message come from the same instant and
+# the I2C bus sees as few transactions as possible. Every read is timed per sensor.
+import time
+from contextlib import contextmanager
+
+from edge_metrics import REGISTRY
+
+READ_SECONDS = REGISTRY.histogram("edge_sensor_read_seconds", "Time taken by one read of a sensor", ["sensor"])
+READ_ERRORS = REGISTRY.counter("edge_sensor_read_errors_total", "Failed sensor reads", ["sensor"])
+
+
+class ReadLatency:
+    """Per-sensor read counters: count, errors, last/max/total read time."""
+
+    def __init__(self):
+        self.sensors = {}
+        self._metrics = {} # name -> (read time histogram, error counter) children
+
+    @contextmanager
+    def timed(self, name):
+        stats = self.sensors.get(name)
+        if stats is None:
+            stats = self.sensors[name] = {"count": 0, "errors": 0, "last_s": 0.0, "max_s": 0.0, "total_s": 0.0}
+            self._metrics[name] = (READ_SECONDS.labels(sensor=name), READ_ERRORS.labels(sensor=name))
+        histogram, error_counter = self._metrics[name]
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            stats["errors"] += 1
+            error_counter.inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            histogram.observe(elapsed)
+            stats["count"] += 1
+            stats["last_s"] = elapsed
+            stats["total_s"] += elapsed
+            if elapsed > stats["max_s"]:
+                stats["max_s"] = elapsed
+
+    def mean_s(self, name):
+        stats = self.sensors.get(name)
+        if not stats or not stats["count"]:
+            return None
+        return stats["total_s"] / stats["count"]
+
+
+def read_ina260(ina260):
+    """One read each of the bus voltage, current and power registers."""
+    return {
+        "voltage_V": ina260.voltage,
+        "current_mA": ina260.current,
+        "power_mW": ina260.power,
+    }
+
+
+def ina260_fields(snapshot):
+    """Telemetry fields derived from one INA260 snapshot."""
+    voltage_v = snapshot["voltage_V"]
+    current_ma = snapshot["current_mA"]
+    fields = {
+        "voltage_mV": voltage_v * 1000,
+        "voltage_V": voltage_v,
+        "current_mA": current_ma,
+        "power_mW": snapshot["power_mW"],
+    }
+    if current_ma: # no resistance with the stack switched off
+        fields["resistance_ohm"] = (voltage_v * 1000) / current_ma
+    return fields
+
+
+def read_sht40(sht40):
+    """Temperature and humidity from a single SHT40 measurement."""
+    # .temperature and .relative_humidity each trigger their own measurement, .measurements does one
+    temperature, humidity = sht40.measurements
+    return {"sht40_temperature_C": temperature, "sht40_humidity_percent": humidity}
+
+
+def read_bmp280(bmp280):
+    """Pressure and temperature from one BMP280 read."""
+    # .pressure reads the temperature registers first to compensate, then the pressure registers.
+    # Reading .temperature as well would read the temperature registers a second time, so reuse
+    # the compensation value the driver keeps (the same maths .temperature does).
+    pressure = bmp280.pressure
+    t_fine = getattr(bmp280, "_t_fine", None)
+    temperature = t_fine / 5120.0 if t_fine is not None else bmp280.temperature
+    return {"bmp280_temperature_C": temperature, "pressure_hPa": pressure}
@@ -5,41 +5,110 @@ import adafruit_ina260
 import adafruit_sht4x
 import adafruit_bmp280
 import os
-import glob
 import time
 import json
 import paho.mqtt.client as mqtt
+from sensor_reads import ReadLatency, read_ina260, ina260_fields, read_sht40, read_bmp280
+from w1_bus import W1Bus, LEGACY_NAME
+from driver_registry import DriverRegistry
+from sampling import SamplingScheduler, SensorTask
+from telemetry_outbox import TelemetryOutbox
+from tb_batcher import TelemetryBatcher, TeeSink
+from telemetry_compression import TelemetryCompressor
+from prom_remote_write import RemoteWriteSink
+from derived_metrics import DerivedFeed
+from history_store import start_history
+from mqtt_uplink import UplinkClient
+from tb_protobuf import sensors_schema
+from edge_metrics import start_export
 
 # MQTT Config - in my case, TB Edge is in a docker onctonter on the Pi. This scritp runs on the host. 
 # MQTT port is availible from the host to the docker container - See README
 THINGSBOARD_EDGE_HOST = "localhost" # Set to your server
 THINGSBOARD_EDGE_PORT = 1883
 THINGSBOARD_EDGE_ACCESS_TOKEN = "f00000E00000W000000dE" # CHANGE THIS - get it from your ThingsBoard Edge Device
+# Readings are stored here first and sent when MQTT is up, so nothing is lost while the broker is down
+OUTBOX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sensors_outbox.db")
+OUTBOX_MAX_BYTES = 50 * 1024 * 1024 # Oldest readings are dropped beyond this
+# "protobuf" sends each reading as a compact protobuf message (see tb_protobuf.py) - the TB device profile
+# must then use Protobuf payloads with the schema from `python tb_protobuf.py --proto sensors --ds18b20 <names>`
+TELEMETRY_FORMAT = "json"
+# Set to the mqtt_uplink.py socket (e.g. "/tmp/pem_iot_uplink.sock") to share its MQTT connection
+# instead of opening one here. The uplink daemon then does the outbox/reconnect side.
+UPLINK_SOCKET = None
+# Window summaries are grouped into one timestamped MQTT message at most this often
+TB_BATCH_SECONDS = 30
+# Report by exception: a key is only sent to ThingsBoard when it can't be reconstructed within the given error
+# from what was already sent (see telemetry_compression.py), and at least every TELEMETRY_HEARTBEAT_SECONDS.
+# The first matching pattern wins. Keys not listed are sent every window. Set to {} to send everything.
+TELEMETRY_COMPRESSION = {
+    "*_samples": {"deadband": 0},
+    "*_read_ms": {"deadband_pct": 25},
+    "*_std": {"deadband_pct": 25},
+    "ds18b20_*": {"swinging_door": 0.05}, # degC - the probes resolve 0.0625
+    "*temperature_C*": {"swinging_door": 0.05}, # degC
+    "sht40_humidity_percent*": {"swinging_door": 0.5}, # %RH
+    "pressure_hPa*": {"swinging_door": 0.05}, # hPa
+    "voltage_*": {"swinging_door_pct": 0.5},
+    "current_mA*": {"swinging_door_pct": 0.5},
+    "power_mW*": {"swinging_door_pct": 0.5},
+    "resistance_ohm*": {"swinging_door_pct": 0.5},
+}
+TELEMETRY_HEARTBEAT_SECONDS = 300
+# Optional: also write the readings straight into the cloud Prometheus with remote_write, see prom_remote_write.py.
+# They're buffered on disk in REMOTE_WRITE_FILE while it can't be reached.
+REMOTE_WRITE_URL = None # e.g. "http://yourhost.net:9090/api/v1/write"
+REMOTE_WRITE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sensors_remote_write.db")
+# Set to derived_metrics.py's socket (e.g. "/tmp/pem_iot_derived.sock") to send it a copy of the readings for the
+# Faraday efficiency / kWh per Nm3 calculation. Nothing waits if the daemon isn't running.
+DERIVED_SOCKET = None
+# Local history of every raw sample (50 Hz INA260 included) for commissioning, queried over HTTP without
+# ThingsBoard or the WAN: raw 10 min, 1 s for 24 h, 1 min for 30 d, see history_store.py.
+HISTORY_PORT = None # e.g. 8765, then curl 'http://raspberrypi:8765/query?series=current_mA&start=-1h'
+HISTORY_DIR = None # None keeps it in memory only. "/dev/shm/pem_history/sensors" survives restarts, not reboots
+HISTORY_KEYS = ("*",) # Patterns of the keys kept, ~5.7 MB each once full (see the README)
+# This script's own performance metrics (read latency per sensor, loop overruns, MQTT publish latency,
+# queue depth), see edge_metrics.py. The textfile goes to node_exporter's textfile collector (see
+# the README). Set METRICS_PORT to also serve /metrics.
+METRICS_TEXTFILE = "/var/lib/node_exporter/textfile_collector/sensors.prom" # None to disable
+METRICS_PORT = None # e.g. 9101
 
 # Setup sensors
-# I2C Bus for INA260, SHT40, BMP280
-i2c = busio.I2C(board.SCL, board.SDA)
-ina260 = adafruit_ina260.INA260(i2c, address=0x40) #  CHANGE THIS - use `i2cdetect -y 1` to check address 
-sht40 = adafruit_sht4x.SHT4x(i2c)
-bmp280 = adafruit_bmp280.Adafruit_BMP280_I2C(i2c, address=0x76) # CHANGE THIS - use `i2cdetect -y 1` to check address 
+# Each device is opened in the background, in parallel, and publishing starts with whatever is ready.
+# A device that fails to open is retried with backoff, one that keeps failing reads is reopened,
+# see driver_registry.py. Until then its keys are just missing from the telemetry.
+DRIVER_OPEN_TIMEOUT_SECONDS = 2.0 # An open taking longer is logged (and counted) and the script carries on without it
 
-time.sleep(0.1) # Wait 100 milliseconds for sensors to settle - things weren't stable when this was added. might not need it. 
+# Read time per sensor
+read_latency = ReadLatency()
 
 # 1-Wire Setup for DS18B20s
-base_dir = '/sys/bus/w1/devices/'
-# Find all devices starting with '28-' (DS18B20 sensors) - (This might not be the best way to do this, but it's working.)
-device_folders = glob.glob(base_dir + '28*')
-# Assign friendly names based on the order found
-# IMPORTANT: The order of sensors in device_folders is not fixed.
-# If you need specific sensors tied to specific names,
-# you'll need to identify their full unique IDs (e.g., '28-00000xxxxx')
-# and map them manually. For now, we'll assign them as found.
-ds18b20_sensors = {}
-if len(device_folders) > 0:
-    ds18b20_sensors["ds18b20_temp_1"] = device_folders[0]
-#if len(device_folders) > 1:
-#    ds18b20_sensors["ds18b20_temp_2"] = device_folders[1]
-# Add more entries if you have more than 2 DS18B20s
+# Map each probe's unique ID to a name. List them with `ls /sys/bus/w1/devices/` (folders starting '28-').
+# Probes that aren't listed here are still published, as ds18b20_<id>, so they never swap names.
+# With the table empty and a single probe on the bus it's published as ds18b20_temp_1, like before.
+DS18B20_NAMES = {
+    # "28-00000xxxxx": "ds18b20_temp_1", # CHANGE THIS
+    # "28-00000yyyyy": "ds18b20_temp_2",
+}
+W1_RESCAN_SECONDS = 60 # Look for hot-plugged probes this often
+
+def settled(driver):
+    time.sleep(0.1) # Wait 100 milliseconds for sensors to settle - things weren't stable when this was added. might not need it.
+    return driver
+
+def open_w1_bus():
+    w1_bus = W1Bus(DS18B20_NAMES, rescan_s=W1_RESCAN_SECONDS)
+    w1_bus.scan()
+    return w1_bus
+
+drivers = DriverRegistry("sensors", timeout_s=DRIVER_OPEN_TIMEOUT_SECONDS)
+# I2C Bus for INA260, SHT40, BMP280
+drivers.add("i2c", lambda: busio.I2C(board.SCL, board.SDA), close_fn=lambda i2c: i2c.deinit())
+drivers.add("ina260", lambda i2c: settled(adafruit_ina260.INA260(i2c, address=0x40)), requires=["i2c"]) #  CHANGE THIS - use `i2cdetect -y 1` to check address
+drivers.add("sht40", lambda i2c: settled(adafruit_sht4x.SHT4x(i2c)), requires=["i2c"])
+drivers.add("bmp280", lambda i2c: settled(adafruit_bmp280.Adafruit_BMP280_I2C(i2c, address=0x76)), requires=["i2c"]) # CHANGE THIS - use `i2cdetect -y 1` to check address
+drivers.add("ds18b20", open_w1_bus, close_fn=lambda w1_bus: w1_bus.close())
+drivers.start()
 
 # MQTT Callbacks 
 def on_connect(client, userdata, flags, rc):
@@ -54,111 +123,151 @@ def on_disconnect(client, userdata, rc):
 def on_publish(client, userdata, mid):
     print(f"Message Published with MID: {mid}")
 
-# MQTT client setup
-client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
-client.username_pw_set(THINGSBOARD_EDGE_ACCESS_TOKEN)
-client.on_connect = on_connect
-client.on_disconnect = on_disconnect
-client.on_publish = on_publish
+outbox = None
+if UPLINK_SOCKET:
+    client = UplinkClient(UPLINK_SOCKET, THINGSBOARD_EDGE_ACCESS_TOKEN)
+    client.loop_start()
+    telemetry_sink = client
+    print(f"Publishing through the MQTT uplink at {UPLINK_SOCKET}")
+    if TELEMETRY_FORMAT == "protobuf":
+        print("TELEMETRY_FORMAT protobuf is ignored with UPLINK_SOCKET, the uplink daemon sends JSON")
+else:
+    # MQTT client setup
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    client.username_pw_set(THINGSBOARD_EDGE_ACCESS_TOKEN)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_publish = on_publish
 
-try:
-    print(f"Attempting to connect to ThingsBoard Edge at {THINGSBOARD_EDGE_HOST}:{THINGSBOARD_EDGE_PORT}...")
-    client.connect(THINGSBOARD_EDGE_HOST, THINGSBOARD_EDGE_PORT, 60)
-    client.loop_start() # Start a non-blocking loop for MQTT
-except Exception as e:
-    print(f"Error connecting to MQTT broker: {e}")
-    exit()
+    try:
+        print(f"Attempting to connect to ThingsBoard Edge at {THINGSBOARD_EDGE_HOST}:{THINGSBOARD_EDGE_PORT}...")
+        # connect_async: the loop keeps retrying if TB Edge isn't up yet. Readings wait in the outbox meanwhile.
+        client.connect_async(THINGSBOARD_EDGE_HOST, THINGSBOARD_EDGE_PORT, 60)
+        client.loop_start() # Start a non-blocking loop for MQTT
+    except Exception as e:
+        print(f"Error connecting to MQTT broker: {e}")
+        exit()
+
+    encoder = sensors_schema(DS18B20_NAMES or [LEGACY_NAME]) if TELEMETRY_FORMAT == "protobuf" else None
+    outbox = TelemetryOutbox(OUTBOX_FILE, client, max_bytes=OUTBOX_MAX_BYTES, encoder=encoder)
+    outbox.start()
+    telemetry_sink = outbox
+
+compressor = None
+if TELEMETRY_COMPRESSION: # only what goes to ThingsBoard, remote_write gets every reading
+    compressor = TelemetryCompressor(telemetry_sink, TELEMETRY_COMPRESSION, heartbeat_s=TELEMETRY_HEARTBEAT_SECONDS, name="sensors")
+    telemetry_sink = compressor
+
+remote_write = None
+if REMOTE_WRITE_URL:
+    remote_write = RemoteWriteSink(REMOTE_WRITE_URL, REMOTE_WRITE_FILE, labels={"job": "pem_edge", "script": "sensors"})
+    remote_write.start()
+    telemetry_sink = TeeSink(telemetry_sink, remote_write)
+
+derived_feed = None
+if DERIVED_SOCKET:
+    derived_feed = DerivedFeed(DERIVED_SOCKET, "sensors")
+    telemetry_sink = TeeSink(telemetry_sink, derived_feed)
+
+batcher = TelemetryBatcher(telemetry_sink, max_age_s=TB_BATCH_SECONDS, name="sensors")
+batcher.start()
+
+history, history_server = None, None
+if HISTORY_PORT or HISTORY_DIR:
+    history, history_server = start_history(HISTORY_DIR, HISTORY_PORT, keys=HISTORY_KEYS)
 
 # Funcs to read sensor data
 
-def read_ds18b20(device_folder):
-    if not device_folder:
+# Each sensor is read once per sample into a snapshot and the published fields are derived from
+# that, so e.g. resistance_ohm uses the same voltage/current as voltage_V and current_mA.
+
+def read_device(name, read):
+    """read(driver) timed and reported to the driver registry. None while the device isn't open."""
+    driver = drivers.get(name)
+    if driver is None:
         return None
-    device_file = device_folder + '/w1_slave'
     try:
-        with open(device_file, 'r') as f:
-            lines = f.readlines()
-
-        # The DS18B20 can sometimes return 'NO' or CRC errors, retry until 'YES'
-        retries = 5
-        for _ in range(retries):
-            if lines[0].strip()[-3:] == 'YES':
-                break
-            time.sleep(0.1) # Small delay before retrying read
-            with open(device_file, 'r') as f:
-                lines = f.readlines()
-        else: # If loop completes without break
-            print(f"Failed to get 'YES' from DS18B20 after {retries} retries: {device_file}")
-            return None
-
-        equals_pos = lines[1].find('t=')
-        if equals_pos != -1:
-            temp_string = lines[1][equals_pos+2:]
-            temp_c = float(temp_string) / 1000.0
-            return temp_c
+        with read_latency.timed(name):
+            values = read(driver)
     except Exception as e:
-        print(f"Error reading DS18B20 from {device_folder}: {e}")
-        return None
-    return None
-
-def collect_sensor_data():
-    data = {}
+        drivers.report_error(name, e) # reopened after enough failures in a row
+        raise
+    drivers.sampled(name)
+    return values
 
-    # INA260
-    try:
-        data["voltage_mV"] = ina260.voltage * 1000
-        data["voltage_V"] = ina260.voltage
-        data["current_mA"] = ina260.current
-        data["power_mW"] = ina260.power
-        data["resistance_ohm"] = (ina260.voltage * 1000) / ina260.current
-    
-    except Exception as e:
-        print(f"Error reading INA260: {e}")
+def sample_ina260():
+    snapshot = read_device("ina260", read_ina260)
+    return None if snapshot is None else ina260_fields(snapshot)
 
-    # SHT40 (part of ENV IV)
-    try:
-        data["sht40_temperature_C"] = sht40.temperature
-        data["sht40_humidity_percent"] = sht40.relative_humidity
-    except Exception as e:
-        print(f"Error reading SHT40: {e}")
+def sample_sht40(): # (part of ENV IV)
+    return read_device("sht40", read_sht40)
 
-    # BMP280 (part of ENV IV)
-    try:
-        data["bmp280_temperature_C"] = bmp280.temperature
-        data["pressure_hPa"] = bmp280.pressure
-        # You can calculate altitude if needed, but it requires a known sea-level pressure
-        # data["altitude_m"] = bmp280.altitude
-    except Exception as e:
-        print(f"Error reading BMP280: {e}")
+def sample_bmp280(): # (part of ENV IV)
+    # You can calculate altitude if needed (bmp280.altitude), but it requires a known sea-level pressure
+    return read_device("bmp280", read_bmp280)
 
-    # DS18B20s
-    for name, folder in ds18b20_sensors.items():
-        temp = read_ds18b20(folder)
-        if temp is not None:
-            data[name] = temp
+def sample_ds18b20(): # one bulk conversion for the whole bus, then every probe read at once
+    return read_device("ds18b20", lambda w1_bus: w1_bus.read_all())
 
-    return data
+# Sampling - each sensor has its own rate. Samples are aggregated (mean/min/max/std) over
+# PUBLISH_INTERVAL_SECONDS and one summary is published per window.
+# The plain key (e.g. current_mA) is the window mean; current_mA_min, current_mA_max, current_mA_std go alongside.
+PUBLISH_INTERVAL_SECONDS = 5
+FIRST_WINDOW_MAX_WAIT_SECONDS = 1.0
+scheduler = SamplingScheduler([
+    SensorTask("ina260", sample_ina260, period_s=0.02), # 50 Hz - catches stack current ripple
+    SensorTask("sht40", sample_sht40, period_s=1.0),
+    SensorTask("bmp280", sample_bmp280, period_s=1.0),
+    SensorTask("ds18b20", sample_ds18b20, period_s=5.0, stats=("mean",)), # water temp moves slowly
+], on_sample=history.put if history else None)
 
 # Main loop
+metrics = start_export("sensors", textfile=METRICS_TEXTFILE, port=METRICS_PORT)
 try:
+    scheduler.start()
+    next_publish = time.monotonic() + PUBLISH_INTERVAL_SECONDS
+    # After a restart the first (short) window goes out as soon as every device has been read once, or
+    # FIRST_WINDOW_MAX_WAIT_SECONDS in with the ones that have, rather than a full window (and TB batch) later
+    drivers.wait_all_sampled(FIRST_WINDOW_MAX_WAIT_SECONDS)
+    first_window = True
     while True:
-        sensor_readings = collect_sensor_data()
+        if not first_window:
+            time.sleep(max(0.0, next_publish - time.monotonic()))
+            next_publish += PUBLISH_INTERVAL_SECONDS
+        sensor_readings = scheduler.summary()
 
         if sensor_readings:
-            json_payload = json.dumps(sensor_readings)
-            print(f"Publishing: {json_payload}")
-            client.publish("v1/devices/me/telemetry", json_payload, qos=1)
+            print(f"Publishing: {json.dumps(sensor_readings)}")
+            batcher.add(sensor_readings)
+            if first_window:
+                batcher.flush("first window")
         else:
             print("No sensor data collected.")
-
-        time.sleep(5) # Publish every 5 seconds
+        first_window = False
 
 except KeyboardInterrupt:
     print("Script terminated by user.")
 except Exception as e:
     print(f"An unexpected error occurred: {e}")
 finally:
+    scheduler.stop()
+    metrics.close()
+    batcher.close()
+    if compressor:
+        compressor.close() # sends the points it's still holding
+        print(f"Telemetry compression: {compressor.stats()}")
+    if outbox:
+        outbox.close()
+    if remote_write:
+        remote_write.close()
+    if derived_feed:
+        derived_feed.close()
+    if history_server:
+        history_server.close()
+    if history:
+        history.close()
     client.loop_stop()
     client.disconnect()
+    drivers.close()
     print("MQTT client disconnected.")
     print("Exiting.")
@@ -0,0 +1,623 @@
+# Simulated hardware for running the edge scripts on any Linux box (no Pi, sensors, PSU or broker)
+# install() puts stand-ins for the hardware and MQTT modules into sys.modules, so sensors.py,
+# gas_monitor.py and KA3005P_controller.py run unmodified:
+#   board/busio + adafruit_ina260/_sht4x/_bmp280  I2C sensors sharing one bus with a per-transfer latency
+#   W1_DEVICES_DIR                                a FakeW1Tree with drifting DS18B20 probes
+#   lgpio                                         SimulatedEdgeSource reed switch pulses (with bounce) in real time
+#   ka3005p                                       FakePowerSupply with its serial round trip
+#   paho.mqtt.client                              clients of an in-process SimBroker that records every publish
+# The benchmark runs each script in its own process for a while under the simulation and reports
+# loop throughput, latency percentiles, missed pulses and the CPU/memory the process used:
+#   python sim_hardware.py --seconds 30
+#   python sim_hardware.py --seconds 30 --scripts KA3005P_controller.py --serial-latency 0.05
+#   python sim_hardware.py --seconds 10 --scripts sensors.py --absent bmp280=3   (a sensor that only answers after 3 s)
+# (CPU and memory include the simulated devices, which cost little next to the scripts.)
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import types
+from types import SimpleNamespace
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# I2C sensors
+class SimI2C:
+    """busio.I2C: one bus, one transfer at a time, each taking latency_s."""
+
+    def __init__(self, scl=None, sda=None, latency_s=0.0003):
+        self.latency_s = latency_s
+        self._lock = threading.Lock()
+        self.transfers = 0
+
+    def transfer(self, count=1):
+        with self._lock:
+            self.transfers += count
+            if self.latency_s:
+                time.sleep(self.latency_s * count)
+
+    def deinit(self):
+        pass
+
+
+class SimINA260:
+    """adafruit_ina260.INA260 on a stack drawing ~2 A with some ripple."""
+
+    def __init__(self, i2c, address=0x40):
+        self.i2c = i2c
+        self._random = random.Random(address)
+
+    def _current_a(self):
+        return 2.0 + 0.05 * math.sin(time.monotonic() * 2 * math.pi * 5) + self._random.gauss(0, 0.002)
+
+    @property
+    def voltage(self):
+        self.i2c.transfer()
+        return 3.6 + 0.2 * (self._current_a() - 2.0)
+
+    @property
+    def current(self):
+        self.i2c.transfer()
+        return self._current_a() * 1000.0
+
+    @property
+    def power(self):
+        self.i2c.transfer()
+        return 3.6 * self._current_a() * 1000.0
+
+
+class SimSHT4x:
+    """adafruit_sht4x.SHT4x: one command, ~8.3 ms high repeatability measurement, one read."""
+
+    measurement_s = 0.0083
+
+    def __init__(self, i2c, address=0x44):
+        self.i2c = i2c
+        self._random = random.Random(address)
+
+    @property
+    def measurements(self):
+        self.i2c.transfer()
+        time.sleep(self.measurement_s)
+        self.i2c.transfer()
+        return 21.0 + self._random.gauss(0, 0.02), 45.0 + self._random.gauss(0, 0.1)
+
+    @property
+    def temperature(self):
+        return self.measurements[0]
+
+    @property
+    def relative_humidity(self):
+        return self.measurements[1]
+
+
+class SimBMP280:
+    """adafruit_bmp280.Adafruit_BMP280_I2C: .pressure reads the temperature registers first (sets _t_fine)."""
+
+    def __init__(self, i2c, address=0x77):
+        self.i2c = i2c
+        self._random = random.Random(address)
+        self._t_fine = None
+
+    @property
+    def temperature(self):
+        self.i2c.transfer()
+        self._t_fine = (21.5 + self._random.gauss(0, 0.01)) * 5120.0
+        return self._t_fine / 5120.0
+
+    @property
+    def pressure(self):
+        self.temperature
+        self.i2c.transfer()
+        return 1013.0 + self._random.gauss(0, 0.01)
+
+
+# Reed switch (lgpio)
+class _SimLgpio:
+    """The lgpio calls LgpioEdgeSource makes. callback() starts a real time SimulatedEdgeSource."""
+
+    SET_PULL_UP = 32
+    BOTH_EDGES = 3
+
+    def __init__(self, rate_hz, bounce_edges=2):
+        self.rate_hz = rate_hz
+        self.bounce_edges = bounce_edges
+        self.sources = []
+
+    def gpiochip_open(self, chip):
+        return chip
+
+    def gpiochip_close(self, handle):
+        pass
+
+    def gpio_claim_alert(self, handle, gpio, edge, flags=0):
+        pass
+
+    def callback(self, handle, gpio, edge, func):
+        from pulse_capture import SimulatedEdgeSource
+
+        source = SimulatedEdgeSource(self.rate_hz, 10 ** 9, bounce_edges=self.bounce_edges, realtime=True, seed=gpio)
+        source.start(func)
+        self.sources.append(source)
+        return SimpleNamespace(cancel=source.stop)
+
+    @property
+    def generated(self):
+        return sum(source.generated for source in self.sources)
+
+
+# MQTT
+def topic_matches(pattern, topic):
+    pattern_parts, topic_parts = pattern.split("/"), topic.split("/")
+    for i, part in enumerate(pattern_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts) or (part != "+" and part != topic_parts[i]):
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+class SimBroker:
+    """In-process stand-in for TB Edge's MQTT broker. Records every publish with its arrival time."""
+
+    def __init__(self, latency_s=0.001):
+        self.latency_s = latency_s # one way, client <-> broker
+        self.messages = [] # (monotonic, wall ms, client_id, topic, payload)
+        self.hooks = [] # fn(topic, payload, arrived) called on every publish
+        self._subscriptions = [] # (client, pattern)
+        self._lock = threading.Lock()
+
+    def receive(self, client, topic, payload):
+        arrived = time.monotonic()
+        with self._lock:
+            self.messages.append((arrived, time.time() * 1000.0, client.client_id, topic, payload))
+            hooks = list(self.hooks)
+        for hook in hooks:
+            hook(topic, payload, arrived)
+
+    def subscribe(self, client, pattern):
+        with self._lock:
+            self._subscriptions.append((client, pattern))
+
+    def subscribed(self, topic):
+        with self._lock:
+            return any(topic_matches(pattern, topic) for _, pattern in self._subscriptions)
+
+    def inject(self, topic, payload):
+        """Sends a message to the subscribed clients, like the server side of TB would."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        with self._lock:
+            clients = [client for client, pattern in self._subscriptions if topic_matches(pattern, topic)]
+        for client in clients:
+            client._deliver(topic, payload)
+
+
+class _MessageInfo:
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = 0
+        self._published = threading.Event()
+
+    def wait_for_publish(self, timeout=None):
+        self._published.wait(timeout)
+
+    def is_published(self):
+        return self._published.is_set()
+
+
+class SimMqttClient:
+    """paho.mqtt.client.Client, enough of it for the scripts, connected to a SimBroker."""
+
+    broker = None # set by install()
+
+    def __init__(self, callback_api_version=None, client_id="", *args, **kwargs):
+        self.callback_api_version = callback_api_version or CallbackAPIVersion.VERSION1
+        self.client_id = client_id or f"sim-{id(self):x}"
+        self.on_connect = self.on_disconnect = self.on_message = self.on_publish = None
+        self._connected = False
+        self._mid = 0
+        self._lock = threading.Lock()
+        self._outgoing = []
+        self._wake = threading.Condition(self._lock)
+        self._stop = False
+        self._thread = None
+
+    def username_pw_set(self, username, password=None):
+        self.username = username
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def max_queued_messages_set(self, count):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60):
+        self._connect()
+        return 0
+
+    def connect_async(self, host, port=1883, keepalive=60):
+        self._connect_pending = True
+
+    def _connect(self):
+        time.sleep(self.broker.latency_s * 2)
+        self._connected = True
+        if self.on_connect:
+            if self.callback_api_version == CallbackAPIVersion.VERSION2:
+                self.on_connect(self, None, {}, 0, None)
+            else:
+                self.on_connect(self, None, {}, 0)
+
+    def _loop(self):
+        if getattr(self, "_connect_pending", False):
+            self._connect()
+        while True:
+            with self._lock:
+                while not self._outgoing and not self._stop:
+                    self._wake.wait()
+                if self._stop and not self._outgoing:
+                    return
+                topic, payload, info = self._outgoing.pop(0)
+            time.sleep(self.broker.latency_s)
+            self.broker.receive(self, topic, payload)
+            time.sleep(self.broker.latency_s) # the PUBACK coming back
+            info._published.set()
+            if self.on_publish:
+                if self.callback_api_version == CallbackAPIVersion.VERSION2:
+                    self.on_publish(self, None, info.mid, 0, None)
+                else:
+                    self.on_publish(self, None, info.mid)
+
+    def loop_start(self):
+        self._thread = threading.Thread(target=self._loop, name=f"sim-mqtt-{self.client_id}", daemon=True)
+        self._thread.start()
+
+    def loop_stop(self):
+        with self._lock:
+            self._stop = True
+            self._wake.notify()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+
+    def disconnect(self):
+        self._connected = False
+
+    def is_connected(self):
+        return self._connected
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self._lock:
+            self._mid += 1
+            info = _MessageInfo(self._mid)
+            self._outgoing.append((topic, payload.encode("utf-8") if isinstance(payload, str) else payload, info))
+            self._wake.notify()
+        return info
+
+    def subscribe(self, topic, qos=0):
+        self.broker.subscribe(self, topic)
+        return 0, 0
+
+    def _deliver(self, topic, payload):
+        if self.on_message:
+            threading.Thread(target=self.on_message, args=(self, None, SimpleNamespace(topic=topic, payload=payload)),
+                             daemon=True).start()
+
+
+class CallbackAPIVersion:
+    VERSION1 = 1
+    VERSION2 = 2
+
+
+def _absent_until(factory, name, until):
+    """factory, except that opening the device fails until the monotonic time until."""
+    def open_device(*args, **kwargs):
+        if time.monotonic() < until:
+            raise OSError(f"{name} not responding (simulated)")
+        return factory(*args, **kwargs)
+    return open_device
+
+
+def install(bus_latency_s=0.0003, serial_latency_s=0.05, mqtt_latency_s=0.001, pulse_rate_hz=2.0, ds18b20_probes=3, w1_dir=None,
+            absent=None):
+    """Registers the simulated modules. Call before importing/running a script. Returns the sim objects.
+
+    absent: {"ina260" / "sht40" / "bmp280" / "psu": seconds} devices that fail to open for that long.
+    """
+    from fake_ka3005p import FakePowerSupply
+
+    modules = {}
+    i2c = SimI2C(latency_s=bus_latency_s)
+    modules["board"] = types.ModuleType("board")
+    modules["board"].SCL, modules["board"].SDA = 3, 2
+    modules["busio"] = types.ModuleType("busio")
+    modules["busio"].I2C = lambda scl, sda, **kwargs: i2c
+    modules["adafruit_ina260"] = types.ModuleType("adafruit_ina260")
+    modules["adafruit_ina260"].INA260 = SimINA260
+    modules["adafruit_sht4x"] = types.ModuleType("adafruit_sht4x")
+    modules["adafruit_sht4x"].SHT4x = SimSHT4x
+    modules["adafruit_bmp280"] = types.ModuleType("adafruit_bmp280")
+    modules["adafruit_bmp280"].Adafruit_BMP280_I2C = SimBMP280
+
+    lgpio = _SimLgpio(pulse_rate_hz)
+    modules["lgpio"] = types.ModuleType("lgpio")
+    for name in ("SET_PULL_UP", "BOTH_EDGES", "gpiochip_open", "gpiochip_close", "gpio_claim_alert", "callback"):
+        setattr(modules["lgpio"], name, getattr(lgpio, name))
+
+    psus = []
+
+    def power_supply(port, *args, **kwargs):
+        psu = FakePowerSupply(port, latency_s=serial_latency_s)
+        psus.append(psu)
+        return psu
+
+    modules["ka3005p"] = types.ModuleType("ka3005p")
+    modules["ka3005p"].PowerSupply = power_supply
+
+    constructors = {"ina260": (modules["adafruit_ina260"], "INA260"), "sht40": (modules["adafruit_sht4x"], "SHT4x"),
+                    "bmp280": (modules["adafruit_bmp280"], "Adafruit_BMP280_I2C"), "psu": (modules["ka3005p"], "PowerSupply")}
+    for name, seconds in (absent or {}).items():
+        module, attr = constructors[name]
+        setattr(module, attr, _absent_until(getattr(module, attr), name, time.monotonic() + seconds))
+
+    broker = SimBroker(latency_s=mqtt_latency_s)
+    SimMqttClient.broker = broker
+    client_module = types.ModuleType("paho.mqtt.client")
+    client_module.Client = SimMqttClient
+    client_module.CallbackAPIVersion = CallbackAPIVersion
+    client_module.MQTTMessageInfo = _MessageInfo
+    modules["paho"] = types.ModuleType("paho")
+    modules["paho.mqtt"] = types.ModuleType("paho.mqtt")
+    modules["paho"].mqtt = modules["paho.mqtt"]
+    modules["paho.mqtt"].client = client_module
+    modules["paho.mqtt.client"] = client_module
+    sys.modules.update(modules)
+
+    w1_tree = None
+    if w1_dir:
+        if "w1_bus" in sys.modules:
+            raise RuntimeError("install() has to run before w1_bus is imported (it reads W1_DEVICES_DIR once)")
+        os.environ["W1_DEVICES_DIR"] = w1_dir
+        from w1_bus import FakeW1Tree
+
+        w1_tree = FakeW1Tree(w1_dir)
+        for i in range(ds18b20_probes):
+            w1_tree.add_probe(f"28-00000000{i:04x}", 18.0 + i)
+    return SimpleNamespace(i2c=i2c, lgpio=lgpio, psus=psus, broker=broker, w1_tree=w1_tree)
+
+
+# Benchmark
+def _override_config(source, overrides):
+    """Replaces single line NAME = value config assignments at the top level of a script."""
+    for name, value in overrides.items():
+        pattern = re.compile(rf"^{re.escape(name)} = [^\n]*$", re.MULTILINE)
+        if not pattern.search(source):
+            raise ValueError(f"no single line '{name} = ...' in the script")
+        source = pattern.sub(lambda m: f"{name} = {value!r} # sim_hardware override", source, count=1)
+    return source
+
+
+BENCH_OVERRIDES = { # shorter batching so a short run shows end to end latency; nothing written to /var/lib
+    "sensors.py": {"TB_BATCH_SECONDS": 5, "METRICS_TEXTFILE": None},
+    "gas_monitor.py": {"MQTT_PUBLISH_INTERVAL_SECONDS": 5, "TELEMETRY_SAMPLE_INTERVAL_SECONDS": 1, "METRICS_TEXTFILE": None},
+    "KA3005P_controller.py": {"TB_BATCH_SECONDS": 2, "METRICS_TEXTFILE": None},
+}
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"n": len(values), "p50": round(pick(0.5), 4), "p90": round(pick(0.9), 4), "p99": round(pick(0.99), 4), "max": round(values[-1], 4)}
+
+
+def _histograms(name):
+    """{label values: (count, sum, p50 upper bound, p99 upper bound)} for an edge_metrics histogram."""
+    from edge_metrics import REGISTRY
+
+    metric = REGISTRY._metrics.get(name)
+    if metric is None:
+        return {}
+    out = {}
+    for key, child in list(metric._children.items()):
+        counts = list(child.counts)
+        total = sum(counts)
+        if not total:
+            continue
+        bounds = child.buckets + (math.inf,)
+
+        def bound(q):
+            cumulative = 0
+            for upper, count in zip(bounds, counts):
+                cumulative += count
+                if cumulative >= q * total:
+                    return upper
+            return math.inf
+
+        out["/".join(key) or name] = {"count": total, "mean": round(child.sum / total, 6), "p50_le": bound(0.5), "p99_le": bound(0.99)}
+    return out
+
+
+def _counter(name):
+    from edge_metrics import REGISTRY
+
+    metric = REGISTRY._metrics.get(name)
+    return {"/".join(key) or name: child.value for key, child in metric._children.items()} if metric else {}
+
+
+def _telemetry_latency(messages, telemetry_topic="v1/devices/me/telemetry"):
+    """Capture time (the record's ts) -> arrival at the broker, for every JSON telemetry record."""
+    latencies, records, payload_bytes = [], 0, 0
+    for _, arrived_ms, _, topic, payload in messages:
+        if topic != telemetry_topic:
+            continue
+        payload_bytes += len(payload)
+        try:
+            body = json.loads(payload)
+        except ValueError:
+            continue # protobuf
+        for entry in body if isinstance(body, list) else [body]:
+            records += 1
+            latencies.append((arrived_ms - entry["ts"]) / 1000.0)
+    return records, payload_bytes, _percentiles(latencies)
+
+
+def run_child(script, seconds, args):
+    """Runs script under the simulation for seconds, then Ctrl+C. Prints one SIM_RESULT json line."""
+    import resource
+    import signal
+    import tempfile
+
+    workdir = tempfile.mkdtemp(prefix="pem_sim_")
+    sim = install(bus_latency_s=args.bus_latency, serial_latency_s=args.serial_latency, mqtt_latency_s=args.mqtt_latency,
+                  pulse_rate_hz=args.pulse_rate, w1_dir=os.path.join(workdir, "w1"),
+                  absent={name: float(seconds) for name, seconds in (entry.split("=") for entry in args.absent)})
+    path = os.path.join(SCRIPT_DIR, script)
+    with open(path) as f:
+        source = _override_config(f.read(), BENCH_OVERRIDES.get(script, {}))
+    code = compile(source, path, "exec")
+    script_globals = {"__name__": "__main__", "__file__": os.path.join(workdir, script)} # data files go to workdir
+
+    rpc_latencies = []
+    stop = threading.Event()
+
+    def drift_probes():
+        while not stop.wait(1.0):
+            for i, rom_id in enumerate(sorted(os.listdir(sim.w1_tree.base_dir))):
+                if rom_id.startswith("28-"):
+                    sim.w1_tree.set_temperature(rom_id, 18.0 + i + 0.5 * math.sin(time.monotonic() / 60.0))
+
+    def dashboard_rpcs():
+        # setManualCurrentPct every 0.5 s, timed until the PSU has it and the reply is back
+        request_topic = "v1/devices/me/rpc/request/+"
+        while not stop.is_set() and not sim.broker.subscribed(request_topic.replace("+", "0")):
+            stop.wait(0.05)
+        pending = {}
+
+        def on_publish(topic, payload, arrived):
+            if topic.startswith("v1/devices/me/rpc/response/"):
+                sent = pending.pop(topic.rsplit("/", 1)[1], None)
+                if sent is not None:
+                    rpc_latencies.append(arrived - sent)
+
+        sim.broker.hooks.append(on_publish)
+        request_id = 0
+        while not stop.wait(0.5):
+            request_id += 1
+            pending[str(request_id)] = time.monotonic()
+            sim.broker.inject(f"v1/devices/me/rpc/request/{request_id}", json.dumps({"method": "setManualCurrentPct", "params": request_id % 100}))
+
+    threading.Thread(target=drift_probes, daemon=True).start()
+    if script == "KA3005P_controller.py":
+        threading.Thread(target=dashboard_rpcs, daemon=True).start()
+    threading.Timer(seconds, lambda: os.kill(os.getpid(), signal.SIGINT)).start()
+
+    sys.path.insert(0, SCRIPT_DIR)
+    started = time.monotonic()
+    try:
+        exec(code, script_globals)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    wall = time.monotonic() - started
+    stop.set()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    records, payload_bytes, telemetry_latency = _telemetry_latency(sim.broker.messages)
+    from driver_registry import process_age_s
+
+    process_start_ms = (time.time() - process_age_s()) * 1000.0
+    first_telemetry = min((arrived_ms for _, arrived_ms, _, topic, _ in sim.broker.messages if topic.endswith("/telemetry")), default=None)
+    result = {
+        "script": script,
+        "wall_s": round(wall, 2),
+        "cpu_pct": round(100.0 * (usage.ru_utime + usage.ru_stime) / wall, 1),
+        "max_rss_mb": round(usage.ru_maxrss / 1024.0, 1),
+        "mqtt_messages": len(sim.broker.messages),
+        "telemetry_records": records,
+        "telemetry_bytes": payload_bytes,
+        "telemetry_latency_s": telemetry_latency,
+        "loop_overruns": _counter("edge_loop_overruns_total"),
+        "first_telemetry_s": round((first_telemetry - process_start_ms) / 1000.0, 3) if first_telemetry else None,
+    }
+    first_samples = _counter("edge_time_to_first_sample_seconds")
+    if first_samples:
+        result["time_to_first_sample_s"] = {device: round(seconds, 3) for device, seconds in first_samples.items()}
+    if script == "sensors.py":
+        reads = _histograms("edge_sensor_read_seconds")
+        result["reads_per_s"] = {sensor: round(h["count"] / wall, 1) for sensor, h in reads.items()}
+        result["read_seconds"] = reads
+        result["i2c_transfers_per_s"] = round(sim.i2c.transfers / wall, 1)
+    elif script == "gas_monitor.py":
+        counted = script_globals["cumulative_volume_ml"] / script_globals["VOLUME_PER_PULSE_ML"]
+        generated = sim.lgpio.generated
+        result["pulses_generated"] = generated
+        result["pulses_counted"] = round(counted)
+        result["missed_pulse_rate"] = round(1.0 - counted / generated, 4) if generated else None
+        result["pulse_lag_s"] = _histograms("edge_pulse_lag_seconds")
+        result["tick_seconds"] = _histograms("edge_loop_seconds")
+    elif script == "KA3005P_controller.py":
+        serial = _histograms("edge_psu_serial_command_seconds")
+        result["serial_commands_per_s"] = round(sum(psu.commands for psu in sim.psus) / wall, 1)
+        result["serial_collisions"] = sum(psu.collisions for psu in sim.psus)
+        result["serial_seconds"] = serial
+        result["rpc_to_psu_reply_s"] = _percentiles(rpc_latencies)
+    print("SIM_RESULT " + json.dumps(result), flush=True)
+    os._exit(0) # gas_monitor's timer threads would keep the process alive
+
+
+if __name__ == "__main__":
+    import argparse
+    import subprocess
+
+    parser = argparse.ArgumentParser(description="Run the edge scripts against simulated hardware and report their performance")
+    parser.add_argument("--scripts", nargs="+", default=["sensors.py", "gas_monitor.py", "KA3005P_controller.py"])
+    parser.add_argument("--seconds", type=float, default=30.0, help="run time per script")
+    parser.add_argument("--bus-latency", type=float, default=0.0003, help="I2C transfer time (s)")
+    parser.add_argument("--serial-latency", type=float, default=0.05, help="KA3005P command round trip (s)")
+    parser.add_argument("--mqtt-latency", type=float, default=0.001, help="one way client <-> broker (s)")
+    parser.add_argument("--pulse-rate", type=float, default=2.0, help="reed switch pulses per second")
+    parser.add_argument("--absent", nargs="*", default=[], metavar="DEVICE=SECONDS",
+                        help="devices (ina260, sht40, bmp280, psu) that fail to open for the first SECONDS")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--json", action="store_true", help="print the raw results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the scripts' own output")
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.seconds, args)
+
+    passthrough = ["--seconds", str(args.seconds), "--bus-latency", str(args.bus_latency), "--serial-latency", str(args.serial_latency),
+                   "--mqtt-latency", str(args.mqtt_latency), "--pulse-rate", str(args.pulse_rate), "--absent"] + args.absent
+    results = []
+    for script in args.scripts:
+        print(f"Running {script} for {args.seconds:g} s on simulated hardware...", flush=True)
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", script] + passthrough,
+                               capture_output=True, text=True, cwd=SCRIPT_DIR)
+        lines = [line for line in child.stdout.splitlines() if line.startswith("SIM_RESULT ")]
+        if args.verbose or not lines:
+            print(child.stdout[-5000:], child.stderr[-5000:])
+        if not lines:
+            print(f"  {script} didn't produce a result (exit code {child.returncode})")
+            continue
+        result = json.loads(lines[-1][len("SIM_RESULT "):])
+        results.append(result)
+        if args.json:
+            continue
+        print(f"  cpu {result['cpu_pct']} %, max rss {result['max_rss_mb']} MB, {result['mqtt_messages']} MQTT messages, "
+              f"{result['telemetry_records']} telemetry records ({result['telemetry_bytes']} bytes)")
+        print(f"  capture -> broker latency (s): {result['telemetry_latency_s']}")
+        print(f"  process start -> first telemetry at the broker: {result['first_telemetry_s']} s")
+        if result["loop_overruns"]:
+            print(f"  loop overruns: {result['loop_overruns']}")
+        for key in ("reads_per_s", "i2c_transfers_per_s", "read_seconds", "pulses_generated", "pulses_counted", "missed_pulse_rate",
+                    "pulse_lag_s", "tick_seconds", "serial_commands_per_s", "serial_collisions", "serial_seconds", "rpc_to_psu_reply_s",
+                    "time_to_first_sample_s"):
+            if key in result:
+                print(f"  {key}: {result[key]}")
+    if args.json:
+        print(json.dumps(results, indent=2))
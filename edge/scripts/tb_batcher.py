@@ -0,0 +1,118 @@
+# Batching of timestamped ThingsBoard telemetry (used by all the edge scripts)
+# Samples are buffered with the time they were captured and handed to the sink (normally the
+# TelemetryOutbox) as one group, which goes out as a single ThingsBoard array payload
+# [{"ts": ..., "values": {...}}, ...]. So sampling faster no longer means publishing faster:
+# a flush happens when the buffer is full, when the oldest sample reaches max_age_s, or straight
+# away for a priority sample (e.g. a setpoint change you want on the dashboard now).
+import threading
+import time
+
+from edge_metrics import REGISTRY
+from telemetry_outbox import now_ms
+
+BUFFERED_SAMPLES = REGISTRY.gauge("edge_batcher_buffered_samples", "Telemetry samples waiting in memory for the next batch", ["batcher"])
+
+
+class TelemetryBatcher:
+    """Buffers (ts, values) samples and flushes them to sink.put_many() by size, age or priority."""
+
+    def __init__(self, sink, max_records=100, max_age_s=10.0, name="telemetry", tap=None):
+        self.sink = sink
+        self.tap = tap # gets every sample as it's added rather than batched, e.g. a HistoryStore
+        self.max_records = max_records
+        self.max_age_s = max_age_s
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._oldest = None # monotonic time the oldest buffered sample was added
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Per-flush stats
+        self.flushes = 0
+        self.records = 0
+        self.last_flush = {}
+        BUFFERED_SAMPLES.labels(batcher=name).set_function(lambda: len(self._buffer))
+
+    def add(self, values, ts=None, priority=False, device=None):
+        """Buffers one sample. ts is the capture time in ms (defaults to now).
+
+        device names the ThingsBoard device for a gateway sink (TelemetryOutbox(gateway=True)).
+        """
+        with self._lock:
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            ts = ts if ts is not None else now_ms()
+            self._buffer.append((ts, values) if device is None else (ts, values, device))
+            full = len(self._buffer) >= self.max_records
+        if self.tap is not None:
+            self.tap.put(ts, values, device)
+        if full or priority:
+            self.flush(reason="priority" if priority else "size")
+        else:
+            self._wake.set()
+
+    def flush(self, reason="manual"):
+        """Hands everything buffered to the sink. Returns the number of samples flushed."""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+            oldest, self._oldest = self._oldest, None
+        if not batch:
+            return 0
+        started = time.monotonic()
+        self.sink.put_many(batch)
+        self.flushes += 1
+        self.records += len(batch)
+        self.last_flush = {
+            "records": len(batch),
+            "reason": reason,
+            "age_s": started - oldest, # how long the oldest sample waited in the buffer
+            "flush_s": time.monotonic() - started,
+        }
+        print(f"DEBUG: {self.name} batch of {len(batch)} samples flushed ({reason}), oldest waited {self.last_flush['age_s']:.1f} s")
+        return len(batch)
+
+    def _age_loop(self):
+        while not self._stop.is_set():
+            with self._lock:
+                oldest = self._oldest
+            if oldest is None:
+                self._wake.wait(self.max_age_s)
+                self._wake.clear()
+                continue
+            wait = oldest + self.max_age_s - time.monotonic()
+            if wait > 0:
+                self._stop.wait(wait)
+                continue
+            try:
+                self.flush(reason="age")
+            except Exception as e:
+                print(f"Error flushing {self.name} batch: {e}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._age_loop, name=f"{self.name}-batcher", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops the age timer and flushes what's left."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        self.flush(reason="close")
+
+
+class TeeSink:
+    """Hands every batch to several sinks, e.g. the MQTT outbox and a RemoteWriteSink."""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def put_many(self, records):
+        for sink in self.sinks:
+            try:
+                sink.put_many(records)
+            except Exception as e:
+                print(f"Error handing telemetry to {type(sink).__name__}: {e}") # one failing sink mustn't starve the others
@@ -0,0 +1,265 @@
+# Protobuf telemetry for ThingsBoard device profiles (optional, used by all the edge scripts)
+# A ThingsBoard device profile with MQTT transport can take Protobuf payloads instead of JSON:
+# the profile holds a .proto schema and TB turns every message back into {"ts": ..., "values": {...}}.
+# The values are then field numbers plus raw doubles/varints instead of repeated key names and
+# decimal text. Each script has a schema here (field numbers are fixed - only ever append new
+# keys, never renumber or reuse one), and this module prints the .proto to paste into the profile:
+#   python tb_protobuf.py --proto sensors --ds18b20 ds18b20_temp_1,ds18b20_temp_2
+#   python tb_protobuf.py --proto gas_monitor
+#   python tb_protobuf.py --proto ka3005p
+# TB parses one message per MQTT publish, so a protobuf outbox sends one publish per record rather
+# than one JSON array per batch. Records with a key the schema doesn't know (a new DS18B20, a key
+# added to a script but not to its schema yet) go out as JSON, which TB accepts when the profile
+# has "Enable compatibility with other payload formats" ticked.
+# Benchmark (bytes on the wire and encode CPU against JSON):  python tb_protobuf.py --bench
+import math
+import struct
+
+from prom_remote_write import _fields, _read_varint, _varint
+
+# 64 bit two's complement for negative int64 varints
+_INT64_WRAP = 1 << 64
+_DOUBLE = struct.Struct("<d")
+
+
+def _window_fields(first, keys, stats=("min", "max", "std")):
+    """sampling.py window summary keys: key, then key_<stat> for each stat, numbered from first."""
+    fields = []
+    for key in keys:
+        for suffix in ("",) + tuple(f"_{stat}" for stat in stats):
+            fields.append((first + len(fields), key + suffix, "double"))
+    return fields
+
+
+def _read_time_fields(first, tasks):
+    fields = []
+    for task in tasks:
+        fields.append((first + len(fields), f"{task}_read_ms", "double"))
+        fields.append((first + len(fields), f"{task}_samples", "int64"))
+    return fields
+
+
+class TelemetrySchema:
+    """One script's telemetry keys with their protobuf field numbers and types (double, int64, bool)."""
+
+    def __init__(self, message, fields):
+        self.message = message
+        self.fields = sorted(fields)
+        self._encoders = {}
+        self._names = {}
+        for number, key, kind in self.fields:
+            if kind not in ("double", "int64", "bool"):
+                raise ValueError(f"{key}: unsupported type {kind}")
+            if key in self._encoders or number in self._names or not 1 <= number < 19000:
+                raise ValueError(f"{key}: duplicate key or bad field number {number}")
+            wire = 1 if kind == "double" else 0
+            self._encoders[key] = (_varint(number << 3 | wire), kind)
+            self._names[number] = (key, kind)
+
+    def encode(self, ts, values):
+        """Telemetry message bytes for one record, or None if a key/value doesn't fit the schema.
+
+        Layout: ts = 1 (int64), values = 2 (the nested Values message with the schema's fields).
+        """
+        body = bytearray()
+        encoders = self._encoders
+        for key, value in values.items():
+            spec = encoders.get(key)
+            if spec is None or value is None:
+                return None
+            tag, kind = spec
+            if kind == "double":
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    return None
+                body += tag
+                body += _DOUBLE.pack(value)
+            elif kind == "int64":
+                if isinstance(value, float):
+                    if not value.is_integer():
+                        return None
+                    value = int(value)
+                elif not isinstance(value, int):
+                    return None
+                body += tag
+                body += _varint(value % _INT64_WRAP if value < 0 else value)
+            else:
+                if not isinstance(value, (bool, int)):
+                    return None
+                body += tag
+                body += b"\x01" if value else b"\x00"
+        return b"\x08" + _varint(ts) + b"\x12" + _varint(len(body)) + bytes(body)
+
+    def decode(self, data):
+        """The inverse of encode: (ts, values). For checks and the benchmark - TB does this server side."""
+        ts, values = 0, {}
+        for number, payload in _fields(data):
+            if number == 1:
+                ts = payload
+            elif number == 2:
+                pos = 0
+                while pos < len(payload):
+                    key, pos = _read_varint(payload, pos)
+                    name, kind = self._names[key >> 3]
+                    if kind == "double":
+                        values[name] = _DOUBLE.unpack_from(payload, pos)[0]
+                        pos += 8
+                    else:
+                        value, pos = _read_varint(payload, pos)
+                        if kind == "int64":
+                            values[name] = value - _INT64_WRAP if value >= 1 << 63 else value
+                        else:
+                            values[name] = bool(value)
+        return ts, values
+
+    def proto(self, package="pem_edge"):
+        """The .proto text for the device profile's "Telemetry proto schema"."""
+        lines = [
+            'syntax = "proto3";',
+            f"package {package};",
+            "",
+            f"message {self.message} {{",
+            "  optional int64 ts = 1;",
+            "  Values values = 2;",
+            "",
+            "  message Values {",
+        ]
+        # optional: a reading of exactly 0 is still sent (and shows on the dashboard)
+        lines += [f"    optional {kind} {key} = {number};" for number, key, kind in self.fields]
+        lines += ["  }", "}", ""]
+        return "\n".join(lines)
+
+
+# sensors.py: window summaries (see sampling.py) of the INA260, SHT40 and BMP280 keys, the per
+# sensor read time/sample counts, then the named DS18B20 probes (window mean only) from 100 up.
+SENSORS_FIELDS = (
+    _window_fields(1, ["voltage_mV", "voltage_V", "current_mA", "power_mW", "resistance_ohm"])
+    + _window_fields(21, ["sht40_temperature_C", "sht40_humidity_percent"])
+    + _window_fields(29, ["bmp280_temperature_C", "pressure_hPa"])
+    + _read_time_fields(37, ["ina260", "sht40", "bmp280", "ds18b20"])
+)
+
+GAS_MONITOR_FIELDS = [
+    (1, "totalVolume_ml", "double"),
+    (2, "flowRate_ml_per_min", "double"),
+    (3, "flowRateInst_ml_per_min", "double"),
+    (4, "flowRateEwma_ml_per_min", "double"),
+    (5, "pulseInterval_p50_s", "double"),
+    (6, "pulseInterval_p90_s", "double"),
+    (7, "pulseInterval_p99_s", "double"),
+    (8, "pulseJitter_s", "double"),
+    (9, "pulseBouncesRejected", "int64"),
+    (10, "pulseMissedEdges", "int64"),
+    (11, "pulseSuspicious", "int64"),
+    (12, "pulseMaxLag_s", "double"),
+]
+
+KA3005P_FIELDS = [
+    (1, "psu_voltage", "double"),
+    (2, "psu_current", "double"),
+    (3, "psu_power", "double"),
+    (4, "psu_commandedCurrent", "double"),
+    (5, "psu_setpointLatency_ms", "double"),
+    (6, "profile_step", "int64"),
+    (7, "profile_timingError_ms", "double"),
+    (8, "profile_timingErrorMax_ms", "double"),
+    (9, "profile_timingErrorMean_ms", "double"),
+]
+
+
+def sensors_schema(ds18b20_names=()):
+    """ds18b20_names: the names given to the probes in sensors.py's DS18B20_NAMES, in order."""
+    names = list(ds18b20_names.values()) if isinstance(ds18b20_names, dict) else list(ds18b20_names)
+    return TelemetrySchema("SensorsTelemetry", SENSORS_FIELDS + [(100 + i, name, "double") for i, name in enumerate(names)])
+
+
+def gas_monitor_schema():
+    return TelemetrySchema("GasMonitorTelemetry", GAS_MONITOR_FIELDS)
+
+
+def ka3005p_schema():
+    return TelemetrySchema("Ka3005pTelemetry", KA3005P_FIELDS)
+
+
+def _example_records(schema, count, seed=1):
+    """Plausible records using every key of the schema (values vary, like real readings)."""
+    import random
+
+    rng = random.Random(seed)
+    ts = 1760000000000
+    records = []
+    for i in range(count):
+        values = {}
+        for _, key, kind in schema.fields:
+            if kind == "int64":
+                values[key] = rng.randrange(0, 500)
+            elif kind == "bool":
+                values[key] = rng.random() < 0.5
+            else:
+                values[key] = round(rng.uniform(0, 1000), rng.choice((2, 4, 6)) if "_std" not in key else 6)
+        records.append((ts + i * 5000, values))
+    return records
+
+
+def _mqtt_publish_overhead(topic, payload_len, qos=1):
+    """MQTT 3.1.1 PUBLISH: fixed header + topic + packet id (QoS > 0), plus the PUBACK coming back."""
+    remaining = 2 + len(topic) + (2 if qos else 0) + payload_len
+    length_bytes = max(1, math.ceil(remaining.bit_length() / 7))
+    return 1 + length_bytes + remaining - payload_len + (4 if qos else 0)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import time
+
+    SCHEMAS = {
+        "sensors": lambda names: sensors_schema(names),
+        "gas_monitor": lambda names: gas_monitor_schema(),
+        "ka3005p": lambda names: ka3005p_schema(),
+    }
+    parser = argparse.ArgumentParser(description="Print a script's ThingsBoard telemetry .proto, or compare protobuf against JSON")
+    parser.add_argument("--proto", choices=sorted(SCHEMAS), help="print the device profile schema for this script")
+    parser.add_argument("--ds18b20", default="", help="sensors: comma separated DS18B20 names, in DS18B20_NAMES order")
+    parser.add_argument("--bench", action="store_true", help="bytes and encode CPU, protobuf against JSON")
+    parser.add_argument("--records", type=int, default=2000, help="records per schema for --bench")
+    args = parser.parse_args()
+    names = [name for name in args.ds18b20.split(",") if name]
+
+    if args.proto:
+        print(SCHEMAS[args.proto](names).proto())
+    if args.bench:
+        topic = "v1/devices/me/telemetry"
+        batch = 100 # records per JSON array message (roughly what a TelemetryBatcher flush holds)
+        for script, make in SCHEMAS.items():
+            schema = make(names or ["ds18b20_temp_1", "ds18b20_temp_2"])
+            records = _example_records(schema, args.records)
+
+            started = time.perf_counter()
+            payloads = [json.dumps(values, separators=(",", ":")) for _, values in records]
+            json_s = time.perf_counter() - started
+            started = time.perf_counter()
+            messages = [schema.encode(ts, values) for ts, values in records]
+            proto_s = time.perf_counter() - started
+            assert all(schema.decode(message) == record for message, record in zip(messages[:50], records))
+
+            # What actually crosses the link per record, MQTT framing included
+            entries = [f'{{"ts":{ts},"values":{payload}}}' for (ts, _), payload in zip(records, payloads)]
+            json_single = sum(len(e) + _mqtt_publish_overhead(topic, len(e)) for e in entries) / len(records)
+            json_batched = 0
+            for i in range(0, len(entries), batch):
+                body_len = len("[" + ",".join(entries[i:i + batch]) + "]")
+                json_batched += body_len + _mqtt_publish_overhead(topic, body_len)
+            json_batched /= len(records)
+            proto_payload = sum(len(m) for m in messages) / len(records)
+            proto_wire = sum(len(m) + _mqtt_publish_overhead(topic, len(m)) for m in messages) / len(records)
+
+            # The outbox keeps JSON on disk, so the protobuf send path is json.loads + encode
+            started = time.perf_counter()
+            for (ts, _), payload in zip(records, payloads):
+                schema.encode(ts, json.loads(payload))
+            outbox_s = time.perf_counter() - started
+
+            print(f"{script}: {len(schema.fields)} keys, {len(records)} records")
+            print(f"  bytes/record  JSON payload {sum(len(e) for e in entries) / len(records):.0f}, protobuf payload {proto_payload:.0f}")
+            print(f"  on the wire   JSON one per publish {json_single:.0f}, JSON {batch} per publish {json_batched:.0f}, protobuf one per publish {proto_wire:.0f}")
+            print(f"  encode us/rec json.dumps {json_s / len(records) * 1e6:.1f}, protobuf {proto_s / len(records) * 1e6:.1f}, outbox send path (json.loads + protobuf) {outbox_s / len(records) * 1e6:.1f}")
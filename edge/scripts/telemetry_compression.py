@@ -0,0 +1,283 @@
+# Report-by-exception compression of telemetry (optional, used by all the edge scripts)
+# Most readings barely move between samples (pressure, water temperature, a PSU sitting at its
+# setpoint), yet every sample of every key is sent and stored by ThingsBoard. TelemetryCompressor
+# sits between the TelemetryBatcher and the outbox and only passes on the values needed to
+# reconstruct each signal within a stated error, per key:
+#   {"deadband": x}          send when the value moved more than x from the last value sent
+#   {"deadband_pct": p}      ... more than p % of the last value sent
+#                            -> holding the last value sent is always within x (or p %) of the truth
+#   {"swinging_door": e}     swinging door trending: keeps the points where a straight line stops
+#   {"swinging_door_pct": p} fitting, so drifting signals cost a couple of points per trend
+#                            -> straight lines between the points sent are within e (or p %) of every sample
+#   {..., "heartbeat_s": s}  send at least every s seconds anyway (default heartbeat_s of the compressor)
+# Keys can be patterns ("ds18b20_*"). Keys without a rule, and text/bool values, are always sent.
+# A swinging door point goes out once the next point shows the trend has changed, so it can be a
+# sample or a few late (never more than the heartbeat). close() sends any point still held.
+# Benchmark on synthetic signals:  python telemetry_compression.py
+import fnmatch
+import math
+import threading
+
+from edge_metrics import REGISTRY
+
+VALUES_IN = REGISTRY.counter("edge_compression_values_in_total", "Telemetry values offered to the compressor", ["compressor"])
+VALUES_OUT = REGISTRY.counter("edge_compression_values_out_total", "Telemetry values the compressor passed on", ["compressor"])
+
+
+class _Deadband:
+    """Sample and hold: passes a value when it leaves the band around the last value passed."""
+
+    def __init__(self, band, relative, heartbeat_ms):
+        self.band = band
+        self.relative = relative
+        self.heartbeat_ms = heartbeat_ms
+        self.sent = None # (ts, value) last passed on
+
+    def add(self, ts, value):
+        sent = self.sent
+        if sent is not None and ts - sent[0] < self.heartbeat_ms:
+            band = self.band * abs(sent[1]) / 100.0 if self.relative else self.band
+            if abs(value - sent[1]) <= band:
+                return ()
+        self.sent = (ts, value)
+        return ((ts, value),)
+
+    def flush(self):
+        return ()
+
+
+class _SwingingDoor:
+    """Swinging door trending with compression deviation e (absolute, or % of the archived value)."""
+
+    def __init__(self, deviation, relative, heartbeat_ms):
+        self.deviation = deviation
+        self.relative = relative
+        self.heartbeat_ms = heartbeat_ms
+        self.archived = None # (ts, value) last point passed on - the doors hinge here
+        self.held = None # last point seen, ends the segment when the next one closes the doors
+        self.upper, self.lower = -math.inf, math.inf # slopes of the two doors
+
+    def _open(self, ts, value):
+        self.archived = (ts, value)
+        self.held = None
+        self.upper, self.lower = -math.inf, math.inf
+
+    def _doors(self, ts, value):
+        """The door slopes with this point added, or None if no line from the archived point fits them all."""
+        t0, v0 = self.archived
+        e = self.deviation * abs(v0) / 100.0 if self.relative else self.deviation
+        dt = ts - t0
+        if dt <= 0: # same timestamp - only fits if inside the band, and changes nothing
+            return (self.upper, self.lower) if abs(value - v0) <= e else None
+        upper = max(self.upper, (value - v0 - e) / dt)
+        lower = min(self.lower, (value - v0 + e) / dt)
+        return (upper, lower) if upper <= lower else None
+
+    def _segment_end(self):
+        # The classic algorithm always sends the held sample, but the line to it can miss earlier
+        # samples by up to 2e. When it would, send the point on the middle slope between the doors
+        # instead: it is within e of the held sample and its line within e of the whole segment.
+        t0, v0 = self.archived
+        ts, value = self.held
+        if ts <= t0 or self.upper <= (value - v0) / (ts - t0) <= self.lower:
+            return self.held
+        return ts, v0 + (self.upper + self.lower) / 2.0 * (ts - t0)
+
+    def add(self, ts, value):
+        if self.archived is None:
+            self._open(ts, value)
+            return ((ts, value),)
+        out = ()
+        doors = self._doors(ts, value)
+        if doors is None and self.held is not None:
+            end = self._segment_end()
+            out = (end,)
+            self._open(*end)
+            doors = self._doors(ts, value)
+        if doors is None: # a jump at the archived point's own timestamp
+            self._open(ts, value)
+            return out + ((ts, value),)
+        self.upper, self.lower = doors
+        if ts > self.archived[0]:
+            self.held = (ts, value)
+        if self.held is not None and ts - self.archived[0] >= self.heartbeat_ms:
+            end = self._segment_end()
+            self._open(*end)
+            out += (end,)
+        return out
+
+    def flush(self):
+        if self.held is None:
+            return ()
+        end = self._segment_end()
+        self._open(*end)
+        return (end,)
+
+
+def _make_series(rule, default_heartbeat_s):
+    heartbeat_ms = float(rule.get("heartbeat_s", default_heartbeat_s)) * 1000.0
+    if "swinging_door" in rule:
+        return _SwingingDoor(float(rule["swinging_door"]), False, heartbeat_ms)
+    if "swinging_door_pct" in rule:
+        return _SwingingDoor(float(rule["swinging_door_pct"]), True, heartbeat_ms)
+    if "deadband" in rule:
+        return _Deadband(float(rule["deadband"]), False, heartbeat_ms)
+    if "deadband_pct" in rule:
+        return _Deadband(float(rule["deadband_pct"]), True, heartbeat_ms)
+    raise ValueError(f"compression rule {rule} needs deadband, deadband_pct, swinging_door or swinging_door_pct")
+
+
+class TelemetryCompressor:
+    """A put_many sink that drops the values the rules say can be reconstructed, then forwards to sink."""
+
+    def __init__(self, sink, rules, heartbeat_s=300.0, name="telemetry"):
+        self.sink = sink
+        self.rules = dict(rules) # key or fnmatch pattern -> rule dict (see the top of this file)
+        self.heartbeat_s = heartbeat_s
+        self.name = name
+        for rule in self.rules.values():
+            _make_series(rule, heartbeat_s) # fail at startup on a typo, not on the first reading
+
+        self._lock = threading.Lock()
+        self._series = {} # (device, key) -> _Deadband/_SwingingDoor, or None for keys sent as they are
+        self._rule_cache = {}
+
+        # Stats
+        self.values_in = 0
+        self.values_out = 0
+        self.per_key = {} # key -> [in, out]
+        self._values_in = VALUES_IN.labels(compressor=name)
+        self._values_out = VALUES_OUT.labels(compressor=name)
+
+    def _rule(self, key):
+        if key not in self._rule_cache:
+            rule = self.rules.get(key)
+            if rule is None:
+                rule = next((r for pattern, r in self.rules.items() if fnmatch.fnmatchcase(key, pattern)), None)
+            self._rule_cache[key] = rule
+        return self._rule_cache[key]
+
+    def _series_for(self, device, key):
+        series_key = (device, key)
+        if series_key not in self._series:
+            rule = self._rule(key)
+            self._series[series_key] = _make_series(rule, self.heartbeat_s) if rule is not None else None
+        return self._series[series_key]
+
+    def put_many(self, records):
+        """Compresses [(ts_ms, values), ...] (or (ts_ms, values, device)) and forwards what's left."""
+        with self._lock:
+            out = {} # (ts, device) -> values, so points released late still go with their own timestamp
+            offered = 0
+            for record in records:
+                ts, values = record[0], record[1]
+                device = record[2] if len(record) > 2 else None
+                offered += len(values)
+                for key, value in values.items():
+                    series = None
+                    if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+                        series = self._series_for(device, key)
+                    points = ((ts, value),) if series is None else series.add(ts, value)
+                    for point_ts, point_value in points:
+                        out.setdefault((point_ts, device), {})[key] = point_value
+                    counts = self.per_key.setdefault(key, [0, 0])
+                    counts[0] += 1
+                    counts[1] += len(points)
+            self._forward(out, offered)
+
+    def flush(self):
+        """Sends the points the swinging doors are still holding (on shutdown)."""
+        with self._lock:
+            out = {}
+            for (device, key), series in self._series.items():
+                for ts, value in series.flush() if series is not None else ():
+                    out.setdefault((ts, device), {})[key] = value
+                    self.per_key.setdefault(key, [0, 0])[1] += 1
+            self._forward(out, 0)
+
+    def _forward(self, out, offered):
+        passed = sum(len(values) for values in out.values())
+        self.values_in += offered
+        self.values_out += passed
+        self._values_in.inc(offered)
+        self._values_out.inc(passed)
+        if out:
+            self.sink.put_many([(ts, values) if device is None else (ts, values, device)
+                                for (ts, device), values in sorted(out.items(), key=lambda item: item[0][0])])
+
+    def close(self):
+        self.flush()
+
+    def stats(self):
+        return {
+            "values_in": self.values_in,
+            "values_out": self.values_out,
+            "ratio": round(self.values_in / self.values_out, 2) if self.values_out else None,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+    import random
+
+    parser = argparse.ArgumentParser(description="Compression ratio and reconstruction error on synthetic readings")
+    parser.add_argument("--hours", type=float, default=24.0)
+    parser.add_argument("--period", type=float, default=5.0, help="sample period (s), sensors.py publishes every 5 s")
+    args = parser.parse_args()
+
+    class _Collect:
+        def __init__(self):
+            self.points = {}
+
+        def put_many(self, records):
+            for ts, values in records:
+                for key, value in values.items():
+                    self.points.setdefault(key, []).append((ts, value))
+
+    rng = random.Random(1)
+    rules = {
+        "pressure_hPa": {"swinging_door": 0.05},
+        "ds18b20_*": {"swinging_door": 0.05},
+        "sht40_humidity_percent": {"deadband": 0.5},
+        "psu_commandedCurrent": {"deadband": 0},
+        "current_mA": {"swinging_door_pct": 0.5},
+    }
+    collect = _Collect()
+    compressor = TelemetryCompressor(collect, rules, heartbeat_s=600)
+    period_ms = int(args.period * 1000)
+    count = int(args.hours * 3600 / args.period)
+    originals = {}
+    pressure, temperature, humidity, setpoint = 1013.0, 20.0, 45.0, 2.0
+    for i in range(count):
+        ts = 1760000000000 + i * period_ms
+        t_h = i * args.period / 3600
+        pressure += rng.gauss(0, 0.01) # weather: slow random walk
+        temperature = 20 + 3 * math.sin(2 * math.pi * t_h / 24) + rng.gauss(0, 0.01) # day/night swing
+        humidity = 45 + 10 * math.sin(2 * math.pi * t_h / 24 + 1) + rng.gauss(0, 0.1)
+        if rng.random() < 0.002: # a new dashboard setpoint now and then
+            setpoint = round(rng.uniform(0, 5), 1)
+        current = setpoint * 1000 * (1 + rng.gauss(0, 0.001))
+        values = {"pressure_hPa": pressure, "ds18b20_temp_1": temperature, "sht40_humidity_percent": humidity,
+                  "psu_commandedCurrent": setpoint, "current_mA": current}
+        for key, value in values.items():
+            originals.setdefault(key, []).append((ts, value))
+        compressor.put_many([(ts, values)])
+    compressor.close()
+
+    print(f"{count} samples per key over {args.hours:g} h: {compressor.stats()}")
+    for key, samples in originals.items():
+        rule = compressor._rule(key)
+        points = collect.points[key]
+        worst = 0.0
+        j = 0
+        for ts, value in samples:
+            while j + 1 < len(points) and points[j + 1][0] <= ts:
+                j += 1
+            t0, v0 = points[j]
+            if "swinging_door" in rule or "swinging_door_pct" in rule: # straight lines between points
+                t1, v1 = points[min(j + 1, len(points) - 1)]
+                estimate = v0 + (v1 - v0) * (ts - t0) / (t1 - t0) if t1 > t0 else v0
+            else: # hold the last value
+                estimate = v0
+            worst = max(worst, abs(value - estimate))
+        print(f"  {key:24} {rule}: {len(samples)} -> {len(points)} points ({len(samples) / len(points):.0f}x), max error {worst:.4g}")
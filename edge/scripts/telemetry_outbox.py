@@ -0,0 +1,206 @@
+# Disk-backed store-and-forward outbox for ThingsBoard telemetry (used by all the edge scripts)
+# Every reading is written to a small SQLite (WAL) database with its original timestamp before it
+# is sent. A background thread publishes whatever is waiting while MQTT is connected, so when the
+# broker or the WAN is down readings pile up on disk (within a fixed budget) instead of in paho's
+# memory, and on reconnect the backlog goes out in large batched ThingsBoard payloads
+# ([{"ts": ..., "values": {...}}, ...]) at a limited rate. The cloud Prometheus/ThingsBoard accept
+# the late data because each record keeps its capture time.
+# With gateway=True records carry a device name and go out through the ThingsBoard gateway API
+# ({"Device A": [{"ts": ..., "values": {...}}, ...], "Device B": [...]}) on one connection.
+# With encoder (a tb_protobuf.TelemetrySchema) records go out as one protobuf message each, for a
+# device profile with Protobuf payloads. They're still stored as JSON, so the schema can change.
+import json
+import sqlite3
+import threading
+import os
+import time
+
+from edge_metrics import REGISTRY
+
+ROW_OVERHEAD_BYTES = 32 # rough per-row cost on top of the payload, for the disk budget
+
+
+PUBLISH_SECONDS = REGISTRY.histogram("edge_mqtt_publish_seconds", "Time from publishing a telemetry batch to the broker acknowledging it", ["outbox"])
+PUBLISH_FAILURES = REGISTRY.counter("edge_mqtt_publish_failures_total", "Telemetry batches that weren't acknowledged and stay queued", ["outbox"])
+QUEUED_RECORDS = REGISTRY.gauge("edge_outbox_queued_records", "Telemetry records waiting in the outbox", ["outbox"])
+DROPPED_RECORDS = REGISTRY.counter("edge_outbox_dropped_records_total", "Oldest records dropped to stay inside the outbox budget", ["outbox"])
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class TelemetryOutbox:
+    """Persistent telemetry queue drained to ThingsBoard over an existing paho client."""
+
+    def __init__(self, path, client, topic=None, max_bytes=50 * 1024 * 1024,
+                 batch_records=500, batch_bytes=64 * 1024, batches_per_s=5.0, qos=1, publish_timeout_s=10.0, gateway=False, encoder=None):
+        if gateway and encoder:
+            raise ValueError("protobuf telemetry isn't supported through the gateway API")
+        self.path = path
+        self.client = client
+        self.gateway = gateway
+        self.encoder = encoder
+        self.topic = topic or ("v1/gateway/telemetry" if gateway else "v1/devices/me/telemetry")
+        self.max_bytes = max_bytes
+        self.batch_records = batch_records
+        self.batch_bytes = batch_bytes
+        self.min_batch_gap_s = 1.0 / batches_per_s if batches_per_s else 0.0
+        self.qos = qos
+        self.publish_timeout_s = publish_timeout_s
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL") # WAL + NORMAL: durable across app crashes, cheap on the SD card
+        self._db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL, payload TEXT NOT NULL, device TEXT)")
+        if "device" not in [row[1] for row in self._db.execute("PRAGMA table_info(outbox)")]:
+            self._db.execute("ALTER TABLE outbox ADD COLUMN device TEXT") # outbox from before gateway support
+        rows, payload_bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM outbox").fetchone()
+        self._bytes = payload_bytes + rows * ROW_OVERHEAD_BYTES
+
+        # Stats
+        self.queued = rows
+        self.sent = 0
+        self.batches = 0
+        self.last_batch = {} # records/bytes/publish latency of the last MQTT message sent
+        self.dropped = 0 # oldest records dropped to stay inside max_bytes
+        self.json_fallbacks = 0 # records the encoder couldn't take, sent as JSON instead
+        if rows:
+            print(f"Telemetry outbox {path} has {rows} records waiting from a previous run")
+
+        label = os.path.splitext(os.path.basename(path))[0]
+        self._publish_seconds = PUBLISH_SECONDS.labels(outbox=label)
+        self._publish_failures = PUBLISH_FAILURES.labels(outbox=label)
+        self._dropped_records = DROPPED_RECORDS.labels(outbox=label)
+        QUEUED_RECORDS.labels(outbox=label).set_function(lambda: self.queued)
+
+    def put(self, values, ts=None):
+        """Stores one telemetry record. ts is the capture time in ms (defaults to now)."""
+        self.put_many([(ts if ts is not None else now_ms(), values)])
+
+    def put_many(self, records):
+        """Stores [(ts_ms, values), ...] (or (ts_ms, values, device) for a gateway) in one transaction.
+
+        They normally go out as one message.
+        """
+        rows = [(record[0], json.dumps(record[1], separators=(",", ":")), record[2] if len(record) > 2 else None) for record in records]
+        with self._lock:
+            with self._db: # one transaction - one fsync for the whole batch
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT INTO outbox (ts, payload, device) VALUES (?, ?, ?)", rows)
+            self._bytes += sum(len(payload) + ROW_OVERHEAD_BYTES for _, payload, _ in rows)
+            self.queued += len(rows)
+            if self._bytes > self.max_bytes:
+                self._enforce_budget()
+        self._wake.set()
+
+    def _enforce_budget(self):
+        # Drop the oldest records until we're back under 90% of the budget
+        target = self.max_bytes * 0.9
+        while self._bytes > target:
+            rows = self._db.execute("SELECT id, LENGTH(payload) FROM outbox ORDER BY id LIMIT 1000").fetchall()
+            if not rows:
+                self._bytes = 0
+                break
+            last_id = rows[0][0]
+            for row_id, length in rows:
+                self._bytes -= length + ROW_OVERHEAD_BYTES
+                self.queued -= 1
+                self.dropped += 1
+                self._dropped_records.inc()
+                last_id = row_id
+                if self._bytes <= target:
+                    break
+            self._db.execute("DELETE FROM outbox WHERE id <= ?", (last_id,))
+        print(f"Telemetry outbox over its {self.max_bytes} byte budget, {self.dropped} oldest records dropped so far")
+
+    def _next_batch(self):
+        with self._lock:
+            rows = self._db.execute("SELECT id, ts, payload, device FROM outbox ORDER BY id LIMIT ?", (self.batch_records,)).fetchall()
+        batch, size = [], 2
+        for row_id, ts, payload, device in rows:
+            entry = f'{{"ts":{ts},"values":{payload}}}'
+            fallback = False
+            if self.encoder:
+                message = self.encoder.encode(ts, json.loads(payload))
+                fallback = message is None
+                entry = entry.encode("utf-8") if fallback else message # the profile's JSON compatibility option takes it
+            if batch and size + len(entry) + 1 > self.batch_bytes:
+                break
+            batch.append((row_id, entry, len(payload), device))
+            self.json_fallbacks += fallback
+            size += len(entry) + 1
+        return batch
+
+    def _body(self, batch):
+        if not self.gateway:
+            return "[" + ",".join(entry for _, entry, _, _ in batch) + "]"
+        by_device = {}
+        for _, entry, _, device in batch:
+            by_device.setdefault(device, []).append(entry)
+        return "{" + ",".join(f'{json.dumps(device)}:[{",".join(entries)}]' for device, entries in by_device.items()) + "}"
+
+    def _publish(self, batch):
+        # TB takes one protobuf message per publish, JSON goes as one array
+        messages = [entry for _, entry, _, _ in batch] if self.encoder else [self._body(batch)]
+        started = time.monotonic()
+        infos = [self.client.publish(self.topic, message, qos=self.qos) for message in messages]
+        if any(info.rc != 0 for info in infos):
+            self._publish_failures.inc()
+            return False # anything that did go out is sent again, TB keeps the last value per ts
+        if self.qos:
+            deadline = started + self.publish_timeout_s
+            for info in infos:
+                info.wait_for_publish(max(0.0, deadline - time.monotonic()))
+                if not info.is_published():
+                    self._publish_failures.inc()
+                    return False
+        self._publish_seconds.observe(time.monotonic() - started)
+        last_id = batch[-1][0]
+        with self._lock:
+            # _enforce_budget may have dropped some of the batch (and counted them) while it was in flight
+            removed, removed_bytes = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM outbox WHERE id <= ?", (last_id,)).fetchone()
+            self._db.execute("DELETE FROM outbox WHERE id <= ?", (last_id,))
+            self._bytes -= removed_bytes + removed * ROW_OVERHEAD_BYTES
+            self.queued -= removed
+        self.sent += len(batch)
+        self.batches += 1
+        self.last_batch = {"records": len(batch), "messages": len(messages), "bytes": sum(len(message) for message in messages),
+                           "publish_s": time.monotonic() - started}
+        return True
+
+    def _drain_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(1.0)
+            self._wake.clear()
+            while not self._stop.is_set() and self.client.is_connected():
+                batch = self._next_batch()
+                if not batch:
+                    break
+                started = time.monotonic()
+                try:
+                    if not self._publish(batch):
+                        break # leave it on disk, try again when reconnected
+                except Exception as e:
+                    print(f"Error publishing telemetry batch: {e}")
+                    break
+                # Rate limit the backlog so a multi-day catch up doesn't swamp TB Edge
+                self._stop.wait(max(0.0, self.min_batch_gap_s - (time.monotonic() - started)))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._drain_loop, name="telemetry-outbox", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            self._db.close()
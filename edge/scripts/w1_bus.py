@@ -0,0 +1,161 @@
+# 1-Wire DS18B20 acquisition for sensors.py
+# - Probes are mapped to names by ROM ID (e.g. 28-00000xxxxx), not by glob order. With no names
+#   configured, a lone probe keeps the name it always had (ds18b20_temp_1), so dashboards don't break.
+# - One bulk conversion is triggered for every probe on the bus (therm_bulk_read), then the
+#   results are read concurrently, so a cycle takes about one conversion time (~750 ms)
+#   however many probes there are, instead of N x 750 ms.
+# - The bus is rescanned every rescan_s so hot-plugged probes show up without a restart.
+# FakeW1Tree builds a fake /sys/bus/w1/devices tree for testing without probes attached.
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+W1_DEVICES_DIR = os.environ.get("W1_DEVICES_DIR", "/sys/bus/w1/devices") # sim_hardware.py points it at a FakeW1Tree
+DS18B20_FAMILY = "28-"
+POWER_ON_RESET_MC = 85000 # 85.000 C is what a DS18B20 reports before its first conversion
+LEGACY_NAME = "ds18b20_temp_1" # the single probe's key before probes were named by ROM ID
+
+
+class W1Bus:
+    """DS18B20 probes on one 1-Wire bus master."""
+
+    def __init__(self, names=None, base_dir=W1_DEVICES_DIR, bus_master="w1_bus_master1", rescan_s=60.0,
+                 retries=3, conversion_timeout_s=1.5):
+        self.names = dict(names or {}) # ROM ID -> telemetry key
+        self.base_dir = base_dir
+        self.bulk_path = os.path.join(base_dir, bus_master, "therm_bulk_read")
+        self.rescan_s = rescan_s
+        self.retries = retries
+        self.conversion_timeout_s = conversion_timeout_s
+        self.probes = {} # ROM ID -> telemetry key, for probes currently on the bus
+        self._last_scan = None
+        self._executor = None
+
+        self.bulk_conversions = 0
+        self.read_errors = 0
+
+    def name_for(self, rom_id):
+        # Unmapped probes still get a stable name, so they don't swap if the glob order changes
+        return self.names.get(rom_id, "ds18b20_" + rom_id.replace("-", "_"))
+
+    def scan(self):
+        """Rescans the bus. Returns (added, removed) ROM IDs."""
+        found = {os.path.basename(p) for p in glob.glob(os.path.join(self.base_dir, DS18B20_FAMILY + "*"))}
+        added = sorted(found - self.probes.keys())
+        removed = sorted(self.probes.keys() - found)
+        for rom_id in removed:
+            print(f"DS18B20 {rom_id} ({self.probes.pop(rom_id)}) removed from the bus")
+        for rom_id in added:
+            if not self.names and len(found) == 1 and LEGACY_NAME not in self.probes.values():
+                self.probes[rom_id] = LEGACY_NAME # it stays with this probe if more are plugged in later
+            else:
+                self.probes[rom_id] = self.name_for(rom_id)
+            print(f"DS18B20 {rom_id} found, publishing as {self.probes[rom_id]}")
+        for rom_id in self.names:
+            if rom_id not in found:
+                print(f"Configured DS18B20 {rom_id} ({self.names[rom_id]}) not found on the bus")
+        self._last_scan = time.monotonic()
+        return added, removed
+
+    def _bulk_convert(self):
+        """Starts a conversion on every probe at once and waits for it. False if unsupported."""
+        try:
+            with open(self.bulk_path, "w") as f:
+                f.write("trigger\n")
+        except OSError:
+            return False # older kernel or no bus master - each probe converts when read instead
+        deadline = time.monotonic() + self.conversion_timeout_s
+        while time.monotonic() < deadline:
+            # -1: conversion in progress, 1: done and results waiting, 0: nothing pending
+            with open(self.bulk_path, "r") as f:
+                state = f.read().strip()
+            if state != "-1":
+                break
+            time.sleep(0.05)
+        self.bulk_conversions += 1
+        return True
+
+    def read_probe(self, rom_id):
+        """Reads one probe in degrees C, or None after the retries are used up."""
+        folder = os.path.join(self.base_dir, rom_id)
+        for attempt in range(self.retries):
+            try:
+                value = self._read_millidegrees(folder)
+                if value is not None and value != POWER_ON_RESET_MC:
+                    return value / 1000.0
+            except (OSError, ValueError) as e:
+                print(f"Error reading DS18B20 {rom_id}: {e}")
+            time.sleep(0.1) # Small delay before retrying read
+        self.read_errors += 1
+        print(f"Failed to read DS18B20 {rom_id} after {self.retries} attempts")
+        return None
+
+    @staticmethod
+    def _read_millidegrees(folder):
+        # 'temperature' gives the result of a pending bulk conversion directly (newer kernels).
+        # Fall back to w1_slave, which has a CRC check line ending in YES/NO.
+        temperature_path = os.path.join(folder, "temperature")
+        if os.path.exists(temperature_path):
+            with open(temperature_path, "r") as f:
+                return int(f.read().strip())
+        with open(os.path.join(folder, "w1_slave"), "r") as f:
+            lines = f.readlines()
+        if len(lines) < 2 or not lines[0].strip().endswith("YES"):
+            return None # CRC error
+        equals_pos = lines[1].find("t=")
+        if equals_pos == -1:
+            return None
+        return int(lines[1][equals_pos + 2:])
+
+    def read_all(self):
+        """One bulk conversion, then all probes read concurrently. Returns {name: temp_C}."""
+        if self._last_scan is None or time.monotonic() - self._last_scan >= self.rescan_s:
+            self.scan()
+        if not self.probes:
+            return {}
+        self._bulk_convert()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="w1")
+        rom_ids = list(self.probes)
+        results = {}
+        for rom_id, temp in zip(rom_ids, self._executor.map(self.read_probe, rom_ids)):
+            if temp is not None:
+                results[self.probes[rom_id]] = temp
+        return results
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class FakeW1Tree:
+    """A fake /sys/bus/w1/devices tree. Point W1Bus(base_dir=tree.base_dir) at it."""
+
+    def __init__(self, base_dir, bus_master="w1_bus_master1"):
+        self.base_dir = base_dir
+        os.makedirs(os.path.join(base_dir, bus_master), exist_ok=True)
+        with open(os.path.join(base_dir, bus_master, "therm_bulk_read"), "w") as f:
+            f.write("0\n")
+
+    def add_probe(self, rom_id, temp_c, crc_ok=True, temperature_file=True):
+        folder = os.path.join(self.base_dir, rom_id)
+        os.makedirs(folder, exist_ok=True)
+        self.set_temperature(rom_id, temp_c, crc_ok, temperature_file)
+
+    def set_temperature(self, rom_id, temp_c, crc_ok=True, temperature_file=True):
+        folder = os.path.join(self.base_dir, rom_id)
+        millidegrees = int(round(temp_c * 1000))
+        with open(os.path.join(folder, "w1_slave"), "w") as f:
+            f.write(f"50 05 4b 46 7f ff 0c 10 1c : crc=1c {'YES' if crc_ok else 'NO'}\n")
+            f.write(f"50 05 4b 46 7f ff 0c 10 1c t={millidegrees}\n")
+        if temperature_file:
+            with open(os.path.join(folder, "temperature"), "w") as f:
+                f.write(f"{millidegrees}\n")
+
+    def remove_probe(self, rom_id):
+        folder = os.path.join(self.base_dir, rom_id)
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+        os.rmdir(folder)